@@ -1,178 +1,49 @@
+import queue
 from tkinter import *
-from PIL import ImageTk, Image
 from tkinter import ttk
-from tqdm.auto import tqdm
-import threading
-from gpiozero import Button as KillSwitch
-import RPi.GPIO as GPIO
-import time
-
-
-class Axis:
-    def __init__(self, axis_name, direction_pin, step_pin, kill_switch_i_pin, kill_switch_f_pin,
-                 direction, step_resolution, axis_length):
-        self.directions = {'up': 1, 'down': 0, 'left': 0, 'right': 1, 'forward': 1, 'backward': 0}
-        self.velocity = 0
-        self.current_position = 0
-        self.step_counter = 0
-        self.stop = 0  # a condition triggered by one of the kill switches
-
-        self.axis_name = axis_name
-        self.direction_pin = direction_pin
-        self.step_pin = step_pin
-        self.step_resolution = step_resolution
-        self.direction = self.directions[direction]
-        self.axis_length = axis_length
-
-        self.kill_switch_i_pin = kill_switch_i_pin  # switch at 0
-        self.kill_switch_f_pin = kill_switch_f_pin  # switch at axis_length
-        self.kill_switch_i = KillSwitch(kill_switch_i_pin)  # switch at 0
-        self.kill_switch_f = KillSwitch(kill_switch_f_pin)  # switch at axis_length
-        self.kill_switch_i_state = self.kill_switch_i.is_pressed  # switch at 0
-        self.kill_switch_f_state = self.kill_switch_f.is_pressed  # switch at axis_length
-
-        self.check_axis_kill_switches()
-        self.axis_setup()
-
-    def axis_setup(self):
-        # This function sets up the motor's pins for initial use
-        GPIO.setup(self.direction_pin, GPIO.OUT)
-        GPIO.setup(self.step_pin, GPIO.OUT)
-
-    def check_axis_kill_switches(self):
-        # This function reads the off switch status and updates it's state in the object
-        self.kill_switch_i_state = self.kill_switch_i.is_pressed
-        self.kill_switch_f_state = self.kill_switch_f.is_pressed
-
-        if (self.kill_switch_i_state and not self.direction) or (self.kill_switch_f_state and self.direction):
-            self.stop = 1
-
-        else:
-            self.stop = 0
-
-    def motor_single_step(self, velocity):
-        # This function makes the motor moves a single step in a defined time interval
-        GPIO.output(self.step_pin, GPIO.HIGH)
-        time.sleep(0.5 * (1 / velocity))
-        GPIO.output(self.step_pin, GPIO.LOW)
-        time.sleep(0.5 * (1 / velocity))
-
-    def update_axis_status(self, velocity, direction):
-        # This function updates the motor's dynamic values
-        self.step_counter += 1
-        self.velocity = velocity
-        self.direction = direction
-
-        if self.direction == 1:
-            self.current_position += self.step_resolution
-        else:
-            self.current_position -= self.step_resolution
-
-        self.current_position = round(self.current_position, 3)
-
-    def axis_while_loop(self, velocity, direction, next_position):
-        # Main motor function, moves the motor and updates it's dynamic values
-        GPIO.output(self.direction_pin, direction)
-        while not self.stop and velocity != 0 and self.current_position != next_position:
-            self.motor_single_step(velocity)
-            self.update_axis_status(velocity, direction)
-            self.check_axis_kill_switches()
-
-    def axis_for_loop(self, velocity, direction, step_amount):
-        # Main motor function, moves the motor and updates it's dynamic values
-        GPIO.output(self.direction_pin, direction)
-        for _step in range(step_amount):
-            if not self.stop and velocity != 0:
-                self.motor_single_step(velocity)
-                self.update_axis_status(velocity, direction)
-                self.check_axis_kill_switches()
-            else:
-                break
-
-    def get_values(self):
-        # This function returns all the motor's attributes
-        return {'axis_name': self.axis_name,
-                'axis_length': self.axis_length,
-                'step_resolution': self.step_resolution,
-                'direction_pin': self.direction_pin,
-                'step_pin': self.step_pin,
-                'kill_switch_i_pin': self.kill_switch_i_pin,
-                'kill_switch_f_pin': self.kill_switch_f_pin,
-                'step_counter': self.step_counter,
-                'direction': self.direction,
-                'velocity': self.velocity,
-                'current_position': self.current_position,
-                'i_off_switch': self.kill_switch_i_state,
-                'f_off_switch': self.kill_switch_f_state}
-
-    def go_to_home_position(self, home_position):
-        direction = self.direction
-        velocity = 1000
-        # Main motor function, moves the motor and updates it's dynamic values
-        GPIO.output(self.direction_pin, direction)
-
-        print(f'{self.axis_name}: going to position 0.')
-        while not self.stop:
-            self.check_axis_kill_switches()
-            self.motor_single_step(velocity)
-            self.update_axis_status(velocity, direction)
-
-        self.current_position = 0
-        print(f'{self.axis_name}: going to home position.')
-        direction = not self.direction
-        GPIO.output(self.direction_pin, direction)
-        for _ in range(int(home_position / self.step_resolution)):
-            self.check_axis_kill_switches()
-            self.motor_single_step(velocity)
-            self.update_axis_status(velocity, direction)
+from step_drivers import get_driver
+from homing import format_homing_report
+from jog import Jog
+from machine import build_machine, driver_name, start_metrics
+from metrics import get_metrics
+from move_queue import MoveQueue
+
+POLL_INTERVAL = 100  # [msec], how often the GUI shows the motion state
+# The step direction of every button, the GUI's own polarity: its Left and Right drive X the other way round from
+# axis_control.DIRECTIONS
+BUTTON_DIRECTIONS = {'up': 1, 'down': 0, 'left': 0, 'right': 1, 'forward': 1, 'backward': 0}
+KEY_RELEASE_DELAY = 40  # [msec], a held key's auto-repeat sends release / press pairs, a release waits this long
+# The jog keys: (axis name, direction)
+JOG_KEYS = {'Left': ('x', 'left'), 'Right': ('x', 'right'), 'Up': ('y', 'up'), 'Down': ('y', 'down'),
+            'Prior': ('z', 'forward'), 'Next': ('z', 'backward')}
 
 
 def update_current_position():
-    global x_axis
-    global y_axis
-    global z_axis
     global current_position_entry
+    global current_velocity_entry
 
-    current_position = (x_axis.current_position, y_axis.current_position, z_axis.current_position)
+    # The moves run on the move queue's threads, the Tk thread only shows its state snapshot
+    state = motion_queue.snapshot()
     current_position_entry.delete(0, 'end')
-    current_position_entry.insert(END, str(current_position))
-
-
-def calc_instructions_for_next_position(axis_status, next_position):
-    current_position = axis_status['current_position']
-    axis_resolution = axis_status['step_resolution']
-    delta = abs(current_position - next_position)
-    steps = int(delta / axis_resolution)
+    current_position_entry.insert(END, str(state['positions']))
+    current_velocity_entry.delete(0, 'end')
+    current_velocity_entry.insert(END, str(tuple(round(velocity, 1) for velocity in state['velocities'])))
 
-    if next_position > current_position:
-        next_direction = 1
 
-    if next_position < current_position:
-        next_direction = 0
-
-    if next_position == current_position:
-        next_direction = 1
-        steps = 0
-
-    return {'steps_amount': steps, 'direction': next_direction}
+def poll_motion_state():
+    update_current_position()
+    master.after(POLL_INTERVAL, poll_motion_state)
 
 
 def homing_sequence():
-    global x_axis
-    global y_axis
-    global z_axis
-
-    x_homing_thread = threading.Thread(target=x_axis.go_to_home_position, args=(int(x_axis.axis_length * 0.5),))
-    y_homing_thread = threading.Thread(target=y_axis.go_to_home_position, args=(int(y_axis.axis_length * 0.5),))
-    z_homing_thread = threading.Thread(target=z_axis.go_to_home_position, args=(int(z_axis.axis_length * 0.5),))
-    x_homing_thread.start()
-    y_homing_thread.start()
-    z_homing_thread.start()
-    x_homing_thread.join()
-    y_homing_thread.join()
-    z_homing_thread.join()
+    # All three axes home together in one timing loop, see homing.py
+    for line in format_homing_report(homing.home()):
+        print(line)
 
-    update_current_position()
+
+def start_homing_sequence():
+    get_metrics().record_command('gui', 'home')
+    motion_queue.submit(homing_sequence)
 
 
 def which_axis(axis_name):
@@ -185,19 +56,20 @@ def which_axis(axis_name):
 
 
 def create_motion(axis_name, direction, steps, velocity):
+    get_metrics().record_command('gui', 'free_move')
     if steps > 0:
         axis = which_axis(axis_name)
-        axis.stop = False
 
-        direction = axis.directions[direction]
+        direction = BUTTON_DIRECTIONS[direction]
         # Main motor function, moves the motor and updates it's dynamic values
-        GPIO.output(axis.direction_pin, direction)
-        axis.check_axis_kill_switches()
-        for _ in tqdm(range(steps)):
-            if not axis.stop:
-                axis.check_axis_kill_switches()
-                axis.motor_single_step(velocity)
-                axis.update_axis_status(velocity, direction)
+        axis.gpio.output(axis.direction_pin, direction)
+        axis.arm_kill_switches(direction)
+        steps = axis.clip_steps(direction, steps)
+        if axis.stop or steps <= 0:
+            return None
+
+        # The progress is shown by polling the move queue, nothing is printed from the step loop
+        axis.run_step_schedule(axis.step_schedule(steps, velocity), velocity, direction, source='gui')
     return None
     # print(f'Current position: ({x_axis.current_position}, {y_axis.current_position}, {z_axis.current_position}) [mm]')
 
@@ -208,8 +80,7 @@ def free_move_up():
 
     free_motion_velocity = float(free_motion_velocity_entry.get())
     free_motion_steps = int(free_motion_steps_entry.get())
-    create_motion('y', 'up', free_motion_steps, free_motion_velocity)
-    update_current_position()
+    motion_queue.submit(create_motion, 'y', 'up', free_motion_steps, free_motion_velocity)
 
 
 def free_move_down():
@@ -218,8 +89,7 @@ def free_move_down():
 
     free_motion_velocity = float(free_motion_velocity_entry.get())
     free_motion_steps = int(free_motion_steps_entry.get())
-    create_motion('y', 'down', free_motion_steps, free_motion_velocity)
-    update_current_position()
+    motion_queue.submit(create_motion, 'y', 'down', free_motion_steps, free_motion_velocity)
 
 
 def free_move_left():
@@ -228,8 +98,7 @@ def free_move_left():
 
     free_motion_velocity = float(free_motion_velocity_entry.get())
     free_motion_steps = int(free_motion_steps_entry.get())
-    create_motion('x', 'left', free_motion_steps, free_motion_velocity)
-    update_current_position()
+    motion_queue.submit(create_motion, 'x', 'left', free_motion_steps, free_motion_velocity)
 
 
 def free_move_right():
@@ -238,8 +107,7 @@ def free_move_right():
 
     free_motion_velocity = float(free_motion_velocity_entry.get())
     free_motion_steps = int(free_motion_steps_entry.get())
-    create_motion('x', 'right', free_motion_steps, free_motion_velocity)
-    update_current_position()
+    motion_queue.submit(create_motion, 'x', 'right', free_motion_steps, free_motion_velocity)
 
 
 def free_move_forward():
@@ -248,8 +116,7 @@ def free_move_forward():
 
     free_motion_velocity = float(free_motion_velocity_entry.get())
     free_motion_steps = int(free_motion_steps_entry.get())
-    create_motion('z', 'forward', free_motion_steps, free_motion_velocity)
-    update_current_position()
+    motion_queue.submit(create_motion, 'z', 'forward', free_motion_steps, free_motion_velocity)
 
 
 def free_move_backward():
@@ -258,41 +125,68 @@ def free_move_backward():
 
     free_motion_velocity = float(free_motion_velocity_entry.get())
     free_motion_steps = int(free_motion_steps_entry.get())
-    create_motion('z', 'backward', free_motion_steps, free_motion_velocity)
-    update_current_position()
+    motion_queue.submit(create_motion, 'z', 'backward', free_motion_steps, free_motion_velocity)
+
+
+def jog_press(axis_name, direction):
+    # The jog velocity is read on every press, the running step loop picks it up without a new move
+    global free_motion_velocity_entry
+
+    axis = which_axis(axis_name)
+    velocity = float(free_motion_velocity_entry.get())
+    get_metrics().record_command('gui', 'jog')
+    if jog.press(axis, BUTTON_DIRECTIONS[direction], velocity):
+        motion_queue.submit(jog.run, discarded=jog.cancel)
+
 
+def jog_release(axis_name):
+    jog.release(which_axis(axis_name))
 
-def planned_x_movement(x_pos, x_vel):
-    next_steps = calc_instructions_for_next_position(x_axis.get_values(), x_pos)
 
-    if next_steps['direction'] == 1:
-        direction = 'left'
-    if next_steps['direction'] == 0:
-        direction = 'right'
+def jog_button_pressed(axis_name, direction):
+    # Hold to jog: the button runs the axis while it is held, its click (a fixed steps free move) is skipped
+    def pressed(event):
+        if not jog_mode.get():
+            return None
+        jog_press(axis_name, direction)
+        return 'break'
+    return pressed
 
-    create_motion('x', direction, next_steps['steps_amount'], x_vel)
 
+def jog_button_released(axis_name):
+    def released(event):
+        if not jog_mode.get():
+            return None
+        jog_release(axis_name)
+        return 'break'
+    return released
 
-def planned_y_movement(y_pos, y_vel):
-    next_steps = calc_instructions_for_next_position(y_axis.get_values(), y_pos)
 
-    if next_steps['direction'] == 1:
-        direction = 'up'
-    if next_steps['direction'] == 0:
-        direction = 'down'
+def jog_key_pressed(event):
+    if not jog_mode.get() or event.keysym not in JOG_KEYS or isinstance(event.widget, Entry):
+        return None
+    pending = pending_key_releases.pop(event.keysym, None)
+    if pending is not None:
+        master.after_cancel(pending)  # an auto-repeat, the key is still held
+        return 'break'
+    jog_press(*JOG_KEYS[event.keysym])
+    return 'break'
 
-    create_motion('y', direction, next_steps['steps_amount'], y_vel)
 
+def jog_key_released(event):
+    if event.keysym not in JOG_KEYS or isinstance(event.widget, Entry):
+        return None
 
-def planned_z_movement(z_pos, z_vel):
-    next_steps = calc_instructions_for_next_position(z_axis.get_values(), z_pos)
+    def release():
+        pending_key_releases.pop(event.keysym, None)
+        jog_release(JOG_KEYS[event.keysym][0])
 
-    if next_steps['direction'] == 1:
-        direction = 'forward'
-    if next_steps['direction'] == 0:
-        direction = 'backward'
+    pending_key_releases[event.keysym] = master.after(KEY_RELEASE_DELAY, release)
+    return 'break'
 
-    create_motion('z', direction, next_steps['steps_amount'], z_vel)
+
+def stream_jog_velocity(event):
+    jog.set_velocity(float(free_motion_velocity_entry.get()))
 
 
 def planned_movement():
@@ -311,158 +205,188 @@ def planned_movement():
     y_vel = float(y_velocity.get())
     z_vel = float(z_velocity.get())
 
-    x_planned_thread = threading.Thread(target=planned_x_movement, args=(x_pos, x_vel,))
-    y_planned_thread = threading.Thread(target=planned_y_movement, args=(y_pos, y_vel,))
-    z_planned_thread = threading.Thread(target=planned_z_movement, args=(z_pos, z_vel,))
-    x_planned_thread.start()
-    y_planned_thread.start()
-    z_planned_thread.start()
-    x_planned_thread.join()
-    y_planned_thread.join()
-    z_planned_thread.join()
-    update_current_position()
-    # print(f'Current position: ({x_axis.current_position}, {y_axis.current_position}, {z_axis.current_position}) [mm]')
+    # The move is planned on the move queue's planner thread while the moves before it still run
+    get_metrics().record_command('gui', 'planned_movement')
+    try:
+        motion_queue.put((x_pos, y_pos, z_pos), velocities=(x_vel, y_vel, z_vel), block=False)
+    except queue.Full:
+        print('The move queue is full, the move was not queued.')
 
 
 def clear_position():
     x_axis.current_position = 0.0
     y_axis.current_position = 0.0
     z_axis.current_position = 0.0
-    update_current_position()
+
+
+def start_clear_position():
+    get_metrics().record_command('gui', 'clear')
+    motion_queue.submit(clear_position)
+
+
+def stop_motion():
+    get_metrics().record_command('gui', 'stop')
+    jog.release_all()
+    motion_queue.stop()
 
 
 def exit_program():
-    GPIO.cleanup()
+    motion_queue.shutdown()
+    driver.cleanup()
     print("Bye bye.")
     exit()
 
 
-GPIO.setmode(GPIO.BOARD)
-GPIO.setwarnings(False)
-
-x_axis = Axis(axis_name='X axis', direction_pin=31, step_pin=29, kill_switch_i_pin=10,
-              kill_switch_f_pin=11, direction='left', step_resolution=0.05, axis_length=1500)
-
-y_axis = Axis(axis_name='Y axis', direction_pin=38, step_pin=40, kill_switch_i_pin=24,
-              kill_switch_f_pin=27, direction='down', step_resolution=0.05, axis_length=500)
-
-z_axis = Axis(axis_name='Z axis', direction_pin=8, step_pin=10, kill_switch_i_pin=23,
-              kill_switch_f_pin=26, direction='forward', step_resolution=0.05, axis_length=2000)
-
-master = Tk()
-bg_color = 'white'
-master.configure(bg=bg_color)
-# master.attributes("-fullscreen", True)
-s = ttk.Style()
-s.theme_names()
-('clam', 'alt', 'default', 'classic')
-s.theme_use('clam')
-
-
-current_position_value = (0, 0, 0)
-
-master.title('Gantry controller V1.0')
-master.resizable(width=True, height=True)
-entry_width = 10
-upper_text = 'Welcome to the gantry control panel.\n' \
-             'All the positions are in [mm] and the velocities are in [mm/sec].\n\n' \
-             "Go - Start motion to a specific point.\n" \
-             "Home - Move the gantry to the system's origin.\n" \
-             "Clear - Turns the current position into the system's origin.\n" \
-             "\nThe free motion buttons will move the system freely \n" \
-             "for a specified amount of steps in a specified velocity.\n" \
-             "\n\nExit - Exit the program.\n\n"
-
-Label(master, text=upper_text, anchor="n", justify=LEFT, bg=bg_color).grid(row=0, column=3, columnspan=3)
-
-img = Image.open('download.png')
-img = img.resize((170, 170))
-img = ImageTk.PhotoImage(img)
-panel = Label(master, image=img, anchor="e", justify=LEFT, bg=bg_color)
-panel.grid(row=0, column=0, columnspan=3)
-tab_text = "____________________________________________________________________________________________________\n " \
-           "Planned motion\n"
-Label(master, text=tab_text, anchor="n", justify=LEFT, bg=bg_color).grid(row=1, column=0, columnspan=5)
-
-##### Position labels & buttons #####
-Label(master, text="X position", bg=bg_color).grid(row=2, column=0)
-x_position = Entry(master, width=entry_width)
-x_position.grid(row=2, column=1, columnspan=1)
-x_position.insert(END, '0')
-
-Label(master, text="Y position", bg=bg_color).grid(row=3, column=0)
-y_position = Entry(master, width=entry_width)
-y_position.grid(row=3, column=1, columnspan=1)
-y_position.insert(END, '0')
-
-Label(master, text="Z position", bg=bg_color).grid(row=4, column=0)
-z_position = Entry(master, width=entry_width)
-z_position.grid(row=4, column=1, columnspan=1)
-z_position.insert(END, '0')
-
-##### Velocity labels & buttons #####
-Label(master, text="    X velocity", bg=bg_color).grid(row=2, column=2)
-x_velocity = Entry(master, width=entry_width)
-x_velocity.grid(row=2, column=3, columnspan=1)
-x_velocity.insert(END, '100')
-
-Label(master, text="    Y velocity", bg=bg_color).grid(row=3, column=2)
-y_velocity = Entry(master, width=entry_width)
-y_velocity.grid(row=3, column=3, columnspan=1)
-y_velocity.insert(END, '100')
-
-Label(master, text="    Z velocity", bg=bg_color).grid(row=4, column=2)
-z_velocity = Entry(master, width=entry_width)
-z_velocity.grid(row=4, column=3, columnspan=1)
-z_velocity.insert(END, '100')
-
-ttk.Button(master, text='Go', command=planned_movement).grid(row=2, column=4)
-ttk.Button(master, text='Home', command=homing_sequence).grid(row=3, column=4)
-ttk.Button(master, text='Clear', command=clear_position).grid(row=4, column=4)
-
-tab_text = "____________________________________________________________________________________________________\n " \
-           "Free motion (20 steps = 1 [mm])\n"
-Label(master, text=tab_text, anchor="n", justify=LEFT, bg=bg_color).grid(row=6, column=0, columnspan=5)
-Label(master, text="Free motion buttons:", anchor="n", justify=LEFT, bg=bg_color).grid(row=7, column=0, columnspan=3)
-Label(master, text="Free motion velocity:", anchor="n", justify=LEFT, bg=bg_color).grid(row=7, column=3, columnspan=1)
-Label(master, text="Free motion steps amount:", anchor="n", justify=LEFT, bg=bg_color).grid(row=7, column=4,
-                                                                                            columnspan=1)
-
-free_motion_velocity_entry = Entry(master, width=entry_width)
-free_motion_velocity_entry.insert(END, '500')
-free_motion_velocity_entry.grid(row=8, column=3, columnspan=1)
-
-free_motion_steps_entry = Entry(master, width=entry_width)
-free_motion_steps_entry.insert(END, '100')
-free_motion_steps_entry.grid(row=8, column=4, columnspan=1)
-
-left = ttk.Button(master, text='Left', command=free_move_left)
-left.grid(row=8, column=0)
-
-right = ttk.Button(master, text='Right', command=free_move_right)
-right.grid(row=9, column=0)
-up = ttk.Button(master, text='Up', command=free_move_up)
-up.grid(row=8, column=1)
-
-down = ttk.Button(master, text='Down', command=free_move_down)
-down.grid(row=9, column=1)
-
-forward = ttk.Button(master, text='Forward', command=free_move_forward)
-forward.grid(row=8, column=2)
-
-backward = ttk.Button(master, text='Backward', command=free_move_backward)
-backward.grid(row=9, column=2)
-
-tab_text = "____________________________________________________________________________________________________\n"
-Label(master, text=tab_text, anchor="n", justify=LEFT, bg=bg_color).grid(row=10, column=0, columnspan=5)
-exit_button = ttk.Button(master, text='Exit', command=exit_program)
-exit_button.grid(row=11, column=4, columnspan=1)
-
-Label(master, text="Current position: ", anchor="n", justify=LEFT, bg=bg_color).grid(row=11, column=0, columnspan=2)
-current_position_entry = Entry(master, width=20)
-current_position_entry.insert(END, str(current_position_value))
-current_position_entry.grid(row=11, column=1, columnspan=3)
-Label(master, text="[mm]", anchor="n", justify=LEFT, bg=bg_color).grid(row=11, column=3, columnspan=1)
-
-Label(master, text=tab_text, anchor="n", justify=LEFT, bg=bg_color).grid(row=12, column=0, columnspan=5)
-mainloop()
+if __name__ == "__main__":
+    # The axes come from the machine config (machine.json), the step pulses backend is picked by the
+    # GANTRY_STEP_DRIVER environment variable, then by the config, see machine.py
+    from PIL import ImageTk, Image
+
+    driver = get_driver(driver_name())
+    (x_axis, y_axis, z_axis), homing = build_machine(driver)  # homes as set in the config
+    start_metrics()  # see the metrics of machine.json
+
+    motion_queue = MoveQueue([x_axis, y_axis, z_axis], driver)
+    jog = Jog([x_axis, y_axis, z_axis], driver)
+    pending_key_releases = {}  # key: its delayed release, see jog_key_released()
+
+    master = Tk()
+    bg_color = 'white'
+    master.configure(bg=bg_color)
+    # master.attributes("-fullscreen", True)
+    s = ttk.Style()
+    s.theme_names()
+    ('clam', 'alt', 'default', 'classic')
+    s.theme_use('clam')
+
+
+    current_position_value = (0, 0, 0)
+
+    master.title('Gantry controller V1.0')
+    master.resizable(width=True, height=True)
+    entry_width = 10
+    upper_text = 'Welcome to the gantry control panel.\n' \
+                 'All the positions are in [mm] and the velocities are in [mm/sec].\n\n' \
+                 "Go - Start motion to a specific point.\n" \
+                 "Home - Move the gantry to the system's origin.\n" \
+                 "Clear - Turns the current position into the system's origin.\n" \
+                 "Stop - Stops the current motion.\n" \
+                 "\nThe free motion buttons will move the system freely \n" \
+                 "for a specified amount of steps in a specified velocity.\n" \
+                 "With Hold to jog they (and the arrow / Page Up / Page Down keys)\n" \
+                 "run an axis while held, Enter in the velocity box changes its speed.\n" \
+                 "\n\nExit - Exit the program.\n\n"
+
+    Label(master, text=upper_text, anchor="n", justify=LEFT, bg=bg_color).grid(row=0, column=3, columnspan=3)
+
+    img = Image.open('download.png')
+    img = img.resize((170, 170))
+    img = ImageTk.PhotoImage(img)
+    panel = Label(master, image=img, anchor="e", justify=LEFT, bg=bg_color)
+    panel.grid(row=0, column=0, columnspan=3)
+    tab_text = "____________________________________________________________________________________________________\n " \
+               "Planned motion\n"
+    Label(master, text=tab_text, anchor="n", justify=LEFT, bg=bg_color).grid(row=1, column=0, columnspan=5)
+
+    ##### Position labels & buttons #####
+    Label(master, text="X position", bg=bg_color).grid(row=2, column=0)
+    x_position = Entry(master, width=entry_width)
+    x_position.grid(row=2, column=1, columnspan=1)
+    x_position.insert(END, '0')
+
+    Label(master, text="Y position", bg=bg_color).grid(row=3, column=0)
+    y_position = Entry(master, width=entry_width)
+    y_position.grid(row=3, column=1, columnspan=1)
+    y_position.insert(END, '0')
+
+    Label(master, text="Z position", bg=bg_color).grid(row=4, column=0)
+    z_position = Entry(master, width=entry_width)
+    z_position.grid(row=4, column=1, columnspan=1)
+    z_position.insert(END, '0')
+
+    ##### Velocity labels & buttons #####
+    Label(master, text="    X velocity", bg=bg_color).grid(row=2, column=2)
+    x_velocity = Entry(master, width=entry_width)
+    x_velocity.grid(row=2, column=3, columnspan=1)
+    x_velocity.insert(END, '100')
+
+    Label(master, text="    Y velocity", bg=bg_color).grid(row=3, column=2)
+    y_velocity = Entry(master, width=entry_width)
+    y_velocity.grid(row=3, column=3, columnspan=1)
+    y_velocity.insert(END, '100')
+
+    Label(master, text="    Z velocity", bg=bg_color).grid(row=4, column=2)
+    z_velocity = Entry(master, width=entry_width)
+    z_velocity.grid(row=4, column=3, columnspan=1)
+    z_velocity.insert(END, '100')
+
+    ttk.Button(master, text='Go', command=planned_movement).grid(row=2, column=4)
+    ttk.Button(master, text='Home', command=start_homing_sequence).grid(row=3, column=4)
+    ttk.Button(master, text='Clear', command=start_clear_position).grid(row=4, column=4)
+    ttk.Button(master, text='Stop', command=stop_motion).grid(row=5, column=4)
+
+    tab_text = "____________________________________________________________________________________________________\n " \
+               "Free motion (20 steps = 1 [mm])\n"
+    Label(master, text=tab_text, anchor="n", justify=LEFT, bg=bg_color).grid(row=6, column=0, columnspan=5)
+    Label(master, text="Free motion buttons:", anchor="n", justify=LEFT, bg=bg_color).grid(row=7, column=0, columnspan=3)
+    Label(master, text="Free motion velocity:", anchor="n", justify=LEFT, bg=bg_color).grid(row=7, column=3, columnspan=1)
+    Label(master, text="Free motion steps amount:", anchor="n", justify=LEFT, bg=bg_color).grid(row=7, column=4,
+                                                                                                columnspan=1)
+
+    free_motion_velocity_entry = Entry(master, width=entry_width)
+    free_motion_velocity_entry.insert(END, '500')
+    free_motion_velocity_entry.grid(row=8, column=3, columnspan=1)
+    free_motion_velocity_entry.bind('<Return>', stream_jog_velocity)
+
+    jog_mode = BooleanVar(master, value=False)
+    Checkbutton(master, text='Hold to jog', variable=jog_mode, bg=bg_color).grid(row=9, column=3, columnspan=1)
+
+    free_motion_steps_entry = Entry(master, width=entry_width)
+    free_motion_steps_entry.insert(END, '100')
+    free_motion_steps_entry.grid(row=8, column=4, columnspan=1)
+
+    left = ttk.Button(master, text='Left', command=free_move_left)
+    left.grid(row=8, column=0)
+
+    right = ttk.Button(master, text='Right', command=free_move_right)
+    right.grid(row=9, column=0)
+    up = ttk.Button(master, text='Up', command=free_move_up)
+    up.grid(row=8, column=1)
+
+    down = ttk.Button(master, text='Down', command=free_move_down)
+    down.grid(row=9, column=1)
+
+    forward = ttk.Button(master, text='Forward', command=free_move_forward)
+    forward.grid(row=8, column=2)
+
+    backward = ttk.Button(master, text='Backward', command=free_move_backward)
+    backward.grid(row=9, column=2)
+
+    for button, axis_name, direction in ((left, 'x', 'left'), (right, 'x', 'right'), (up, 'y', 'up'),
+                                         (down, 'y', 'down'), (forward, 'z', 'forward'),
+                                         (backward, 'z', 'backward')):
+        button.bind('<ButtonPress-1>', jog_button_pressed(axis_name, direction))
+        button.bind('<ButtonRelease-1>', jog_button_released(axis_name))
+    master.bind('<KeyPress>', jog_key_pressed)
+    master.bind('<KeyRelease>', jog_key_released)
+
+    tab_text = "____________________________________________________________________________________________________\n"
+    Label(master, text=tab_text, anchor="n", justify=LEFT, bg=bg_color).grid(row=10, column=0, columnspan=5)
+    exit_button = ttk.Button(master, text='Exit', command=exit_program)
+    exit_button.grid(row=11, column=4, columnspan=1)
+
+    Label(master, text="Current position: ", anchor="n", justify=LEFT, bg=bg_color).grid(row=11, column=0, columnspan=2)
+    current_position_entry = Entry(master, width=20)
+    current_position_entry.insert(END, str(current_position_value))
+    current_position_entry.grid(row=11, column=1, columnspan=3)
+    Label(master, text="[mm]", anchor="n", justify=LEFT, bg=bg_color).grid(row=11, column=3, columnspan=1)
+
+    Label(master, text="Current velocity: ", anchor="n", justify=LEFT, bg=bg_color).grid(row=12, column=0, columnspan=2)
+    current_velocity_entry = Entry(master, width=20)
+    current_velocity_entry.insert(END, str(current_position_value))
+    current_velocity_entry.grid(row=12, column=1, columnspan=3)
+    Label(master, text="[mm/sec]", anchor="n", justify=LEFT, bg=bg_color).grid(row=12, column=3, columnspan=1)
+
+    Label(master, text=tab_text, anchor="n", justify=LEFT, bg=bg_color).grid(row=13, column=0, columnspan=5)
+    master.after(POLL_INTERVAL, poll_motion_state)
+    mainloop()
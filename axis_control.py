@@ -1,16 +1,29 @@
-import RPi.GPIO as GPIO
-import time
-from gpiozero import Button as KillSwitch
+from flight_recorder import EVENT_STEP, EVENT_STOP, EVENT_SWITCH, FLAG_STOP, FLAG_SWITCH_F, FLAG_SWITCH_I
+from metrics import get_metrics
+from step_drivers import get_driver
+from step_timing import StepSchedule, constant_velocity_intervals
+
+# The direction names of the machine config, 1 steps towards axis_length and 0 towards the switch at 0
+DIRECTIONS = {'up': 1, 'down': 0, 'left': 1, 'right': 0, 'forward': 1, 'backward': 0}
 
 
 class Axis:
     def __init__(self, axis_name, direction_pin, step_pin, kill_switch_i_pin, kill_switch_f_pin,
-                 direction, step_resolution, axis_length):
-        self.directions = {'up': 1, 'down': 0, 'left': 1, 'right': 0, 'forward': 1, 'backward': 0}
+                 direction, step_resolution, axis_length, motion_profile=None, driver=None,
+                 kill_switch_class=None, soft_limits=None):
+        self.directions = DIRECTIONS
         self.velocity = 0
-        self.current_position = 0
+        self.step_position = 0  # [steps], the position in mm is derived from it, see current_position
         self.step_counter = 0
+        self.telemetry = None  # a telemetry.TelemetryChannel the steps are recorded to
+        self.telemetry_axis = 0
+        self.position_watcher = None  # called after every step, e.g. by a capture.CapturePipeline
+        self.flight_recorder = None  # a flight_recorder.FlightRecorder the steps and kill switch events go to
+        self.flight_recorder_axis = 0
         self.stop = 0  # a condition triggered by one of the kill switches
+        self.stop_edge_time = None  # when the kill switch that stopped the axis was pressed
+        self.stop_latency = None  # [sec], from the kill switch edge to the end of the last step pulse
+        self.done_running = False  # a boolean flag for the main process, True when the movement is done
 
         self.axis_name = axis_name
         self.direction_pin = direction_pin
@@ -18,21 +31,46 @@ class Axis:
         self.step_resolution = step_resolution
         self.direction = self.directions[direction]
         self.axis_length = axis_length
+        self.soft_limits = soft_limits  # (min, max) [mm], the moves are clipped to them when they are planned
+        self.motion_profile = motion_profile  # ramps the moves when set, see motion_profiles.py
+        self.driver = get_driver() if driver is None else driver  # the step pulses backend, see step_drivers.py
+        self.gpio = self.driver.gpio
+        if kill_switch_class is None:
+            kill_switch_class = self.driver.kill_switch_class
 
         self.kill_switch_i_pin = kill_switch_i_pin  # switch at 0
         self.kill_switch_f_pin = kill_switch_f_pin  # switch at axis_length
-        self.kill_switch_i = KillSwitch(kill_switch_i_pin)  # switch at 0
-        self.kill_switch_f = KillSwitch(kill_switch_f_pin)  # switch at axis_length
+        self.kill_switch_i = kill_switch_class(kill_switch_i_pin)  # switch at 0
+        self.kill_switch_f = kill_switch_class(kill_switch_f_pin)  # switch at axis_length
         self.kill_switch_i_state = self.kill_switch_i.is_pressed  # switch at 0
         self.kill_switch_f_state = self.kill_switch_f.is_pressed  # switch at axis_length
 
+        # The kill switches are edge driven, the step loops only read self.stop
+        self.kill_switch_i.when_pressed = self.kill_switch_i_pressed
+        self.kill_switch_i.when_released = self.kill_switch_i_released
+        self.kill_switch_f.when_pressed = self.kill_switch_f_pressed
+        self.kill_switch_f.when_released = self.kill_switch_f_released
+
+        self.step_timer = self.driver.step_timer(step_pin)
+        self.last_step_report = None  # achieved versus commanded step rate of the last scheduled move
+
         self.check_axis_kill_switches()
         self.axis_setup()
+        self.driver.attach_axis(self)
+
+    @property
+    def current_position(self):
+        # The position [mm], derived on demand from the integer step count so it never drifts
+        return round(self.step_position * self.step_resolution, 6)
+
+    @current_position.setter
+    def current_position(self, position):
+        self.step_position = round(position / self.step_resolution)
 
     def axis_setup(self):
         # This function sets up the motor's pins for initial use
-        GPIO.setup(self.direction_pin, GPIO.OUT)
-        GPIO.setup(self.step_pin, GPIO.OUT)
+        self.gpio.setup(self.direction_pin, self.gpio.OUT)
+        self.gpio.setup(self.step_pin, self.gpio.OUT)
 
     def check_axis_kill_switches(self):
         # This function reads the off switch status and updates it's state in the object
@@ -40,49 +78,143 @@ class Axis:
         self.kill_switch_f_state = self.kill_switch_f.is_pressed
 
         if (self.kill_switch_i_state and not self.direction) or (self.kill_switch_f_state and self.direction):
+            self.stop_edge_time = self.step_timer.clock()
             self.stop = 1
 
         else:
             self.stop = 0
 
+    def kill_switch_i_pressed(self):
+        # This function is called by gpiozero on the switch at 0 edge, it stops an axis moving towards it
+        self.kill_switch_i_state = True
+        if not self.direction:
+            self.stop_edge_time = self.step_timer.clock()
+            self.stop = 1
+        if self.flight_recorder is not None:
+            self.record_flight(EVENT_SWITCH, self.velocity)
+
+    def kill_switch_f_pressed(self):
+        # This function is called by gpiozero on the switch at axis_length edge, it stops an axis moving towards it
+        self.kill_switch_f_state = True
+        if self.direction:
+            self.stop_edge_time = self.step_timer.clock()
+            self.stop = 1
+        if self.flight_recorder is not None:
+            self.record_flight(EVENT_SWITCH, self.velocity)
+
+    def kill_switch_i_released(self):
+        self.kill_switch_i_state = False
+        if self.flight_recorder is not None:
+            self.record_flight(EVENT_SWITCH, self.velocity)
+
+    def kill_switch_f_released(self):
+        self.kill_switch_f_state = False
+        if self.flight_recorder is not None:
+            self.record_flight(EVENT_SWITCH, self.velocity)
+
+    def arm_kill_switches(self, direction):
+        # This function reads the kill switches once before a move, during the move only the edges set self.stop
+        self.direction = direction
+        self.stop_edge_time = None
+        self.stop_latency = None
+        self.check_axis_kill_switches()
+
+    def stopped_by_kill_switch(self):
+        # This function is called by a step loop that sees self.stop, it records the edge to last pulse latency
+        if self.stop_edge_time is not None and self.stop_latency is None:
+            self.stop_latency = self.step_timer.clock() - self.stop_edge_time
+            get_metrics().record_kill_switch(self.axis_name, self.stop_latency)
+            if self.flight_recorder is not None:
+                self.record_flight(EVENT_STOP, self.velocity)
+        return True
+
     def motor_single_step(self, velocity):
         # This function makes the motor moves a single step in a defined time interval
-        GPIO.output(self.step_pin, GPIO.HIGH)
-        time.sleep(0.5 * (1 / velocity))
-        GPIO.output(self.step_pin, GPIO.LOW)
-        time.sleep(0.5 * (1 / velocity))
+        self.step_timer.pulse(1 / velocity)
+
+    def attach_telemetry(self, channel, axis_index):
+        # This function makes every step write a (timestamp, axis, step, position) record, see telemetry.py
+        self.telemetry = channel
+        self.telemetry_axis = axis_index
+
+    def attach_flight_recorder(self, recorder, axis_index):
+        # This function makes every step and kill switch event write a record, see flight_recorder.py
+        self.flight_recorder = recorder
+        self.flight_recorder_axis = axis_index
+
+    def record_flight(self, kind, velocity):
+        flags = ((FLAG_SWITCH_I if self.kill_switch_i_state else 0) |
+                 (FLAG_SWITCH_F if self.kill_switch_f_state else 0) |
+                 (FLAG_STOP if self.stop else 0))
+        self.flight_recorder.record(self.flight_recorder_axis, kind, self.step_counter, self.step_position,
+                                    self.direction, flags, velocity)
+
+    def attach_position_watcher(self, callback):
+        # This function makes every step call back, so a position can trigger something mid move
+        self.position_watcher = callback
 
     def update_axis_status(self, velocity, direction):
         # This function updates the motor's dynamic values
         self.step_counter += 1
         self.velocity = velocity
         self.direction = direction
+        self.step_position += 1 if direction == 1 else -1
 
-        if self.direction == 1:
-            self.current_position += self.step_resolution
-        else:
-            self.current_position -= self.step_resolution
+        if self.telemetry is not None:
+            self.telemetry.record(self.telemetry_axis, self.step_counter, self.current_position)
+        if self.flight_recorder is not None:
+            self.record_flight(EVENT_STEP, velocity)
+        if self.position_watcher is not None:
+            self.position_watcher()
 
-        self.current_position = round(self.current_position, 3)
+    def clip_steps(self, direction, step_amount, step_position=None):
+        # This function clips a move to the soft limits, once when it is planned instead of on every step.
+        # step_position is where the move starts [steps], the current position when None.
+        if self.soft_limits is None:
+            return step_amount
+        if step_position is None:
+            step_position = self.step_position
+        low, high = (round(limit / self.step_resolution) for limit in self.soft_limits)
+        if direction == 1:
+            return max(0, min(step_amount, high - step_position))
+        return max(0, min(step_amount, step_position - low))
 
     def axis_while_loop(self, velocity, direction, next_position):
-        # Main motor function, moves the motor and updates it's dynamic values
-        GPIO.output(self.direction_pin, direction)
-        while not self.stop and velocity != 0 and self.current_position != next_position:
-            self.motor_single_step(velocity)
-            self.update_axis_status(velocity, direction)
-            self.check_axis_kill_switches()
+        # Main motor function, moves the motor to next_position [mm] and updates it's dynamic values.
+        # The target is turned into a step count up front, so the loop can't step past it.
+        step_delta = round(next_position / self.step_resolution) - self.step_position
+        step_amount = abs(step_delta) if (step_delta > 0) == (direction == 1) else 0
+        self.axis_for_loop(velocity, direction, step_amount)
 
     def axis_for_loop(self, velocity, direction, step_amount):
         # Main motor function, moves the motor and updates it's dynamic values
-        GPIO.output(self.direction_pin, direction)
-        for _step in range(step_amount):
-            if not self.stop and velocity != 0:
-                self.motor_single_step(velocity)
-                self.update_axis_status(velocity, direction)
-                self.check_axis_kill_switches()
-            else:
-                break
+        self.gpio.output(self.direction_pin, direction)
+        self.arm_kill_switches(direction)
+        step_amount = self.clip_steps(direction, step_amount)
+        if not self.stop and velocity != 0 and step_amount > 0:
+            self.run_step_schedule(self.step_schedule(step_amount, velocity), velocity, direction)
+        self.done_running = True
+
+    def reset_axis_run(self):
+        self.done_running = False
+
+    def step_schedule(self, step_amount, velocity):
+        # This function plans a move, ramped up to velocity when the axis has a motion profile
+        if self.motion_profile is None:
+            return StepSchedule(constant_velocity_intervals(step_amount, velocity))
+        return self.motion_profile.step_schedule(step_amount, velocity)
+
+    def run_step_schedule(self, schedule, velocity, direction, source='axis'):
+        # This function emits a precomputed step schedule, it stops as soon as a kill switch edge sets self.stop.
+        # source labels the move in the metrics, see metrics.py
+        def on_step():
+            self.update_axis_status(velocity, direction)
+            return self.stop and self.stopped_by_kill_switch()
+
+        report = self.last_step_report = self.step_timer.run(schedule, on_step)
+        get_metrics().record_move(source, report, ((self.axis_name, report['steps']),),
+                                  report['steps'] < len(schedule))
+        return report
 
     def get_values(self):
         # This function returns all the motor's attributes
@@ -97,27 +229,51 @@ class Axis:
                 'direction': self.direction,
                 'velocity': self.velocity,
                 'current_position': self.current_position,
+                'step_position': self.step_position,
+                'soft_limits': self.soft_limits,
                 'i_off_switch': self.kill_switch_i_state,
                 'f_off_switch': self.kill_switch_f_state,
+                'stop_latency': self.stop_latency,
+                'motion_profile': None if self.motion_profile is None else self.motion_profile.get_values(),
                 'done_running': self.done_running}
 
     def go_to_home_position(self, home_position):
         direction = self.direction
         velocity = 1000
         # Main motor function, moves the motor and updates it's dynamic values
-        GPIO.output(self.direction_pin, direction)
+        self.gpio.output(self.direction_pin, direction)
+        self.arm_kill_switches(direction)
 
         print(f'{self.axis_name}: going to position 0.')
         while not self.stop:
             self.motor_single_step(velocity)
             self.update_axis_status(velocity, direction)
-            self.check_axis_kill_switches()
+        if self.stop_edge_time is None:
+            print(f'{self.axis_name}: homing stopped.')
+            return
+        self.stopped_by_kill_switch()
 
-        self.current_position = 0
+        self.step_position = 0
+        if self.soft_limits is None:
+            self.soft_limits = (0, self.axis_length)  # the axis is referenced now
         print(f'{self.axis_name}: going to home position.')
         direction = not self.direction
-        GPIO.output(self.direction_pin, direction)
-        for _ in range(int(home_position / self.step_resolution)):
+        self.gpio.output(self.direction_pin, direction)
+        self.arm_kill_switches(direction)
+        for _ in range(round(home_position / self.step_resolution)):
             self.motor_single_step(velocity)
             self.update_axis_status(velocity, direction)
-            self.check_axis_kill_switches()
+
+
+if __name__ == "__main__":
+    # Drift check: a million steps out and back on the simulated driver must land exactly where they started
+    steps = 1000000
+    axis = Axis(axis_name='X axis', direction_pin=31, step_pin=29, kill_switch_i_pin=10, kill_switch_f_pin=11,
+                direction='left', step_resolution=0.05, axis_length=1500, driver=get_driver('simulated'))
+    for direction in (1, 0):
+        for _ in range(steps):
+            axis.update_axis_status(1000, direction)
+        print(f'{steps} steps in direction {direction}: step_position={axis.step_position}, '
+              f'current_position={axis.current_position} [mm]')
+    assert axis.step_position == 0 and axis.current_position == 0, 'the position drifted'
+    print('No drift.')
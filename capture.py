@@ -0,0 +1,300 @@
+import collections
+import itertools
+import struct
+import threading
+import time
+from array import array
+from coordinated_motion import feed_rate_for_velocities
+
+DEFAULT_CAPACITY = 64  # frames held in memory
+DEFAULT_BULK = 16  # frames the writer gathers before it writes
+WRITER_TIMEOUT = 0.1  # [sec], the writer flushes a partial bulk after this long
+TRIGGER_TOLERANCE = 1  # [steps], how close on every axis the path must pass a trigger position to fire it
+
+# The frames file: a header, then per frame a record header (frame number, trigger timestamp, trigger index
+# and the step position of every axis) followed by the frame's bytes
+FRAMES_MAGIC = b'GFR1'
+FRAMES_HEADER_FORMAT = '<4sBxxxQ'  # magic, axes amount, frame size [bytes]
+
+
+def frame_record_format(axes_amount):
+    return f'<Qdq{axes_amount}q'
+
+
+class OpenCVCamera:
+    def __init__(self, device=0):
+        # A cv2.VideoCapture frame source, the frames are copied into the ring buffer slots
+        import cv2
+
+        self.capture = cv2.VideoCapture(device)
+        ok, frame = self.capture.read()
+        if not ok:
+            raise RuntimeError(f'Could not read a frame from camera {device}.')
+        self.frame_size = frame.nbytes
+
+    def grab_into(self, buffer):
+        ok, frame = self.capture.read()
+        if not ok:
+            raise RuntimeError('The camera stopped sending frames.')
+        buffer[:] = memoryview(frame).cast('B')
+
+
+class FrameRing:
+    def __init__(self, capacity, frame_size, axes_amount):
+        # Preallocated frame slots with their (timestamp, trigger index, step positions) tags.
+        # One capture thread fills them, one writer thread empties them, a full ring drops the new frames.
+        self.capacity = capacity
+        self.frame_size = frame_size
+        self.axes_amount = axes_amount
+        self.slots = [bytearray(frame_size) for _ in range(capacity)]
+        self.views = [memoryview(slot) for slot in self.slots]
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.triggers = array('q', bytes(8 * capacity))
+        self.steps = array('q', bytes(8 * capacity * axes_amount))
+        self.head = 0  # frames put so far
+        self.tail = 0  # frames taken so far
+        self.dropped = 0
+
+    def free_slot(self):
+        # This function returns the index of the slot the next frame goes to, None when the ring is full
+        if self.head - self.tail >= self.capacity:
+            return None
+        return self.head % self.capacity
+
+    def put(self, index, timestamp, trigger, steps):
+        self.timestamps[index] = timestamp
+        self.triggers[index] = trigger
+        self.steps[index * self.axes_amount:(index + 1) * self.axes_amount] = array('q', steps)
+        self.head += 1
+
+    def __len__(self):
+        return self.head - self.tail
+
+
+class CapturePipeline:
+    def __init__(self, axes, camera, output_path, capacity=DEFAULT_CAPACITY, bulk=DEFAULT_BULK,
+                 clock=time.perf_counter):
+        # Grabs camera frames when the axes reach trigger positions. The step loop only queues the trigger
+        # (a timestamp and the exact step positions), a capture thread grabs the frame into a preallocated
+        # ring and a writer thread appends the frames to output_path in bulk.
+        # camera has a frame_size and a grab_into(buffer) method, see fake_gpio.SimulatedCamera.
+        self.axes = axes
+        self.camera = camera
+        self.output_path = output_path
+        self.bulk = bulk
+        self.clock = clock
+        self.ring = FrameRing(capacity, camera.frame_size, len(axes))
+        self.targets = {}  # step position: trigger index, the triggers not reached yet
+        self.near = [set() for _ in axes]  # per axis, the step positions within the tolerance of a target
+        self.offsets = [(0,) * len(axes)]  # the step offsets around a position that a target may be at
+        self.requests = collections.deque()
+        self.request_event = threading.Event()
+        self.frame_event = threading.Event()
+        self.running = False
+        self.capture_thread = None
+        self.writer_thread = None
+
+        self.triggered = 0
+        self.missed = 0  # triggers that came while the capture thread was still that many frames behind
+        self.captured = 0
+        self.written = 0
+        self.first_capture = None
+        self.last_capture = None
+        self.write_time = 0.0
+
+    def set_triggers(self, positions, tolerance=TRIGGER_TOLERANCE):
+        # This function arms the trigger positions [mm] (one value per axis), each one fires once. A trigger
+        # fires when the path passes within tolerance steps of it on every axis, so a coordinated move that
+        # steps around it (a diagonal, an off lattice position) or ends a step past it still takes the frame.
+        self.targets = {tuple(round(value / axis.step_resolution) for value, axis in zip(position, self.axes)): index
+                        for index, position in enumerate(positions)}
+        self.near = [{target[axis_index] + offset for target in self.targets
+                      for offset in range(-tolerance, tolerance + 1)} for axis_index in range(len(self.axes))]
+        self.offsets = list(itertools.product(range(-tolerance, tolerance + 1), repeat=len(self.axes)))
+
+    def start(self):
+        self.running = True
+        for axis in self.axes:
+            axis.attach_position_watcher(self.check_position)
+        self.capture_thread = threading.Thread(target=self.capture_loop, daemon=True)
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.capture_thread.start()
+        self.writer_thread.start()
+
+    def check_position(self):
+        # This function is called from the step loop after every step, it only queues the triggers passed
+        if not self.targets:
+            return
+        steps = tuple(axis.step_position for axis in self.axes)
+        # Most steps are away from every target on some axis, the neighbourhood is only searched near one
+        for value, near in zip(steps, self.near):
+            if value not in near:
+                return
+        for offset in self.offsets:
+            trigger = self.targets.pop(tuple(value + delta for value, delta in zip(steps, offset)), None)
+            if trigger is not None:
+                self.trigger(trigger, steps)
+
+    def trigger(self, trigger=-1, steps=None):
+        # This function requests a frame, tagged with the step positions (the current ones when None)
+        if steps is None:
+            steps = tuple(axis.step_position for axis in self.axes)
+        self.triggered += 1
+        if len(self.requests) >= self.ring.capacity:
+            self.missed += 1
+            return
+        self.requests.append((self.clock(), trigger, steps))
+        self.request_event.set()
+
+    def capture_loop(self):
+        ring = self.ring
+        while self.running or self.requests:
+            if not self.requests:
+                self.request_event.wait(WRITER_TIMEOUT)
+                self.request_event.clear()
+                continue
+            timestamp, trigger, steps = self.requests.popleft()
+            index = ring.free_slot()
+            if index is None:
+                ring.dropped += 1
+                continue
+            self.camera.grab_into(ring.views[index])
+            ring.put(index, timestamp, trigger, steps)
+            self.captured += 1
+            self.last_capture = self.clock()
+            if self.first_capture is None:
+                self.first_capture = self.last_capture
+            self.frame_event.set()
+
+    def writer_loop(self):
+        ring = self.ring
+        record = struct.Struct(frame_record_format(ring.axes_amount))
+        with open(self.output_path, 'wb') as frames_file:
+            frames_file.write(struct.pack(FRAMES_HEADER_FORMAT, FRAMES_MAGIC, ring.axes_amount, ring.frame_size))
+            while True:
+                # A bulk is written once it is full, or when no frame came for WRITER_TIMEOUT
+                done = not self.capture_thread.is_alive()
+                if len(ring) < self.bulk and not done and self.frame_event.wait(WRITER_TIMEOUT):
+                    self.frame_event.clear()
+                    continue
+                amount = len(ring)
+                if amount == 0:
+                    if done:
+                        break
+                    continue
+
+                start = self.clock()
+                chunks = []
+                for frame in range(ring.tail, ring.tail + amount):
+                    index = frame % ring.capacity
+                    steps = ring.steps[index * ring.axes_amount:(index + 1) * ring.axes_amount]
+                    chunks.append(record.pack(self.written + len(chunks) // 2, ring.timestamps[index],
+                                              ring.triggers[index], *steps))
+                    chunks.append(ring.views[index])
+                frames_file.writelines(chunks)
+                frames_file.flush()
+                ring.tail += amount
+                self.written += amount
+                self.write_time += self.clock() - start
+
+    def scan(self, coordinated_motion, positions, feed_rate=None, velocities=None, stop_and_shoot=True):
+        # This function makes a coordinated move to every position [mm] in turn, feed_rate [mm/sec] or
+        # per axis velocities [steps/sec] set the speed. With stop_and_shoot a frame is taken at every position
+        # once the axes are at rest, otherwise only the trigger positions crossed on the way take frames.
+        self.check_position()  # the axes may start on a trigger position
+        for index, position in enumerate(positions):
+            legs = []
+            for value, axis in zip(position, self.axes):
+                step_delta = round(value / axis.step_resolution) - axis.step_position
+                legs.append((axis, 1 if step_delta > 0 else 0, abs(step_delta)))
+            if any(step_amount for _axis, _direction, step_amount in legs):
+                rate = feed_rate if velocities is None else feed_rate_for_velocities(legs, velocities)
+                coordinated_motion.move(legs, rate)
+                if any(axis.stop for axis in self.axes):
+                    return False
+            if stop_and_shoot:
+                self.trigger(index)
+        return True
+
+    def close(self):
+        # This function waits for the queued frames to be captured and written
+        self.running = False
+        self.request_event.set()
+        self.capture_thread.join()
+        self.frame_event.set()
+        self.writer_thread.join()
+        for axis in self.axes:
+            axis.attach_position_watcher(None)
+
+    def stats(self):
+        capture_time = (self.last_capture - self.first_capture) if self.captured > 1 else 0
+        return {'triggered': self.triggered,
+                'captured': self.captured,
+                'written': self.written,
+                'missed': self.missed,
+                'dropped': self.ring.dropped,
+                'pending_triggers': len(self.targets),
+                'frames_per_second': (self.captured - 1) / capture_time if capture_time else None,
+                'write_bytes_per_second': self.written * self.ring.frame_size / self.write_time
+                if self.write_time else None}
+
+
+def read_frames(path):
+    # This function yields the (frame number, timestamp, trigger index, step positions, frame bytes)
+    # of a frames file, one frame at a time
+    header_size = struct.calcsize(FRAMES_HEADER_FORMAT)
+    with open(path, 'rb') as frames_file:
+        magic, axes_amount, frame_size = struct.unpack(FRAMES_HEADER_FORMAT, frames_file.read(header_size))
+        if magic != FRAMES_MAGIC:
+            raise ValueError(f'{path} is not a frames file.')
+        record = struct.Struct(frame_record_format(axes_amount))
+        while True:
+            header = frames_file.read(record.size)
+            if len(header) < record.size:
+                break
+            number, timestamp, trigger, *steps = record.unpack(header)
+            yield number, timestamp, trigger, tuple(steps), frames_file.read(frame_size)
+
+
+if __name__ == "__main__":
+    # Demo: a serpentine grid scanned on the fly, then the same grid stop and shoot, on the simulated GPIO
+    # with a synthetic camera
+    import os
+    import tempfile
+    from axis_control import Axis
+    from coordinated_motion import CoordinatedMotion
+    from fake_gpio import SimulatedCamera
+    from motion_profiles import MotionProfile
+    from step_drivers import get_driver
+
+    driver = get_driver('simulated')
+    profile = MotionProfile(max_velocity=4000, acceleration=8000, start_velocity=200)
+    axes = [Axis(axis_name='X axis', direction_pin=31, step_pin=29, kill_switch_i_pin=10, kill_switch_f_pin=11,
+                 direction='right', step_resolution=0.05, axis_length=1500, motion_profile=profile, driver=driver),
+            Axis(axis_name='Y axis', direction_pin=38, step_pin=40, kill_switch_i_pin=24, kill_switch_f_pin=27,
+                 direction='down', step_resolution=0.05, axis_length=500, motion_profile=profile, driver=driver)]
+    coordinated_motion = CoordinatedMotion(driver)
+    rows, columns, pitch = 5, 10, 2.0  # [mm]
+    grid = [[(column * pitch, row * pitch) for column in range(columns)] for row in range(rows)]
+    serpentine = [point for row, points in enumerate(grid) for point in (points if row % 2 == 0 else points[::-1])]
+
+    for mode in ('on the fly', 'stop and shoot'):
+        for axis in axes:
+            axis.step_position = 0
+        output_path = os.path.join(tempfile.gettempdir(), 'capture_demo.frames')
+        pipeline = CapturePipeline(axes, SimulatedCamera(320, 240, exposure=0.002), output_path)
+        pipeline.start()
+        start = time.perf_counter()
+        if mode == 'on the fly':
+            # Every row is a single move, the frames are grabbed as the camera passes the points
+            pipeline.set_triggers(serpentine)
+            row_ends = [point for row, points in enumerate(grid)
+                        for point in ((points[0], points[-1]) if row % 2 == 0 else (points[-1], points[0]))]
+            pipeline.scan(coordinated_motion, row_ends, feed_rate=20, stop_and_shoot=False)
+        else:
+            pipeline.scan(coordinated_motion, serpentine, feed_rate=20)
+        scan_time = time.perf_counter() - start
+        pipeline.close()
+        frames = sum(1 for _frame in read_frames(output_path))
+        print(f'{mode}: {len(serpentine)} points scanned in {scan_time:.2f} [sec], {frames} frames on disk, '
+              f'{pipeline.stats()}')
@@ -0,0 +1,176 @@
+import itertools
+import json
+import queue
+import socket
+import threading
+from command_server import DEFAULT_PORT
+
+DEFAULT_TIMEOUT = None  # [sec], how long a call waits for its answer, forever when None
+CLOSED_ANSWER = {'ok': False, 'error': 'The connection was closed.', 'closed': True}
+
+
+class CommandError(RuntimeError):
+    pass
+
+
+class ConnectionClosed(CommandError):
+    # The server went away before it answered, the command may or may not have run
+    pass
+
+
+class GantryClient:
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT):
+        # A blocking client of command_server.py. A reader thread sorts the server's lines into the answers
+        # the calls wait for and the subscribed events, so several threads can share one connection.
+        self.socket = socket.create_connection((host, port))
+        self.file = self.socket.makefile('rb')
+        self.timeout = timeout
+        self.ids = itertools.count(1)
+        self.answers = {}  # id: queue the answer is put in
+        self.events = queue.Queue()
+        self.send_lock = threading.Lock()
+        self.closed = False  # set by the reader thread once the server's lines ended
+        self.reader = threading.Thread(target=self.read_lines, daemon=True)
+        self.reader.start()
+
+    def read_lines(self):
+        try:
+            for line in self.file:
+                message = json.loads(line)
+                if 'event' in message:
+                    self.events.put(message['event'])
+                else:
+                    answer = self.answers.pop(message['id'], None)
+                    if answer is not None:
+                        answer.put(message)
+        except OSError:
+            pass  # a reset connection ends like a closed one
+        with self.send_lock:
+            self.closed = True
+        for answer in list(self.answers.values()):
+            answer.put(CLOSED_ANSWER)
+        self.events.put(None)
+
+    def send(self, request):
+        # This function sends a request, returns the queue its answer will be put in
+        request['id'] = next(self.ids)
+        answer = queue.Queue(maxsize=1)
+        with self.send_lock:
+            if self.closed:
+                answer.put(CLOSED_ANSWER)
+                return answer
+            self.answers[request['id']] = answer
+            self.socket.sendall(json.dumps(request).encode() + b'\n')
+        return answer
+
+    def call(self, command, **arguments):
+        # This function runs a command on the server and returns its result, a failed command raises
+        message = self.send(dict(arguments, command=command)).get(timeout=self.timeout)
+        if message.get('closed'):
+            raise ConnectionClosed(message['error'])
+        if not message['ok']:
+            raise CommandError(message['error'])
+        return message['result']
+
+    def move_to(self, position, feed_rate=None):
+        # position is [mm] per axis, None keeps an axis where it is, feed_rate is along the path [mm/sec]
+        return self.call('move_to', position=list(position), feed_rate=feed_rate)
+
+    def jog(self, axis, distance, feed_rate=None):
+        return self.call('jog', axis=axis, distance=distance, feed_rate=feed_rate)
+
+    def home(self):
+        return self.call('home')
+
+    def job(self, gcode):
+        # This function runs a G-code job (its text) on the server, returns the job report
+        return self.call('job', gcode=gcode)
+
+    def batch(self, commands):
+        # This function runs many commands in one round trip, see move_command, jog_command and home_command.
+        # Returns their results, the batch stops at the first failing command.
+        return self.call('batch', commands=list(commands))
+
+    def move_batch(self, positions, feed_rate=None):
+        # This function moves through positions [mm] in one round trip, e.g. a dense scan
+        return self.batch(move_command(position, feed_rate) for position in positions)
+
+    def stop(self):
+        return self.call('stop')
+
+    def state(self):
+        return self.call('state')
+
+    def subscribe(self, interval=None):
+        # This function starts the position updates, read them with next_event()
+        arguments = {} if interval is None else {'interval': interval}
+        return self.call('subscribe', **arguments)
+
+    def unsubscribe(self):
+        return self.call('unsubscribe')
+
+    def next_event(self, timeout=None):
+        # This function returns the next position update, None once the connection is closed
+        return self.events.get(timeout=timeout)
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self.reader.join()
+
+
+def move_command(position, feed_rate=None):
+    return {'command': 'move_to', 'position': list(position), 'feed_rate': feed_rate}
+
+
+def jog_command(axis, distance, feed_rate=None):
+    return {'command': 'jog', 'axis': axis, 'distance': distance, 'feed_rate': feed_rate}
+
+
+def home_command():
+    return {'command': 'home'}
+
+
+if __name__ == "__main__":
+    # Demo against a running server (python command_server.py --driver simulated): a dense scan row sent one
+    # move per round trip, then as one batch, while a second client reads the state
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Drives a gantry command server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    arguments = parser.parse_args()
+
+    client = GantryClient(arguments.host, arguments.port)
+    status_client = GantryClient(arguments.host, arguments.port)
+    client.subscribe(0.2)
+    print(f'Homed in {client.home()["duration"]:.2f} [sec].')
+    row = [(10 + 0.5 * i, 10, None) for i in range(40)]
+
+    start = time.perf_counter()
+    for position in row:
+        client.move_to(position, feed_rate=50)
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = threading.Thread(target=client.move_batch, args=(row[::-1], 50))
+    batch.start()
+    states = 0
+    while batch.is_alive():
+        status_client.state()
+        states += 1
+    batch_time = time.perf_counter() - start
+
+    events = 0
+    while not client.events.empty():
+        client.next_event()
+        events += 1
+    print(f'{len(row)} moves one by one in {single_time:.2f} [sec], as a batch in {batch_time:.2f} [sec], '
+          f'{states} state reads during the batch, {events} position updates.')
+    print(f'At {status_client.state()["positions"]} [mm].')
+    client.close()
+    status_client.close()
@@ -0,0 +1,157 @@
+import asyncio
+import json
+from gantry_controller import EVENT_INTERVAL
+from metrics import get_metrics
+
+DEFAULT_HOST = '127.0.0.1'  # use --host 0.0.0.0 to serve the local network
+DEFAULT_PORT = 8765
+MAX_LINE = 1 << 24  # [bytes], a request line, big enough for a dense scan batch
+
+# The protocol is JSON lines over TCP, one request per line: {"id": 1, "command": "move_to", ...}.
+# Every request gets one {"id": 1, "ok": true, "result": ...} or {"id": 1, "ok": false, "error": "..."} line,
+# a subscribed connection also gets {"event": {...}} lines. The requests of a connection run concurrently,
+# so a state request is answered while a move runs, and the answers may come out of order.
+MOTION_COMMANDS = ('move_to', 'jog', 'home', 'batch', 'job')
+
+
+class CommandServer:
+    def __init__(self, controller, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        # Serves a gantry_controller.GantryController. The motion commands of all the clients go to the
+        # controller's motion thread one after the other, the state and the events never wait for them.
+        self.controller = controller
+        self.host = host
+        self.port = port
+        self.server = None
+        self.clients = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve_client, self.host, self.port, limit=MAX_LINE)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def run_command(self, request):
+        # This function runs one command, returns its result
+        command = request.get('command')
+        controller = self.controller
+        get_metrics().record_command('tcp', str(command))
+        if command == 'move_to':
+            return await controller.move_to(request['position'], request.get('feed_rate'))
+        if command == 'jog':
+            return await controller.jog(request['axis'], request['distance'], request.get('feed_rate'))
+        if command == 'home':
+            return await controller.home()
+        if command == 'job':
+            return await controller.job(request['gcode'])
+        if command == 'batch':
+            # The commands of a batch run back to back, the batch stops at the first failing one
+            results = []
+            for sub_request in request['commands']:
+                if sub_request.get('command') not in MOTION_COMMANDS[:3]:
+                    raise ValueError(f'A batch holds {", ".join(MOTION_COMMANDS[:3])} commands.')
+                results.append(await self.run_command(sub_request))
+            return results
+        if command == 'stop':
+            return await controller.stop()
+        if command == 'state':
+            return controller.state()
+        raise ValueError(f'Unknown command {command}.')
+
+    async def serve_client(self, reader, writer):
+        self.clients += 1
+        tasks = set()
+        subscription = None
+        lock = asyncio.Lock()
+
+        async def send(message):
+            async with lock:
+                writer.write(json.dumps(message).encode() + b'\n')
+                await writer.drain()
+
+        async def answer(request):
+            try:
+                result = await self.run_command(request)
+                message = {'id': request.get('id'), 'ok': True, 'result': result}
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                message = {'id': request.get('id'), 'ok': False, 'error': f'{type(error).__name__}: {error}'}
+            await send(message)
+
+        async def stream_events(interval):
+            async for event in self.controller.events(interval):
+                await send({'event': event})
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as error:
+                    await send({'id': None, 'ok': False, 'error': f'Bad request: {error}'})
+                    continue
+                command = request.get('command')
+                if command == 'subscribe':
+                    if subscription is None:
+                        subscription = asyncio.create_task(stream_events(request.get('interval', EVENT_INTERVAL)))
+                    await send({'id': request.get('id'), 'ok': True, 'result': None})
+                elif command == 'unsubscribe':
+                    if subscription is not None:
+                        subscription.cancel()
+                        subscription = None
+                    await send({'id': request.get('id'), 'ok': True, 'result': None})
+                else:
+                    task = asyncio.create_task(answer(request))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            # The moves a client left running go on, only its event stream ends
+            if subscription is not None:
+                subscription.cancel()
+            if tasks:
+                await asyncio.wait(tasks)
+            self.clients -= 1
+            writer.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    from gantry_controller import GantryController
+    from machine import build_machine, driver_name, start_metrics
+    from step_drivers import get_driver
+
+    parser = argparse.ArgumentParser(description='Serves the gantry over TCP, JSON lines.')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='the interface to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--driver',
+                        help='the step driver, see step_drivers.py (GANTRY_STEP_DRIVER, then machine.json by default)')
+    arguments = parser.parse_args()
+
+    async def main():
+        driver = get_driver(arguments.driver or driver_name())
+        axes, homing = build_machine(driver)
+        start_metrics()
+        if driver.name == 'simulated':
+            # The simulated carriages start mid travel and press the switches at the travel ends
+            from fake_gpio import SimulatedCarriage
+
+            for axis in axes:
+                SimulatedCarriage(driver.gpio, axis, round(axis.axis_length / axis.step_resolution / 2))
+        controller = GantryController(axes, driver, homing)
+        server = CommandServer(controller, arguments.host, arguments.port)
+        await server.start()
+        print(f'Serving the gantry on {arguments.host}:{server.port}.')
+        try:
+            async with server.server:
+                await server.server.serve_forever()
+        finally:
+            controller.close()
+            driver.cleanup()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,167 @@
+import math
+import time
+from functools import lru_cache
+from metrics import get_metrics
+from motion_profiles import build_step_schedule
+from step_timing import StepSchedule, constant_velocity_intervals
+
+DDA_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=DDA_CACHE_SIZE)
+def dda_ticks(step_amounts):
+    # This function interpolates a straight line between the axes (Bresenham / DDA).
+    # The axis with the most steps is pulsed on every tick, returns the axes indexes stepped at each tick.
+    major_steps = max(step_amounts)
+    errors = [major_steps // 2] * len(step_amounts)
+    ticks = []
+    for _tick in range(major_steps):
+        stepping = []
+        for index, step_amount in enumerate(step_amounts):
+            errors[index] -= step_amount
+            if errors[index] < 0:
+                errors[index] += major_steps
+                stepping.append(index)
+        ticks.append(tuple(stepping))
+    return tuple(ticks)
+
+
+def path_length(legs):
+    # This function returns the length of a straight move [mm], legs are (axis, direction, step_amount)
+    return math.sqrt(sum((step_amount * axis.step_resolution) ** 2 for axis, _direction, step_amount in legs))
+
+
+def feed_rate_for_velocities(legs, velocities):
+    # This function returns the fastest feed rate [mm/sec] along the path that keeps every axis at or under
+    # its own step rate [steps/sec], given per leg
+    duration = max(step_amount / velocity for (_axis, _direction, step_amount), velocity in zip(legs, velocities)
+                   if step_amount > 0)
+    return path_length(legs) / duration
+
+
+def path_limits(step_amounts, profiles):
+    # This function returns the (max velocity, acceleration, jerk, start velocity) of a straight move in major
+    # axis steps (ticks), the most restrictive of its axes' motion profiles, None when no axis has one.
+    # An axis moves step_amount / major_steps of a step per tick, so its limits are scaled up by the inverse.
+    major_steps = max(step_amounts)
+    limits = [(profile, major_steps / step_amount) for step_amount, profile in zip(step_amounts, profiles)
+              if profile is not None]
+    if not limits:
+        return None
+    jerks = [profile.jerk * ratio for profile, ratio in limits if profile.jerk is not None]
+    return (min(profile.max_velocity * ratio for profile, ratio in limits),
+            min(profile.acceleration * ratio for profile, ratio in limits),
+            min(jerks) if jerks else None,
+            min(profile.start_velocity * ratio for profile, ratio in limits))
+
+
+class CoordinatedMotion:
+    def __init__(self, driver):
+        # Moves several axes along a straight line in a single timing loop, all the axes arrive together.
+        # driver is the step pulses backend of the axes, see step_drivers.py
+        self.gpio = driver.gpio
+        self.step_timer = driver.step_timer(None)
+        self.last_report = None
+        self.source = 'coordinated'  # labels the moves in the metrics, see metrics.py
+
+    def plan(self, legs, feed_rate, step_positions=None):
+        # This function turns a linear move into a ready to run PlannedMove, None when there is nothing to move.
+        # legs are (axis, direction, step_amount), feed_rate is along the path [mm/sec]. step_positions are the
+        # axes' positions [steps] the move starts from, their current ones when None, so a move can be planned
+        # while the one before it still runs.
+        legs = [leg for leg in legs if leg[2] > 0]
+        if not legs or feed_rate <= 0:
+            return None
+        planning_start = time.perf_counter()
+
+        # The soft limits are applied once, here. A move that would leave them is shortened along its path,
+        # so it keeps its direction.
+        if step_positions is None:
+            step_positions = [axis.step_position for axis, _direction, _step_amount in legs]
+        fraction = min(axis.clip_steps(direction, step_amount, step_position) / step_amount
+                       for (axis, direction, step_amount), step_position in zip(legs, step_positions))
+        if fraction < 1:
+            legs = [(axis, direction, int(step_amount * fraction)) for axis, direction, step_amount in legs]
+            legs = [leg for leg in legs if leg[2] > 0]
+            if not legs:
+                return None
+
+        step_amounts = tuple(step_amount for _axis, _direction, step_amount in legs)
+        duration = path_length(legs) / feed_rate
+        major_steps = max(step_amounts)
+        major_velocity = major_steps / duration
+
+        # The whole path follows one ramp in major axis steps, within the limits of every axis on it
+        limits = path_limits(step_amounts, [axis.motion_profile for axis, _direction, _step_amount in legs])
+        if limits is None:
+            schedule = StepSchedule(constant_velocity_intervals(major_steps, major_velocity))
+        else:
+            max_velocity, acceleration, jerk, start_velocity = limits
+            major_velocity = min(major_velocity, max_velocity)
+            schedule = build_step_schedule(major_steps, float(major_velocity), float(acceleration), jerk,
+                                           float(start_velocity))
+
+        ticks = dda_ticks(step_amounts)
+        step_pins = [axis.step_pin for axis, _direction, _step_amount in legs]
+        tick_pins = [tuple(step_pins[index] for index in tick) for tick in ticks]
+        velocities = [major_velocity * step_amount / major_steps for step_amount in step_amounts]
+        get_metrics().record_planning(self.source, time.perf_counter() - planning_start)
+        return PlannedMove(legs, schedule, ticks, tick_pins, velocities)
+
+    def execute(self, planned_move, start=None):
+        # This function runs a PlannedMove, start chains it to the end deadline of the move before it.
+        # A kill switch on any axis stops all of them, so the path is never left.
+        legs = planned_move.legs
+        ticks = planned_move.ticks
+        velocities = planned_move.velocities
+        for axis, direction, _step_amount in legs:
+            axis.arm_kill_switches(direction)
+            if axis.stop:
+                return None
+        for axis, direction, _step_amount in legs:
+            self.gpio.output(axis.direction_pin, direction)
+
+        def on_tick(tick):
+            stop = False
+            for index in ticks[tick]:
+                axis, direction, _step_amount = legs[index]
+                axis.update_axis_status(velocities[index], direction)
+                if axis.stop:
+                    stop = axis.stopped_by_kill_switch()
+            return stop
+
+        step_counters = [axis.step_counter for axis, _direction, _step_amount in legs]
+        report = self.last_report = self.step_timer.run_ticks(planned_move.schedule, planned_move.tick_pins, on_tick,
+                                                              start)
+        get_metrics().record_move(self.source, report,
+                                  [(axis.axis_name, axis.step_counter - step_counter)
+                                   for (axis, _direction, _step_amount), step_counter in zip(legs, step_counters)],
+                                  report['steps'] < len(planned_move))
+        return report
+
+    def move(self, legs, feed_rate):
+        # This function runs a linear move at a feed rate along the path [mm/sec].
+        # legs are (axis, direction, step_amount), the legs with no steps are ignored.
+        for axis, direction, step_amount in legs:
+            if step_amount > 0:
+                axis.arm_kill_switches(direction)
+                if axis.stop:
+                    return None
+        planned_move = self.plan(legs, feed_rate)
+        if planned_move is None:
+            return None
+        return self.execute(planned_move)
+
+
+class PlannedMove:
+    def __init__(self, legs, schedule, ticks, tick_pins, velocities):
+        # A linear move planned ahead of time: its legs, the major axis's step schedule, the axes stepped and the
+        # pins pulsed at every tick and the velocity of every leg [steps/sec]
+        self.legs = legs
+        self.schedule = schedule
+        self.ticks = ticks
+        self.tick_pins = tick_pins
+        self.velocities = velocities
+
+    def __len__(self):
+        return len(self.schedule)
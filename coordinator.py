@@ -0,0 +1,375 @@
+import hashlib
+import queue
+import threading
+import time
+from command_client import CommandError, ConnectionClosed, GantryClient
+
+HEARTBEAT_INTERVAL = 1.0  # [sec], how often every connected node's state is read
+HEARTBEAT_TIMEOUT = 3.0  # [sec], a node that doesn't answer a state request in this long is taken as down
+RECONNECT_INTERVAL = 2.0  # [sec], how often a down node is tried again
+MAX_ATTEMPTS = 3  # a job is given up once it was cut off on this many nodes
+RATIO_SMOOTHING = 0.3  # the weight of a node's last actual over estimated job time in its speed ratio
+
+
+def estimate_job_time(gcode):
+    # This function returns a G-code job's duration [sec] from a dry run on a virtual machine, see dry_run.py.
+    # The nodes are identical gantries, the local machine config stands for all of them.
+    from dry_run import dry_run
+    from gcode import interpret, parse
+
+    return dry_run(interpret(parse(gcode.splitlines())))['duration']
+
+
+class Job:
+    def __init__(self, job_id, name, gcode, estimate):
+        # A G-code job of the coordinator, status is 'pending', 'running', 'done' or 'failed'
+        self.job_id = job_id
+        self.name = name
+        self.gcode = gcode
+        self.estimate = estimate  # [sec]
+        self.status = 'pending'
+        self.node = None  # the name of the node running it, or that ran it last
+        self.attempts = 0
+        self.started = None
+        self.finished = None
+        self.report = None  # the node's gcode.JobRunner report
+        self.error = None
+
+    def get_values(self):
+        return {'job_id': self.job_id,
+                'name': self.name,
+                'status': self.status,
+                'node': self.node,
+                'attempts': self.attempts,
+                'estimate': self.estimate,
+                'duration': None if self.report is None else self.report['duration'],
+                'position': None if self.report is None else self.report['position'],
+                'error': self.error}
+
+
+class Node:
+    def __init__(self, name, host, port):
+        # A controller node, a gantry served by command_server.py. status is 'connecting', 'idle', 'busy'
+        # or 'down'. The jobs run on one connection, the heartbeat reads the state on another.
+        self.name = name
+        self.host = host
+        self.port = port
+        self.status = 'connecting'
+        self.client = None
+        self.monitor = None
+        self.job = None
+        self.speed_ratio = 1.0  # the node's actual over estimated job time, smoothed
+        self.position = None  # [mm], from the last heartbeat
+        self.last_seen = None
+        self.completed = 0
+        self.failures = 0
+
+    def connect(self):
+        self.client = GantryClient(self.host, self.port)
+        try:
+            self.monitor = GantryClient(self.host, self.port, timeout=HEARTBEAT_TIMEOUT)
+        except OSError:
+            self.client.close()
+            raise
+
+    def disconnect(self):
+        for client in (self.client, self.monitor):
+            if client is not None:
+                client.close()
+        self.client = None
+        self.monitor = None
+
+    def remaining_time(self, now):
+        # This function returns the estimated time [sec] until the node's running job ends
+        if self.job is None:
+            return 0.0
+        return max(0.0, self.job.estimate * self.speed_ratio - (now - self.job.started))
+
+
+class Coordinator:
+    def __init__(self, nodes, estimator=estimate_job_time, max_attempts=MAX_ATTEMPTS, clock=time.monotonic):
+        # Dispatches G-code jobs to several gantry nodes over the network. nodes are (name, host, port).
+        # Every pending job is planned longest first onto the node that would finish it first, from the
+        # nodes' running jobs and their speed ratios, and a node that goes idle takes the first job of its
+        # plan. A node that drops its connection or misses its heartbeat is down: its job goes back to the
+        # pending ones and runs elsewhere from the start, while the node is reconnected in the background.
+        self.nodes = [Node(*node) for node in nodes]
+        self.estimator = estimator
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.estimates = {}  # the G-code's sha1: estimate [sec]
+        self.jobs = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.threads = [threading.Thread(target=self.node_loop, args=(node,), daemon=True) for node in self.nodes]
+        self.threads.append(threading.Thread(target=self.heartbeat_loop, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, gcode, name=None):
+        # This function queues a job (its G-code text), returns the Job
+        key = hashlib.sha1(gcode.encode()).hexdigest()
+        if key not in self.estimates:
+            self.estimates[key] = self.estimator(gcode)
+        with self.condition:
+            job = Job(len(self.jobs), name or f'job {len(self.jobs)}', gcode, self.estimates[key])
+            self.jobs.append(job)
+            self.condition.notify_all()
+        return job
+
+    def plan(self):
+        # This function returns the pending jobs planned onto the nodes up, {node name: [jobs]}, and the
+        # estimated time [sec] each node is done at. The caller holds self.condition.
+        now = self.clock()
+        nodes = [node for node in self.nodes if node.status in ('idle', 'busy')]
+        finish_times = {node.name: node.remaining_time(now) for node in nodes}
+        plans = {node.name: [] for node in nodes}
+        if not nodes:
+            return plans, finish_times
+        pending = sorted((job for job in self.jobs if job.status == 'pending'),
+                         key=lambda job: (-job.estimate, job.job_id))
+        for job in pending:
+            node = min(nodes, key=lambda node: (finish_times[node.name] + job.estimate * node.speed_ratio,
+                                                node.name))
+            finish_times[node.name] += job.estimate * node.speed_ratio
+            plans[node.name].append(job)
+        return plans, finish_times
+
+    def take_job(self, node):
+        # This function blocks until the plan gives an idle node a job, None when the node is down or closed
+        with self.condition:
+            while not self.closed and node.status == 'idle':
+                plans, _finish_times = self.plan()
+                if plans.get(node.name):
+                    job = plans[node.name][0]
+                    job.status = 'running'
+                    job.node = node.name
+                    job.attempts += 1
+                    job.started = self.clock()
+                    job.error = None
+                    node.job = job
+                    node.status = 'busy'
+                    return job
+                self.condition.wait()
+            return None
+
+    def finish_job(self, node, job, report=None, error=None):
+        with self.condition:
+            if node.job is not job:
+                # A late answer of a node that was taken down, its job was put back and may run elsewhere
+                return
+            job.finished = self.clock()
+            job.report = report
+            job.error = error
+            job.status = 'done' if report is not None and report['status'] == 'done' else 'failed'
+            if report is not None and job.estimate > 0:
+                ratio = report['duration'] / job.estimate
+                node.speed_ratio += RATIO_SMOOTHING * (ratio - node.speed_ratio)
+            node.completed += 1
+            node.job = None
+            if node.status == 'busy':
+                node.status = 'idle'
+            self.condition.notify_all()
+
+    def node_failed(self, node, error):
+        # This function takes a node down and puts its job back, it is called once per failure
+        with self.condition:
+            if node.status == 'down':
+                return
+            node.status = 'down'
+            node.failures += 1
+            job = node.job
+            node.job = None
+            if job is not None:
+                job.error = f'{node.name}: {error}'
+                job.status = 'pending' if job.attempts < self.max_attempts else 'failed'
+                if job.status == 'failed':
+                    job.finished = self.clock()
+            self.condition.notify_all()
+        print(f'{node.name} is down ({error}).')
+        node.disconnect()
+
+    def node_loop(self, node):
+        # The thread of a node: (re)connect, then run the jobs its plan gives it one at a time
+        while not self.closed:
+            if node.status in ('connecting', 'down'):
+                try:
+                    node.connect()
+                except OSError:
+                    time.sleep(RECONNECT_INTERVAL)
+                    continue
+                with self.condition:
+                    node.status = 'idle'
+                    node.last_seen = self.clock()
+                    self.condition.notify_all()
+            job = self.take_job(node)
+            if job is None:
+                continue
+            try:
+                report = node.client.job(job.gcode)
+            except (ConnectionClosed, OSError) as error:
+                self.node_failed(node, error)
+            except CommandError as error:
+                self.finish_job(node, job, error=str(error))
+            else:
+                self.finish_job(node, job, report, None if report['status'] == 'done' else 'the job was stopped')
+        node.disconnect()
+
+    def heartbeat_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed, HEARTBEAT_INTERVAL)
+                if self.closed:
+                    return
+                nodes = [node for node in self.nodes if node.status in ('idle', 'busy')]
+            for node in nodes:
+                monitor = node.monitor
+                if monitor is None:
+                    continue
+                try:
+                    state = monitor.state()
+                except (CommandError, OSError, queue.Empty) as error:
+                    self.node_failed(node, str(error) or 'no heartbeat')
+                    continue
+                node.position = state['positions']
+                node.last_seen = self.clock()
+
+    def status(self):
+        # This function returns the nodes' and the jobs' state at once
+        with self.condition:
+            plans, finish_times = self.plan()
+            now = self.clock()
+            nodes = [{'name': node.name,
+                      'address': f'{node.host}:{node.port}',
+                      'status': node.status,
+                      'job': None if node.job is None else node.job.name,
+                      'queued': [job.name for job in plans.get(node.name, [])],
+                      'done_in': finish_times.get(node.name),
+                      'speed_ratio': node.speed_ratio,
+                      'position': node.position,
+                      'last_seen': None if node.last_seen is None else now - node.last_seen,
+                      'completed': node.completed,
+                      'failures': node.failures}
+                     for node in self.nodes]
+            counts = {}
+            for job in self.jobs:
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {'nodes': nodes, 'jobs': counts}
+
+    def results(self):
+        with self.condition:
+            return [job.get_values() for job in self.jobs]
+
+    def wait(self, timeout=None):
+        # This function blocks until every job is done or failed, returns False on timeout
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: all(job.status in ('done', 'failed') for job in self.jobs), timeout)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for node in self.nodes:
+            node.disconnect()
+
+
+def start_local_nodes(amount, driver='simulated'):
+    # This function starts stand-in controller nodes, command_server.py processes on free local ports,
+    # returns [(process, port)]
+    import os
+    import subprocess
+    import sys
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    nodes = []
+    for index in range(amount):
+        process = subprocess.Popen([sys.executable, '-u', os.path.join(directory, 'command_server.py'),
+                                    '--port', '0', '--driver', driver],
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        port = None
+        for line in process.stdout:
+            if line.startswith('Serving the gantry on '):
+                port = int(line.rsplit(':', 1)[1].rstrip('.\n'))
+                break
+        if port is None:
+            raise RuntimeError(f'Local node {index} did not start.')
+        # The node's output is drained so it never blocks on a full pipe
+        threading.Thread(target=process.stdout.read, daemon=True).start()
+        nodes.append((process, port))
+    return nodes
+
+
+if __name__ == "__main__":
+    # Demo: local stand-in nodes on the simulated GPIO run a set of scan jobs. One node is killed mid run and
+    # its job is rescheduled on the others.
+    import argparse
+    import os
+    import tempfile
+    from scan_patterns import serpentine, write_gcode
+
+    parser = argparse.ArgumentParser(description='Dispatches G-code jobs to several gantry nodes.')
+    parser.add_argument('jobs', nargs='*', help='G-code files, a set of scan jobs when left out')
+    parser.add_argument('--nodes', nargs='+', metavar='HOST:PORT', help='the nodes, local ones are started when '
+                                                                         'left out')
+    parser.add_argument('--local', type=int, default=3, help='how many local nodes to start')
+    parser.add_argument('--driver', default='simulated', help="the local nodes' step driver, see step_drivers.py")
+    parser.add_argument('--kill-after', type=float, metavar='SEC',
+                        help='kill the first local node after this long, 2 [sec] in the demo')
+    arguments = parser.parse_args()
+
+    local_nodes = []
+    if arguments.nodes:
+        node_addresses = [(address, address.rsplit(':', 1)[0], int(address.rsplit(':', 1)[1]))
+                          for address in arguments.nodes]
+    else:
+        local_nodes = start_local_nodes(arguments.local, arguments.driver)
+        node_addresses = [(f'node {index}', '127.0.0.1', port) for index, (_process, port) in enumerate(local_nodes)]
+        print(f'Started {len(local_nodes)} local nodes on ports {", ".join(str(port) for _p, port in local_nodes)}.')
+
+    job_texts = []
+    for path in arguments.jobs:
+        with open(path) as job_file:
+            job_texts.append((os.path.basename(path), job_file.read()))
+    if not job_texts:
+        demo_path = os.path.join(tempfile.gettempdir(), 'gantry_coordinator_demo.gcode')
+        for index, (width, height) in enumerate([(40, 20), (80, 20), (20, 20), (60, 40), (40, 40), (100, 20),
+                                                 (20, 10), (60, 20)]):
+            write_gcode(serpentine((100, 100 + width), (100, 100 + height), 10), demo_path, feed_rate=100)
+            with open(demo_path) as job_file:
+                job_texts.append((f'scan {index} ({width}x{height})', job_file.read()))
+        if local_nodes and arguments.kill_after is None:
+            arguments.kill_after = 2.0
+
+    coordinator = Coordinator(node_addresses)
+    start = time.monotonic()
+    for name, text in job_texts:
+        coordinator.submit(text, name)
+    estimated = coordinator.status()
+    print(f'{len(job_texts)} jobs, {sum(job.estimate for job in coordinator.jobs):.1f} [sec] of estimated work.')
+
+    killed = False
+    while not coordinator.wait(1.0):
+        elapsed = time.monotonic() - start
+        for node in coordinator.status()['nodes']:
+            print(f'  {elapsed:5.1f} [sec] {node["name"]}: {node["status"]}, running {node["job"]}, '
+                  f'queued {node["queued"]}')
+        if local_nodes and not killed and arguments.kill_after is not None and elapsed >= arguments.kill_after:
+            print(f'Killing {node_addresses[0][0]}.')
+            local_nodes[0][0].kill()
+            killed = True
+    makespan = time.monotonic() - start
+
+    for result in coordinator.results():
+        duration = 'n/a' if result['duration'] is None else f'{result["duration"]:.2f}'
+        print(f'{result["name"]}: {result["status"]} on {result["node"]} after {result["attempts"]} attempt(s), '
+              f'estimated {result["estimate"]:.2f} [sec], took {duration} [sec]'
+              + (f', {result["error"]}' if result['error'] else ''))
+    for node in coordinator.status()['nodes']:
+        print(f'{node["name"]}: {node["status"]}, {node["completed"]} jobs, speed ratio {node["speed_ratio"]:.2f}, '
+              f'{node["failures"]} failures')
+    print(f'All the jobs ended in {makespan:.1f} [sec].')
+    coordinator.close()
+    for process, _port in local_nodes:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,79 @@
+import time
+from gcode import DEFAULT_RAPID_RATE, JobRunner, load_job
+
+
+def virtual_machine(config=None, start=None, carriages=None):
+    # This function returns (driver, axes, homing) of the machine on a fresh virtual driver. start [mm] is
+    # where the axes are and think they are (a homed machine), carriages [mm] moves only the carriages, so
+    # the axes must home to find them. Both are per axis, None keeps 0.
+    from machine import build_machine
+    from step_drivers import VirtualDriver
+
+    driver = VirtualDriver()
+    axes, homing = build_machine(driver, config)
+    for index, axis in enumerate(axes):
+        carriage = driver.carriages[index]
+        if start is not None and start[index] is not None:
+            axis.current_position = start[index]
+            carriage.position = axis.step_position
+        if carriages is not None and carriages[index] is not None:
+            carriage.position = round(carriages[index] / axis.step_resolution)
+    return driver, axes, homing
+
+
+def dry_run(commands, config=None, start=None, carriages=None, rapid_rate=DEFAULT_RAPID_RATE):
+    # This function runs a job's commands (see gcode.load_job) on a virtual machine, faster than real time.
+    # Returns the job report, its duration is the machine's, with the carriages' final positions, every
+    # kill switch edge and the wall time the simulation took.
+    driver, axes, homing = virtual_machine(config, start, carriages)
+    wall_start = time.perf_counter()
+    report = JobRunner(axes, driver, homing, rapid_rate=rapid_rate).run(commands)
+    report['wall_time'] = time.perf_counter() - wall_start
+    report['steps'] = [axis.step_counter for axis in axes]
+    report['carriage_positions'] = [round(carriage.position * axis.step_resolution, 6)
+                                    for carriage, axis in zip(driver.carriages, axes)]
+    report['switch_events'] = driver.switch_events()
+    return report
+
+
+def format_report(report):
+    # This function returns a dry run's report as printable lines
+    lines = [f'Job {report["status"]} in {report["duration"]:.3f} [sec] of machine time, simulated in '
+             f'{report["wall_time"]:.2f} [sec] ({report["duration"] / max(report["wall_time"], 1e-9):.0f}x), '
+             f'{report["commands"]["move"]} moves, {sum(report["steps"])} steps.',
+             f'Axes at {report["position"]} [mm], carriages at {report["carriage_positions"]} [mm].']
+    for event_time, axis_name, switch, pressed, position in report['switch_events']:
+        lines.append(f'  {event_time:10.4f} [sec] {axis_name}: switch {switch} {"pressed" if pressed else "released"}'
+                     f' at step {position}')
+    if not report['switch_events']:
+        lines.append('No kill switch was hit.')
+    return lines
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import tempfile
+
+    parser = argparse.ArgumentParser(description='Runs a G-code job on a virtual machine, faster than real time, '
+                                                 'and reports its duration, end positions and kill switch hits.')
+    parser.add_argument('job', nargs='?', help='a G-code file or a compiled job, a serpentine scan demo when left out')
+    parser.add_argument('--start', type=float, nargs='+', metavar='MM',
+                        help='where the homed axes start [mm], one value per axis')
+    parser.add_argument('--carriages', type=float, nargs='+', metavar='MM',
+                        help='where the carriages really are [mm] while the axes think they are at 0, e.g. to '
+                             'dry run G28')
+    parser.add_argument('--rapid-rate', type=float, default=DEFAULT_RAPID_RATE, help='the G0 feed rate [mm/sec]')
+    arguments = parser.parse_args()
+
+    job = arguments.job
+    if job is None:
+        # A dense serpentine over 300 x 100 [mm], a point every 2 [mm] with a stop at each
+        from scan_patterns import serpentine, write_gcode
+
+        job = os.path.join(tempfile.gettempdir(), 'gantry_dry_run_demo.gcode')
+        write_gcode(serpentine((100, 400), (100, 200), 2), job, feed_rate=50)
+    dry_run_report = dry_run(load_job(job), start=arguments.start, carriages=arguments.carriages,
+                             rapid_rate=arguments.rapid_rate)
+    for line in format_report(dry_run_report):
+        print(line)
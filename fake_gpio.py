@@ -0,0 +1,296 @@
+import threading
+import time
+
+
+class VirtualClock:
+    def __init__(self, start=0.0):
+        # A clock that only moves when it is told to, the waits of the virtual step timers jump it ahead.
+        # now() and sleep() stand in for time.perf_counter and time.sleep.
+        self.time = start
+        self.lock = threading.Lock()
+
+    def now(self):
+        return self.time
+
+    def advance_to(self, deadline):
+        # This function moves the clock to a deadline, a deadline in the past leaves it where it is
+        with self.lock:
+            if deadline > self.time:
+                self.time = deadline
+
+    def sleep(self, duration):
+        self.advance_to(self.time + duration)
+
+
+class RecordingGPIO:
+    # A stand-in for the RPi.GPIO module that records every output edge with its timestamp,
+    # used to run the axis code and measure pulse timing without the gantry
+    HIGH = 1
+    LOW = 0
+    OUT = 0
+    IN = 1
+    BOARD = 10
+    BCM = 11
+
+    def __init__(self, clock=time.perf_counter, record_edges=True):
+        # record_edges False only keeps the pin states, for runs too long to hold every edge
+        self.clock = clock
+        self.record_edges = record_edges
+        self.mode = None
+        self.pin_modes = {}
+        self.pin_states = {}
+        self.edges = []  # (timestamp, pin, value)
+        self.pulse_callbacks = {}  # pin: [remaining rising edges, callback], see call_after_pulses()
+        self.pulse_watchers = {}  # pin: [callback], called on every rising edge, see watch_pulses()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode):
+        self.pin_modes[pin] = mode
+        self.pin_states[pin] = self.LOW
+
+    def output(self, pin, value):
+        value = int(value)
+        if self.record_edges:
+            self.edges.append((self.clock(), pin, value))
+        self.pin_states[pin] = value
+        if value and pin in self.pulse_callbacks:
+            self.count_pulse(pin)
+        if value and pin in self.pulse_watchers:
+            for callback in self.pulse_watchers[pin]:
+                callback()
+
+    def count_pulse(self, pin):
+        pending = self.pulse_callbacks[pin]
+        pending[0] -= 1
+        if pending[0] <= 0:
+            del self.pulse_callbacks[pin]
+            pending[1]()
+
+    def call_after_pulses(self, pin, pulses, callback):
+        # This function calls back once a pin has been pulsed a number of times, e.g. to hit a switch mid move
+        self.pulse_callbacks[pin] = [pulses, callback]
+
+    def watch_pulses(self, pin, callback):
+        # This function calls back on every pulse of a pin, e.g. to follow a simulated carriage
+        self.pulse_watchers.setdefault(pin, []).append(callback)
+
+    def input(self, pin):
+        return self.pin_states.get(pin, self.LOW)
+
+    def cleanup(self):
+        self.pin_modes = {}
+        self.pin_states = {}
+
+    def reset(self):
+        # This function forgets all the recorded edges
+        self.edges = []
+
+    def rising_edges(self, pin):
+        # This function returns the timestamps of every LOW -> HIGH output on a pin
+        return [timestamp for timestamp, edge_pin, value in self.edges if edge_pin == pin and value == self.HIGH]
+
+    def pulse_intervals(self, pin):
+        # This function returns the time between consecutive rising edges on a pin [sec]
+        rising = self.rising_edges(pin)
+        return [rising[i + 1] - rising[i] for i in range(len(rising) - 1)]
+
+
+class SimulatedKillSwitch:
+    def __init__(self, pin):
+        # A stand-in for a gpiozero Button, pressing it calls when_pressed like a real edge would
+        self.pin = pin
+        self.is_pressed = False
+        self.when_pressed = None
+        self.when_released = None
+        self.press_time = None
+
+    def press(self):
+        self.press_time = time.perf_counter()
+        self.is_pressed = True
+        if self.when_pressed is not None:
+            self.when_pressed()
+
+    def release(self):
+        self.is_pressed = False
+        if self.when_released is not None:
+            self.when_released()
+
+    def press_after(self, delay):
+        # This function presses the switch from another thread, like gpiozero's edge callbacks do
+        timer = threading.Timer(delay, self.press)
+        timer.start()
+        return timer
+
+    def press_at_pulse(self, gpio, step_pin, pulses):
+        # This function presses the switch when the axis reaches a step of the move, gpio is a RecordingGPIO
+        gpio.call_after_pulses(step_pin, pulses, self.press)
+
+
+class SimulatedCarriage:
+    def __init__(self, gpio, axis, position, clock=time.perf_counter):
+        # A carriage on a simulated axis, it follows the axis's step and direction pins (direction 1 moves it
+        # away from 0) and holds the kill switches down while it is at the travel ends. position is in steps.
+        # Every switch edge is kept in switch_events as (time, axis name, 'i' or 'f', pressed, position [steps]).
+        self.gpio = gpio
+        self.axis = axis
+        self.position = position
+        self.clock = clock
+        self.length = round(axis.axis_length / axis.step_resolution)
+        self.switch_events = []
+        gpio.watch_pulses(axis.step_pin, self.step)
+
+    def step(self):
+        self.position += 1 if self.gpio.input(self.axis.direction_pin) == 1 else -1
+        self.set_switch(self.axis.kill_switch_i, 'i', self.position <= 0)
+        self.set_switch(self.axis.kill_switch_f, 'f', self.position >= self.length)
+
+    def set_switch(self, switch, name, pressed):
+        if pressed == switch.is_pressed:
+            return
+        self.switch_events.append((self.clock(), self.axis.axis_name, name, pressed, self.position))
+        if pressed:
+            switch.press()
+        else:
+            switch.release()
+
+
+class SimulatedCamera:
+    def __init__(self, width=640, height=480, channels=1, exposure=0.002, clock=time.perf_counter):
+        # A synthetic frame source, every frame is a flat pattern of its frame number taking exposure [sec]
+        self.frame_size = width * height * channels
+        self.exposure = exposure
+        self.clock = clock
+        self.frames = 0
+        self.patterns = [bytes([value]) * self.frame_size for value in range(256)]
+
+    def grab_into(self, buffer):
+        # This function writes the next frame into a preallocated buffer
+        deadline = self.clock() + self.exposure
+        buffer[:] = self.patterns[self.frames % 256]
+        self.frames += 1
+        while self.clock() < deadline:
+            time.sleep(0.0001)
+
+
+class SimulatedPulse:
+    def __init__(self, gpio_on, gpio_off, delay):
+        # pigpio.pulse, bit masks of the pins switched on and off, then a delay [usec]
+        self.gpio_on = gpio_on
+        self.gpio_off = gpio_off
+        self.delay = delay
+
+
+class SimulatedPi:
+    def __init__(self, clock=time.perf_counter):
+        # A stand-in for a pigpio daemon connection. Sent waves are played into a RecordingGPIO (by BCM
+        # pin number) with the edge timestamps the DMA engine would produce.
+        self.clock = clock
+        self.connected = True
+        self.gpio = RecordingGPIO(clock)
+        self.pending_pulses = []
+        self.waves = {}
+        self.next_wave_id = 0
+        self.transmissions = []  # (wave id, start time, end time), in sending order
+
+    def set_mode(self, pin, mode):
+        self.gpio.setup(pin, mode)
+
+    def write(self, pin, value):
+        self.gpio.output(pin, value)
+
+    def read(self, pin):
+        return self.gpio.input(pin)
+
+    def stop(self):
+        self.connected = False
+
+    def wave_clear(self):
+        self.pending_pulses = []
+        self.waves = {}
+
+    def wave_add_generic(self, pulses):
+        self.pending_pulses.extend(pulses)
+        return len(self.pending_pulses)
+
+    def wave_create(self):
+        wave_id = self.next_wave_id
+        self.next_wave_id += 1
+        self.waves[wave_id] = self.pending_pulses
+        self.pending_pulses = []
+        return wave_id
+
+    def wave_delete(self, wave_id):
+        self.waves.pop(wave_id, None)
+
+    def wave_send_using_mode(self, wave_id, mode):
+        # Every mode is treated as ONE_SHOT_SYNC, the wave starts when the one being sent ends
+        now = self.clock()
+        start = max(now, self.transmissions[-1][2]) if self.transmissions else now
+        offset = start
+        for pulse in self.waves[wave_id]:
+            for pin in range(32):
+                if pulse.gpio_on >> pin & 1:
+                    self.gpio.edges.append((offset, pin, 1))
+                if pulse.gpio_off >> pin & 1:
+                    self.gpio.edges.append((offset, pin, 0))
+            offset += pulse.delay * 1e-6
+        self.transmissions.append((wave_id, start, offset))
+        return len(self.waves[wave_id])
+
+    def wave_tx_busy(self):
+        return 1 if self.transmissions and self.clock() < self.transmissions[-1][2] else 0
+
+    def wave_tx_at(self):
+        now = self.clock()
+        for wave_id, start, end in self.transmissions:
+            if start <= now < end:
+                return wave_id
+        return SimulatedPigpio.NO_TX_WAVE
+
+    def wave_tx_stop(self):
+        # The edges that were due after the stop never happen
+        now = self.clock()
+        self.gpio.edges = [edge for edge in self.gpio.edges if edge[0] <= now]
+        self.transmissions = [(wave_id, start, min(end, now)) for wave_id, start, end in self.transmissions
+                              if start <= now]
+
+
+class SimulatedPigpio:
+    # A stand-in for the pigpio module, enough of it for step_drivers.PigpioDriver
+    OUTPUT = 1
+    WAVE_MODE_ONE_SHOT_SYNC = 2
+    NO_TX_WAVE = 9999
+    pulse = SimulatedPulse
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+
+    def pi(self):
+        return SimulatedPi(self.clock)
+
+
+if __name__ == "__main__":
+    # Harness: a simulated kill switch fires mid move, the axis must stop on the next step
+    from axis_control import Axis
+    from step_drivers import get_driver
+
+    driver = get_driver('simulated')
+    fake_gpio = driver.gpio
+    axis = Axis(axis_name='X axis', direction_pin=31, step_pin=29, kill_switch_i_pin=10, kill_switch_f_pin=11,
+                direction='left', step_resolution=0.05, axis_length=1500, driver=driver)
+    axis.kill_switch_f.press_at_pulse(fake_gpio, axis.step_pin, 300)
+    axis.axis_for_loop(2000, 1, 1000)
+    print(f'Pressed at pulse 300, stopped after {len(fake_gpio.rising_edges(axis.step_pin))} pulses, '
+          f'stop latency {axis.stop_latency * 1e6:.1f} [usec]')
+
+    axis.kill_switch_f.release()
+    fake_gpio.reset()
+    axis.kill_switch_f.press_after(0.1)
+    axis.axis_for_loop(2000, 1, 1000)
+    print(f'Pressed after 0.1 [sec], stopped after {len(fake_gpio.rising_edges(axis.step_pin))} pulses, '
+          f'stop latency {axis.stop_latency * 1e6:.1f} [usec]')
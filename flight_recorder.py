@@ -0,0 +1,237 @@
+import csv
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+DEFAULT_CAPACITY = 1 << 18  # records, a power of 2, 32 bytes each
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'gantry_flight_recorder.bin')
+RECORDER_ENVIRONMENT_VARIABLE = 'GANTRY_FLIGHT_RECORDER'
+
+# The recording file: a header, then a ring of fixed size records. The records are packed in place through the mmap,
+# so the records a crashed process wrote are in the page cache and end up in the file.
+# The head (the records written so far) is stored after every record, the records before it are complete.
+RECORDER_MAGIC = b'GFL1'
+HEADER_FORMAT = '<4sIQ'  # magic, capacity, head
+HEADER_SIZE = 64
+RECORD = struct.Struct('<dqqfBBBB')  # 32 bytes
+COLUMNS = (('timestamp', 'd'), ('step_counter', 'q'), ('step_position', 'q'), ('velocity', 'f'), ('axis', 'B'),
+           ('kind', 'B'), ('direction', 'B'), ('flags', 'B'))
+
+# Record kinds, and the flags that hold the kill switches states at the time of the record
+EVENT_STEP = 0
+EVENT_SWITCH = 1  # a kill switch edge
+EVENT_STOP = 2  # a step loop stopped on axis.stop
+EVENT_NAMES = ('step', 'switch', 'stop')
+FLAG_SWITCH_I = 1  # the switch at 0 is pressed
+FLAG_SWITCH_F = 2  # the switch at axis_length is pressed
+FLAG_STOP = 4  # axis.stop is set
+
+
+def recording_path(path=None):
+    # This function returns the recording file: path, the GANTRY_FLIGHT_RECORDER environment variable or a file
+    # in the temporary directory
+    if path is None:
+        path = os.environ.get(RECORDER_ENVIRONMENT_VARIABLE, DEFAULT_PATH)
+    return os.path.abspath(path)
+
+
+def file_size(capacity):
+    return HEADER_SIZE + capacity * RECORD.size
+
+
+def open_locked(path):
+    # This function opens a recording file for this process only, None when another process records to it.
+    # The lock goes with the file, a crashed process doesn't keep it.
+    recording_file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT), 'r+b')
+    try:
+        import fcntl
+    except ImportError:  # no file locks off Unix
+        return recording_file
+    try:
+        fcntl.flock(recording_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        recording_file.close()
+        return None
+    return recording_file
+
+
+class FlightRecorder:
+    def __init__(self, path=None, capacity=DEFAULT_CAPACITY, clock=time.time):
+        # An always on ring of compact motion records in a memory mapped file, the last capacity records are kept.
+        # A record is a single struct pack into the mapped ring, nothing is formatted or printed.
+        # A file of the same capacity is appended to, so a recording runs on across restarts. Only one process
+        # records to a file, another one that asks for it records to a file of its own, named with its pid.
+        if capacity & (capacity - 1):
+            raise ValueError('The flight recorder capacity must be a power of 2.')
+        self.path = recording_path(path)
+        self.file = open_locked(self.path)
+        if self.file is None:
+            root, extension = os.path.splitext(self.path)
+            print(f'{self.path} is recorded to by another recorder, recording to {root}_{os.getpid()}{extension}.')
+            self.path = f'{root}_{os.getpid()}{extension}'
+            self.file = open_locked(self.path)
+            if self.file is None:
+                raise RuntimeError(f'Could not lock the flight recording {self.path}.')
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.clock = clock
+        self.lock = threading.Lock()  # the step loops and the kill switch callbacks record from their threads
+
+        size = file_size(capacity)
+        head = 0
+        if os.path.getsize(self.path) == size:
+            magic, file_capacity, file_head = struct.unpack(HEADER_FORMAT,
+                                                            self.file.read(struct.calcsize(HEADER_FORMAT)))
+            if magic == RECORDER_MAGIC and file_capacity == capacity:
+                head = file_head
+        if not head:
+            self.file.truncate(0)
+            self.file.truncate(size)
+        self.memory = mmap.mmap(self.file.fileno(), size)
+        struct.pack_into(HEADER_FORMAT, self.memory, 0, RECORDER_MAGIC, capacity, head)
+        self.head_view = memoryview(self.memory)[8:16].cast('Q')
+        self.pack_into = RECORD.pack_into
+        self.head = head
+
+    def record(self, axis, kind, step_counter, step_position, direction, flags, velocity):
+        # This function is called from the step loop, one record per event
+        with self.lock:
+            self.pack_into(self.memory, HEADER_SIZE + (self.head & self.mask) * RECORD.size, self.clock(),
+                           step_counter, step_position, velocity, axis, kind, direction, flags)
+            self.head += 1
+            self.head_view[0] = self.head
+
+    def flush(self):
+        # This function writes the records to the disk, the page cache already survives a process crash
+        self.memory.flush()
+
+    def close(self):
+        self.head_view.release()
+        self.memory.close()
+        self.file.close()
+
+
+def read_recording(path, axis=None, kinds=None, start=None, end=None, last=None):
+    # This function returns the records of a recording file, oldest first, as a dict of columns (arrays).
+    # The records can be filtered by axis, kinds (names or numbers), a [start, end] time window and
+    # the last amount of records.
+    with open(path, 'rb') as recording_file:
+        data = recording_file.read()
+    magic, capacity, head = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if magic != RECORDER_MAGIC or len(data) != file_size(capacity):
+        raise ValueError(f'{path} is not a flight recording.')
+    records = list(RECORD.iter_unpack(memoryview(data)[HEADER_SIZE:]))
+    first = max(0, head - capacity)
+    records = [records[i & (capacity - 1)] for i in range(first, head)]
+    if kinds is not None:
+        kinds = {EVENT_NAMES.index(kind) if isinstance(kind, str) else kind for kind in kinds}
+    records = [record for record in records
+               if (axis is None or record[4] == axis)
+               and (kinds is None or record[5] in kinds)
+               and (start is None or record[0] >= start)
+               and (end is None or record[0] <= end)]
+    if last is not None:
+        records = records[-last:] if last else []
+    return {name: array(code, [record[field] for record in records]) for field, (name, code) in enumerate(COLUMNS)}
+
+
+def to_numpy(recording):
+    # This function turns the columns of read_recording() into NumPy arrays
+    import numpy as np
+
+    return {name: np.frombuffer(column, dtype=column.typecode) for name, column in recording.items()}
+
+
+def write_csv(recording, output):
+    writer = csv.writer(output)
+    writer.writerow([name for name, _code in COLUMNS] + ['event', 'switch_i', 'switch_f', 'stop'])
+    for values in zip(*(recording[name] for name, _code in COLUMNS)):
+        record = dict(zip((name for name, _code in COLUMNS), values))
+        flags = record['flags']
+        writer.writerow([f'{record["timestamp"]:.6f}'] + list(values[1:]) +
+                        [EVENT_NAMES[record['kind']], int(bool(flags & FLAG_SWITCH_I)),
+                         int(bool(flags & FLAG_SWITCH_F)), int(bool(flags & FLAG_STOP))])
+
+
+def summary(recording):
+    # This function returns a line per axis: its records, last position and the switch and stop events
+    lines = []
+    for axis in sorted(set(recording['axis'])):
+        indexes = [i for i, record_axis in enumerate(recording['axis']) if record_axis == axis]
+        events = [i for i in indexes if recording['kind'][i] != EVENT_STEP]
+        last = indexes[-1]
+        lines.append(f'axis {axis}: {len(indexes)} records, last at step {recording["step_position"][last]} '
+                     f'(step counter {recording["step_counter"][last]}), {len(events)} switch/stop events')
+        for i in events[-5:]:
+            lines.append(f'  {time.strftime("%H:%M:%S", time.localtime(recording["timestamp"][i]))}'
+                         f'.{int(recording["timestamp"][i] % 1 * 1e6):06d} {EVENT_NAMES[recording["kind"][i]]} '
+                         f'at step {recording["step_position"][i]}, flags {recording["flags"][i]:03b}')
+    return lines
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Dumps a flight recording of the step loops.')
+    parser.add_argument('path', nargs='?', help='the recording file, GANTRY_FLIGHT_RECORDER by default')
+    parser.add_argument('--axis', type=int, help='only the records of this axis index')
+    parser.add_argument('--kind', action='append', choices=EVENT_NAMES, help='only these record kinds')
+    parser.add_argument('--start', type=float, help='only the records from this time on [sec since the epoch]')
+    parser.add_argument('--end', type=float, help='only the records up to this time [sec since the epoch]')
+    parser.add_argument('--last', type=int, help='only the last records')
+    parser.add_argument('--csv', metavar='OUTPUT', help="write the records as CSV, '-' for stdout")
+    parser.add_argument('--npz', metavar='OUTPUT', help='write the records as NumPy arrays (needs NumPy)')
+    parser.add_argument('--demo', action='store_true', help='record a simulated run with a kill switch hit first')
+    arguments = parser.parse_args()
+
+    if arguments.demo:
+        # A simulated axis runs into its switch at 0, then the per record cost is measured
+        from fake_gpio import SimulatedCarriage
+        from machine import build_machine
+        from step_drivers import get_driver
+
+        driver = get_driver('simulated')
+        machine_axes, _homing = build_machine(driver)
+        demo_recorder = machine_axes[0].flight_recorder  # the machine config's recorder
+        if demo_recorder is None:
+            demo_recorder = FlightRecorder(arguments.path)
+            for index, machine_axis in enumerate(machine_axes):
+                machine_axis.attach_flight_recorder(demo_recorder, index)
+        arguments.path = demo_recorder.path
+        for machine_axis in machine_axes:
+            SimulatedCarriage(driver.gpio, machine_axis, 200)
+        machine_axes[0].axis_for_loop(2000, 0, 500)
+        machine_axes[1].axis_for_loop(2000, 1, 100)
+        demo_recorder.flush()
+        cost_path = os.path.join(tempfile.gettempdir(), 'gantry_flight_recorder_cost.bin')
+        cost_recorder = FlightRecorder(cost_path, capacity=1 << 16)
+        events = 100000
+        begin = time.perf_counter()
+        for _ in range(events):
+            cost_recorder.record(0, EVENT_STEP, 0, 0, 1, 0, 1000.0)
+        cost = (time.perf_counter() - begin) / events
+        cost_recorder.close()
+        os.remove(cost_path)
+        print(f'Recorded to {arguments.path}, {cost * 1e9:.0f} [nsec] per record.', file=sys.stderr)
+        arguments.kind = arguments.kind or ['step', 'switch', 'stop']
+        arguments.last = arguments.last or 1000
+
+    records = read_recording(recording_path(arguments.path), arguments.axis, arguments.kind, arguments.start,
+                             arguments.end, arguments.last)
+    if arguments.npz:
+        import numpy as np
+
+        np.savez(arguments.npz, **to_numpy(records))
+    if arguments.csv == '-':
+        write_csv(records, sys.stdout)
+    elif arguments.csv:
+        with open(arguments.csv, 'w', newline='') as csv_file:
+            write_csv(records, csv_file)
+    if not arguments.csv == '-':
+        for line in summary(records):
+            print(line)
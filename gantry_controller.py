@@ -0,0 +1,194 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from coordinated_motion import CoordinatedMotion, feed_rate_for_velocities
+from move_queue import STOP_POLL_INTERVAL
+
+DEFAULT_VELOCITY = 1000  # [steps/sec], for the axes without a motion profile
+EVENT_INTERVAL = 0.05  # [sec], how often the event stream looks at the position
+
+
+class GantryController:
+    def __init__(self, axes, driver, homing=None):
+        # An asyncio front end for the axes. The step loops run on a dedicated single thread executor, so the
+        # event loop never waits on them and the motion commands run one at a time in the order they came.
+        # Cancelling a motion coroutine stops the axes on the next step. homing is a homing.Homing.
+        self.axes = axes
+        self.driver = driver
+        self.homing = homing
+        self.coordinated_motion = CoordinatedMotion(driver)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gantry-motion')
+        self.busy = False
+        self.motion = None  # a token of the motion call that runs on the motion thread, None when idle
+        self.last_error = None
+
+    def run_motion(self, function, *args):
+        # This function runs a blocking motion call on the motion thread
+        token = object()
+
+        def motion():
+            self.motion = token
+            self.busy = True
+            try:
+                return function(*args)
+            finally:
+                self.busy = False
+                self.motion = None
+        return self.executor.submit(motion)
+
+    async def wait_motion(self, function, *args):
+        # This function awaits a motion call, a cancelled call that already runs is stopped, and awaited
+        # until its step loop has returned, so the axes are at rest when the cancellation goes on.
+        # The stop is asserted until the call is out, a move that starts after it re-arms the kill switches.
+        future = self.run_motion(function, *args)
+        wrapped = asyncio.wrap_future(future)
+        try:
+            return await asyncio.shield(wrapped)
+        except asyncio.CancelledError:
+            if not future.cancel():
+                while not future.done():
+                    self.stop_axes()
+                    await asyncio.wait([wrapped], timeout=STOP_POLL_INTERVAL)
+            raise
+
+    def stop_axes(self):
+        # This function sets axis.stop once, the step loops see it. A move that has not armed its kill switches
+        # yet clears it again, so a stop goes through stop() or wait_motion's cancellation.
+        for axis in self.axes:
+            axis.stop = 1
+
+    def legs_to(self, position):
+        # This function returns the legs of a move to a position [mm], None for the axes that stay
+        legs = []
+        for value, axis in zip(position, self.axes):
+            if value is None:
+                continue
+            step_delta = round(value / axis.step_resolution) - axis.step_position
+            legs.append((axis, 1 if step_delta > 0 else 0, abs(step_delta)))
+        return legs
+
+    def move_legs(self, legs, feed_rate):
+        # This function runs on the motion thread, it turns the legs into one coordinated move
+        legs = [leg for leg in legs if leg[2] > 0]
+        if not legs:
+            return None
+        if feed_rate is None:
+            velocities = [DEFAULT_VELOCITY if axis.motion_profile is None else axis.motion_profile.max_velocity
+                          for axis, _direction, _step_amount in legs]
+            feed_rate = feed_rate_for_velocities(legs, velocities)
+        return self.coordinated_motion.move(legs, feed_rate)
+
+    def move_to_position(self, position, feed_rate):
+        # The legs are computed on the motion thread, from the position the previous command left the axes at
+        return self.move_legs(self.legs_to(position), feed_rate)
+
+    def jog_axis(self, axis, distance, feed_rate):
+        step_delta = round(distance / axis.step_resolution)
+        return self.move_legs([(axis, 1 if step_delta > 0 else 0, abs(step_delta))], feed_rate)
+
+    async def move_to(self, position, feed_rate=None):
+        # This function moves the axes along a straight line to a position [mm] (None keeps an axis where
+        # it is) at a feed rate along the path [mm/sec], the fastest the axes allow when None.
+        # Returns the step timer report.
+        return await self.wait_motion(self.move_to_position, tuple(position), feed_rate)
+
+    async def jog(self, axis_index, distance, feed_rate=None):
+        # This function moves one axis by a distance [mm], negative towards 0
+        return await self.wait_motion(self.jog_axis, self.axes[axis_index], distance, feed_rate)
+
+    def run_gcode(self, gcode):
+        # This function runs on the motion thread, gcode is a G-code job's text, see gcode.py
+        from gcode import JobRunner, interpret, parse
+
+        return JobRunner(self.axes, self.driver, self.homing).run(interpret(parse(gcode.splitlines())))
+
+    async def job(self, gcode):
+        # This function runs a whole G-code job (its text), returns the job report. A stop ends the job.
+        return await self.wait_motion(self.run_gcode, gcode)
+
+    async def home(self):
+        # This function homes all the axes together, returns the homing report
+        if self.homing is None:
+            raise ValueError('The controller has no homing.Homing.')
+        return await self.wait_motion(self.homing.home)
+
+    async def stop(self):
+        # This function stops the running motion call, the queued ones still run. The stop is asserted until
+        # the call is out, the way move_queue.MoveQueue.stop does.
+        motion = self.motion
+        while motion is not None and self.motion is motion:
+            self.stop_axes()
+            await asyncio.sleep(STOP_POLL_INTERVAL)
+
+    def state(self):
+        # This function returns the motion state at once, without waiting for the motion thread
+        busy = self.busy
+        return {'busy': busy,
+                'positions': tuple(axis.current_position for axis in self.axes),
+                'velocities': tuple(axis.velocity * axis.step_resolution if busy else 0 for axis in self.axes),
+                'stopped': tuple(bool(axis.stop) for axis in self.axes)}
+
+    async def events(self, interval=EVENT_INTERVAL):
+        # This async generator yields the state with a timestamp whenever it changes,
+        # e.g. async for event in controller.events(): ...
+        previous = None
+        while True:
+            state = self.state()
+            if state != previous:
+                previous = state
+                yield dict(state, time=time.time())
+            await asyncio.sleep(interval)
+
+    def close(self):
+        motion = self.motion
+        while motion is not None and self.motion is motion:
+            self.stop_axes()
+            time.sleep(STOP_POLL_INTERVAL)
+        self.executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    # Demo on the simulated GPIO: homing and moves overlap with other coroutines, a long move is cancelled
+    from fake_gpio import SimulatedCarriage
+    from machine import build_machine
+    from step_drivers import get_driver
+
+    async def main():
+        driver = get_driver('simulated')
+        axes, homing = build_machine(driver)
+        for axis in axes:
+            SimulatedCarriage(driver.gpio, axis, 2000)
+        controller = GantryController(axes, driver, homing)
+        loop_ticks = 0
+
+        async def other_io():
+            # stands in for the camera reads, logging and network the event loop keeps serving
+            nonlocal loop_ticks
+            while True:
+                await asyncio.sleep(0.01)
+                loop_ticks += 1
+
+        async def show_events():
+            async for event in controller.events(0.25):
+                print(f'  event: busy={event["busy"]}, positions={event["positions"]}')
+
+        tasks = [asyncio.create_task(other_io()), asyncio.create_task(show_events())]
+        start = time.perf_counter()
+        report = await controller.home()
+        print(f'Homed in {report["duration"]:.2f} [sec].')
+        await controller.move_to((20, 15, None))
+        await controller.jog(2, 5)
+
+        long_move = asyncio.create_task(controller.move_to((400, None, None), feed_rate=20))
+        await asyncio.sleep(0.5)
+        long_move.cancel()
+        try:
+            await long_move
+        except asyncio.CancelledError:
+            print(f'Long move cancelled, the axes stopped at {controller.state()["positions"]} [mm].')
+        print(f'{time.perf_counter() - start:.2f} [sec] of motion, the event loop ran {loop_ticks} other ticks.')
+        for task in tasks:
+            task.cancel()
+        controller.close()
+
+    asyncio.run(main())
@@ -0,0 +1,269 @@
+import argparse
+import math
+import re
+import struct
+from trajectory_planner import DEFAULT_ACCELERATION, DEFAULT_JUNCTION_DEVIATION, TrajectoryPlanner
+
+AXIS_LETTERS = 'XYZ'
+DEFAULT_FEED_RATE = 10  # [mm/sec], until the job sets one with F
+DEFAULT_RAPID_RATE = 50  # [mm/sec], G0 moves, the axes motion profiles may cap it lower
+PLANNER_BUFFER = 128  # moves planned together, a longer job is run in batches of this many
+MM_PER_MIN = 1 / 60  # F words are in mm/min
+
+# The compiled job file: a header, then one fixed size record per command. A record is the command kind,
+# the flags (rapid, relative), the feed rate [mm/sec] and one value per axis [mm], NaN when not given.
+COMPILED_MAGIC = b'GCJ1'
+COMPILED_HEADER_FORMAT = '<4sB'  # magic, axes amount
+COMMAND_KINDS = ('move', 'home', 'set_position', 'wait')
+RAPID = 1
+RELATIVE = 2
+READ_CHUNK = 4096  # records read at a time from a compiled job
+
+WORD = re.compile(r'([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))')
+COMMENT = re.compile(r'\(.*?\)|;.*')
+
+
+def read_lines(path):
+    # This function yields the lines of a job file one at a time, the file is never loaded whole
+    with open(path) as job_file:
+        for line in job_file:
+            yield line
+
+
+def parse(lines):
+    # This function yields the (line number, words) of the G-code lines that hold any,
+    # words are (letter, value) pairs in the line's order
+    for line_number, line in enumerate(lines, 1):
+        line = COMMENT.sub('', line).upper()
+        words = [(letter, float(value)) for letter, value in WORD.findall(line)]
+        if words:
+            yield line_number, words
+
+
+def interpret(parsed, axes_amount=len(AXIS_LETTERS)):
+    # This function turns parsed G-code into gantry commands, one generator step at a time:
+    # ('move', flags, feed rate [mm/sec], values [mm]), ('home',), ('set_position', values [mm]) and ('wait',).
+    # The values are per axis, None for the axes the line doesn't name. Relative moves keep their deltas,
+    # the job runner resolves them against the real position, so a compiled job runs from anywhere.
+    letters = AXIS_LETTERS[:axes_amount]
+    relative = False
+    rapid = False
+    feed_rate = DEFAULT_FEED_RATE
+    for line_number, words in parsed:
+        codes = [(letter, value) for letter, value in words if letter in 'GM']
+        values = dict((letter, value) for letter, value in words if letter not in 'GM')
+        axis_values = tuple(values.get(letter) for letter in letters)
+        if 'F' in values:
+            if values['F'] <= 0:
+                raise ValueError(f'Line {line_number}: the feed rate must be positive.')
+            feed_rate = values['F'] * MM_PER_MIN
+
+        motion = None
+        for letter, value in codes:
+            code = f'{letter}{value:g}'
+            if code in ('G0', 'G1'):
+                motion = code
+            elif code == 'G90':
+                relative = False
+            elif code == 'G91':
+                relative = True
+            elif code == 'G28':
+                motion = code
+            elif code == 'G92':
+                motion = code
+            elif code == 'M400':
+                yield ('wait',)
+            else:
+                raise ValueError(f'Line {line_number}: {code} is not supported.')
+
+        if motion in ('G0', 'G1'):
+            rapid = motion == 'G0'
+        if motion == 'G28':
+            yield ('home',)
+        elif motion == 'G92':
+            yield ('set_position', axis_values)
+        elif any(value is not None for value in axis_values):
+            flags = (RAPID if rapid else 0) | (RELATIVE if relative else 0)
+            yield ('move', flags, feed_rate, axis_values)
+
+
+def record_format(axes_amount):
+    return f'<BBxxf{axes_amount}d'
+
+
+def compile_job(commands, output_path, axes_amount=len(AXIS_LETTERS)):
+    # This function writes the commands to a compiled job file, returns how many it wrote
+    record = struct.Struct(record_format(axes_amount))
+    empty = (None,) * axes_amount
+    written = 0
+    with open(output_path, 'wb') as output_file:
+        output_file.write(struct.pack(COMPILED_HEADER_FORMAT, COMPILED_MAGIC, axes_amount))
+        for command in commands:
+            kind = command[0]
+            flags, feed_rate, values = 0, 0.0, empty
+            if kind == 'move':
+                _kind, flags, feed_rate, values = command
+            elif kind == 'set_position':
+                values = command[1]
+            output_file.write(record.pack(COMMAND_KINDS.index(kind), flags, feed_rate,
+                                          *(math.nan if value is None else value for value in values)))
+            written += 1
+    return written
+
+
+def read_compiled(path):
+    # This function yields the commands of a compiled job file, it reads a chunk of records at a time
+    header_size = struct.calcsize(COMPILED_HEADER_FORMAT)
+    with open(path, 'rb') as job_file:
+        magic, axes_amount = struct.unpack(COMPILED_HEADER_FORMAT, job_file.read(header_size))
+        if magic != COMPILED_MAGIC:
+            raise ValueError(f'{path} is not a compiled job.')
+        record = struct.Struct(record_format(axes_amount))
+        while True:
+            chunk = job_file.read(READ_CHUNK * record.size)
+            if not chunk:
+                break
+            for kind, flags, feed_rate, *values in record.iter_unpack(chunk):
+                kind = COMMAND_KINDS[kind]
+                values = tuple(None if math.isnan(value) else value for value in values)
+                if kind == 'move':
+                    yield (kind, flags, feed_rate, values)
+                elif kind == 'set_position':
+                    yield (kind, values)
+                else:
+                    yield (kind,)
+
+
+def is_compiled(path):
+    with open(path, 'rb') as job_file:
+        return job_file.read(len(COMPILED_MAGIC)) == COMPILED_MAGIC
+
+
+def load_job(path, axes_amount=len(AXIS_LETTERS)):
+    # This function returns the commands generator of a G-code file or of a compiled job
+    if is_compiled(path):
+        return read_compiled(path)
+    return interpret(parse(read_lines(path)), axes_amount)
+
+
+class JobRunner:
+    def __init__(self, axes, driver, homing=None, rapid_rate=DEFAULT_RAPID_RATE,
+                 acceleration=DEFAULT_ACCELERATION, junction_deviation=DEFAULT_JUNCTION_DEVIATION):
+        # Runs gantry commands on the axes (in AXIS_LETTERS order). The moves are queued in a look-ahead
+        # TrajectoryPlanner and stepped in batches, so consecutive G1 moves blend. homing runs G28.
+        self.axes = axes
+        self.driver = driver
+        self.clock = None if driver is None else driver.clock  # a driverless runner sets its own
+        self.homing = homing
+        self.rapid_rate = rapid_rate
+        self.acceleration = acceleration
+        self.junction_deviation = junction_deviation
+        self.offsets = [0.0] * len(axes)  # [mm], the machine position of the job's 0, set by G92
+        self.position = None  # [steps], where the queued moves end
+        self.planner = None
+        self.stopped = False
+
+    def machine_position(self):
+        # This function returns the position the queued moves end at [mm]
+        return [steps * axis.step_resolution for steps, axis in zip(self.position, self.axes)]
+
+    def queue_move(self, flags, feed_rate, values):
+        if self.planner is None:
+            self.planner = TrajectoryPlanner(self.axes, self.acceleration, self.junction_deviation, self.position)
+        position = self.machine_position()
+        for index, value in enumerate(values):
+            if value is None:
+                continue
+            position[index] = position[index] + value if flags & RELATIVE else value + self.offsets[index]
+        self.planner.add_waypoint(position, self.rapid_rate if flags & RAPID else feed_rate)
+        self.position = list(self.planner.last_steps)
+        if len(self.planner.segments) >= PLANNER_BUFFER:
+            self.flush()
+
+    def flush(self):
+        # This function steps the queued moves, a kill switch or the Stop button stops the job
+        if self.planner is None:
+            return
+        planner, self.planner = self.planner, None
+        ticks = sum(max(abs(delta) for delta in segment.step_deltas) for segment in planner.segments)
+        reports = planner.execute(self.driver)
+        if sum(report['steps'] for report in reports) < ticks:
+            self.stopped = True
+        self.position = [axis.step_position for axis in self.axes]
+
+    def home(self):
+        # This function runs G28, returns False when an axis could not be homed
+        if self.homing is None:
+            raise ValueError('G28 needs a homing.Homing to run.')
+        report = self.homing.home()
+        self.position = [axis.step_position for axis in self.axes]
+        return all(axis_report['status'] == 'homed' for axis_report in report['axes'].values())
+
+    def run(self, commands):
+        # This function runs a job, returns its report. The duration is on the driver's clock, the virtual
+        # driver's dry runs report how long the job takes on the machine.
+        start = self.clock()
+        self.stopped = False
+        self.position = [axis.step_position for axis in self.axes]
+        counts = dict.fromkeys(COMMAND_KINDS, 0)
+        for command in commands:
+            kind = command[0]
+            counts[kind] += 1
+            if kind == 'move':
+                self.queue_move(*command[1:])
+            else:
+                self.flush()
+            if self.stopped:
+                break
+            if kind == 'home':
+                if not self.home():
+                    self.stopped = True
+                    break
+            elif kind == 'set_position':
+                position = self.machine_position()
+                for index, value in enumerate(command[1]):
+                    if value is not None:
+                        self.offsets[index] = position[index] - value
+        if not self.stopped:
+            self.flush()
+        return {'status': 'stopped' if self.stopped else 'done',
+                'commands': counts,
+                'duration': self.clock() - start,
+                'position': [axis.current_position for axis in self.axes]}
+
+
+if __name__ == "__main__":
+    from machine import build_machine, driver_name, start_metrics
+    from metrics import PROFILE_MODES, profiled
+    from step_drivers import get_driver
+
+    parser = argparse.ArgumentParser(description='Runs a G-code job (G0/G1/G28/G90/G91/G92/F/M400) on the gantry.')
+    parser.add_argument('job', help='a G-code file, or a job compiled with --compile')
+    parser.add_argument('--compile', metavar='OUTPUT', help='compile the job to a binary move list and exit')
+    parser.add_argument('--driver',
+                        help='the step driver, see step_drivers.py (GANTRY_STEP_DRIVER, then machine.json by default)')
+    parser.add_argument('--rapid-rate', type=float, default=DEFAULT_RAPID_RATE, help='the G0 feed rate [mm/sec]')
+    parser.add_argument('--profile', choices=PROFILE_MODES, help='profile the job, see metrics.profiled()')
+    parser.add_argument('--profile-output', help='the .prof (cprofile) or collapsed stacks (sampling) file, '
+                                                 'the top functions are printed when left out')
+    arguments = parser.parse_args()
+
+    if arguments.compile:
+        amount = compile_job(load_job(arguments.job), arguments.compile)
+        print(f'Compiled {amount} commands to {arguments.compile}.')
+    else:
+        step_driver = get_driver(arguments.driver or driver_name())
+        machine_axes, machine_homing = build_machine(step_driver)
+        start_metrics()
+        if step_driver.name == 'simulated':
+            # The simulated carriages start mid travel and press the switches at the travel ends
+            from fake_gpio import SimulatedCarriage
+
+            carriages = [SimulatedCarriage(step_driver.gpio, axis, round(axis.axis_length / axis.step_resolution / 2))
+                         for axis in machine_axes]
+        runner = JobRunner(machine_axes, step_driver, machine_homing, rapid_rate=arguments.rapid_rate)
+        with profiled(arguments.profile, arguments.profile_output):
+            job_report = runner.run(load_job(arguments.job))
+        print(f'Job {job_report["status"]} in {job_report["duration"]:.2f} [sec], '
+              f'{job_report["commands"]["move"]} moves, at {job_report["position"]} [mm].')
+        step_driver.cleanup()
@@ -0,0 +1,235 @@
+import heapq
+from metrics import get_metrics
+from motion_profiles import MotionProfile
+from step_timing import StepSchedule
+
+DEFAULT_FAST_VELOCITY = 4000  # [steps/sec], the approach, back-off and home moves
+DEFAULT_SLOW_VELOCITY = 250  # [steps/sec], the precise re-seek, run without a ramp
+DEFAULT_ACCELERATION = 8000  # [steps/sec^2]
+DEFAULT_BACK_OFF = 5  # [mm], how far the axis leaves its switch before the re-seek
+SEEK_MARGIN = 1.1  # the approach gives up after this many axis lengths
+MIN_TICK_INTERVAL = 20e-6  # [sec], steps of different axes closer than this are pulsed on the same tick
+
+
+class HomingSettings:
+    def __init__(self, fast_velocity=DEFAULT_FAST_VELOCITY, slow_velocity=DEFAULT_SLOW_VELOCITY,
+                 acceleration=DEFAULT_ACCELERATION, back_off=DEFAULT_BACK_OFF, home_position=None, direction=None):
+        # The homing parameters of one axis. direction is the way to the homing switch, 0 for the switch at 0
+        # and 1 for the one at axis_length, the axis's direction when None. home_position [mm] is where the
+        # axis is parked after homing, back_off away from the switch when None.
+        self.fast_velocity = fast_velocity
+        self.slow_velocity = slow_velocity
+        self.acceleration = acceleration
+        self.back_off = back_off
+        self.home_position = home_position
+        self.direction = direction
+
+    def get_values(self):
+        return {'fast_velocity': self.fast_velocity,
+                'slow_velocity': self.slow_velocity,
+                'acceleration': self.acceleration,
+                'back_off': self.back_off,
+                'home_position': self.home_position,
+                'direction': self.direction}
+
+
+def merge_schedules(schedules, min_interval=MIN_TICK_INTERVAL):
+    # This function interleaves the step schedules of several axes into one schedule of ticks.
+    # Returns (ticks, schedule), ticks[i] holds the indexes of the schedules stepped at tick i.
+    events = heapq.merge(*[[(rise, index) for rise in schedule.rise_times]
+                           for index, schedule in enumerate(schedules)])
+    times = []
+    ticks = []
+    for rise, index in events:
+        if times and rise - times[-1] < min_interval and index not in ticks[-1]:
+            ticks[-1] += (index,)
+        else:
+            times.append(rise)
+            ticks.append((index,))
+    if not times:
+        return (), StepSchedule([])
+    end = max(schedule.duration for schedule in schedules)
+    intervals = [times[i + 1] - times[i] for i in range(len(times) - 1)] + [end - times[-1]]
+    return tuple(ticks), StepSchedule(intervals)
+
+
+class Homing:
+    def __init__(self, axes, driver, settings=None):
+        # Homes several axes at once in a single timing loop: a fast accelerated approach to the switch,
+        # a back-off, a slow re-seek that latches the switch position, then an accelerated move to the home
+        # position. settings are HomingSettings per axis, the defaults when None.
+        self.axes = axes
+        self.step_timer = driver.step_timer(None)
+        self.settings = [HomingSettings() for _ in axes] if settings is None else settings
+        self.directions = [axis.direction if setting.direction is None else setting.direction
+                           for axis, setting in zip(axes, self.settings)]
+        self.stopped = False
+        self.last_report = None
+
+    def run_phase(self, moves):
+        # This function runs the moves of one homing phase together, moves are
+        # (axis, settings, direction, step_amount, velocity, start_velocity, seek). An axis that hits a switch drops out
+        # and the others carry on from their current velocity. Returns {axis: result} where the result is
+        # 'switch' (a seek reached its switch), 'done', 'not found' (a seek ran out of travel),
+        # 'blocked' (a switch stopped a move away from it) or 'stopped' (the Stop button).
+        clock = self.step_timer.clock
+        start = clock()
+        results = {}
+        pending = [[axis, setting, direction, step_amount, velocity, seek, 0, start_velocity]
+                   for axis, setting, direction, step_amount, velocity, start_velocity, seek in moves]
+
+        while pending and not self.stopped:
+            running = []
+            for move in pending:
+                axis, setting, direction, step_amount, _velocity, seek, steps, _start_velocity = move
+                axis.gpio.output(axis.direction_pin, direction)
+                axis.arm_kill_switches(direction)
+                if axis.stop or step_amount <= 0:
+                    results[axis] = self.phase_result(move, 'done', steps, clock() - start)
+                else:
+                    running.append(move)
+
+            schedules = [MotionProfile(velocity, setting.acceleration, start_velocity=start_velocity)
+                         .step_schedule(step_amount)
+                         for _axis, setting, _direction, step_amount, velocity, _seek, _steps, start_velocity
+                         in running]
+            ticks, schedule = merge_schedules(schedules)
+            tick_pins = [tuple(running[index][0].step_pin for index in tick) for tick in ticks]
+            done = [0] * len(running)
+            finish_times = [None] * len(running)
+
+            def on_tick(tick):
+                stop = False
+                for index in ticks[tick]:
+                    axis, _setting, direction = running[index][:3]
+                    axis.update_axis_status(1 / schedules[index].intervals[done[index]], direction)
+                    done[index] += 1
+                    if axis.stop:
+                        finish_times[index] = clock()
+                        stop = axis.stopped_by_kill_switch()
+                    elif done[index] == len(schedules[index]):
+                        finish_times[index] = clock()
+                return stop
+
+            if running:
+                self.step_timer.run_ticks(schedule, tick_pins, on_tick)
+
+            pending = []
+            for index, move in enumerate(running):
+                axis = move[0]
+                move[6] += done[index]
+                if axis.stop or done[index] == len(schedules[index]):
+                    finish_time = clock() if finish_times[index] is None else finish_times[index]
+                    results[axis] = self.phase_result(move, 'done', move[6], finish_time - start)
+                else:
+                    # Interrupted by another axis's switch, it goes on at the velocity it had reached
+                    move[3] -= done[index]
+                    if done[index]:
+                        move[7] = 1 / schedules[index].intervals[done[index] - 1]
+                    pending.append(move)
+            if any(result['result'] == 'stopped' for result in results.values()):
+                self.stopped = True
+
+        for move in pending:
+            results[move[0]] = {'result': 'stopped', 'steps': move[6], 'duration': clock() - start}
+        return results
+
+    @staticmethod
+    def phase_result(move, result, steps, duration):
+        axis, _setting, _direction, _step_amount, _velocity, seek, _steps, _start_velocity = move
+        if axis.stop and axis.stop_edge_time is None:
+            result = 'stopped'
+        elif axis.stop:
+            result = 'switch' if seek else 'blocked'
+        elif seek:
+            result = 'not found'
+        return {'result': result, 'steps': steps, 'duration': duration}
+
+    def home(self):
+        # This function homes all the axes, returns and keeps (last_report) the per axis phase timings
+        clock = self.step_timer.clock
+        start = clock()
+        self.stopped = False
+        axes_reports = {axis.axis_name: {'settings': setting.get_values(), 'status': 'homing', 'phases': {}}
+                        for axis, setting in zip(self.axes, self.settings)}
+        active = list(zip(self.axes, self.settings, self.directions))
+
+        def phase(name, moves, expected):
+            nonlocal active
+            results = self.run_phase(moves)
+            still_active = []
+            for axis, setting, direction in active:
+                if axis not in results:
+                    still_active.append((axis, setting, direction))
+                    continue
+                axes_reports[axis.axis_name]['phases'][name] = results[axis]
+                if results[axis]['result'] == expected:
+                    still_active.append((axis, setting, direction))
+                else:
+                    axes_reports[axis.axis_name]['status'] = f'{name}: {results[axis]["result"]}'
+            active = still_active
+
+        phase('approach', [(axis, setting, direction, round(SEEK_MARGIN * axis.axis_length / axis.step_resolution),
+                            setting.fast_velocity, 0, True) for axis, setting, direction in active], 'switch')
+        phase('back_off', [(axis, setting, 1 - direction, round(setting.back_off / axis.step_resolution),
+                            setting.fast_velocity, 0, False) for axis, setting, direction in active], 'done')
+        # The re-seek runs at the slow velocity from its first step, no ramp
+        phase('re_seek', [(axis, setting, direction, 2 * round(setting.back_off / axis.step_resolution),
+                           setting.slow_velocity, setting.slow_velocity, True) for axis, setting, direction in active],
+              'switch')
+
+        # The switch positions are latched, from here on the axes are referenced
+        moves = []
+        for axis, setting, direction in active:
+            axis.current_position = axis.axis_length if direction else 0
+            if axis.soft_limits is None:
+                axis.soft_limits = (0, axis.axis_length)
+            home_position = setting.home_position
+            if home_position is None:
+                home_position = axis.axis_length - setting.back_off if direction else setting.back_off
+            step_delta = round(home_position / axis.step_resolution) - axis.step_position
+            moves.append((axis, setting, 1 if step_delta > 0 else 0, abs(step_delta), setting.fast_velocity, 0,
+                          False))
+        phase('home', moves, 'done')
+
+        for axis, _setting, _direction in active:
+            phases = axes_reports[axis.axis_name]['phases']
+            axes_reports[axis.axis_name]['status'] = 'homed'
+            axes_reports[axis.axis_name]['duration'] = sum(result['duration'] for result in phases.values())
+        self.last_report = {'duration': clock() - start, 'axes': axes_reports}
+        get_metrics().record_homing(self.last_report)
+        return self.last_report
+
+
+def format_homing_report(report):
+    # This function returns the homing report as printable lines
+    lines = [f'Homing took {report["duration"]:.2f} [sec].']
+    for axis_name, axis_report in report['axes'].items():
+        phases = ', '.join(f'{name} {result["steps"]} steps in {result["duration"]:.2f} [sec]'
+                           for name, result in axis_report['phases'].items())
+        lines.append(f'{axis_name}: {axis_report["status"]} ({phases})')
+    return lines
+
+
+if __name__ == "__main__":
+    # Demo: three simulated axes home together from the middle of their travel, the simulated carriages
+    # press the switches at the travel ends
+    from axis_control import Axis
+    from fake_gpio import SimulatedCarriage
+    from step_drivers import get_driver
+
+    driver = get_driver('simulated')
+    axes = [Axis(axis_name='X axis', direction_pin=31, step_pin=29, kill_switch_i_pin=10, kill_switch_f_pin=11,
+                 direction='right', step_resolution=0.05, axis_length=1500, driver=driver),
+            Axis(axis_name='Y axis', direction_pin=38, step_pin=40, kill_switch_i_pin=24, kill_switch_f_pin=27,
+                 direction='down', step_resolution=0.05, axis_length=500, driver=driver),
+            Axis(axis_name='Z axis', direction_pin=8, step_pin=12, kill_switch_i_pin=23, kill_switch_f_pin=26,
+                 direction='backward', step_resolution=0.05, axis_length=2000, driver=driver)]
+    carriages = [SimulatedCarriage(driver.gpio, axis, start)
+                 for axis, start in zip(axes, (4000, 1500, 6000))]
+    homing = Homing(axes, driver, [HomingSettings(home_position=10) for _ in axes])
+    for line in format_homing_report(homing.home()):
+        print(line)
+    for axis, carriage in zip(axes, carriages):
+        print(f'{axis.axis_name}: at {axis.current_position} [mm], the carriage is at '
+              f'{carriage.position * axis.step_resolution:.2f} [mm]')
@@ -0,0 +1,216 @@
+import math
+import threading
+from metrics import get_metrics
+
+JOG_LATENCY_BUDGET = 0.02  # [sec], from a press to the first step pulse, a slower start is reported
+DEFAULT_ACCELERATION = 4000  # [steps/sec^2], for the axes without a motion profile
+PULSE_WIDTH = 10e-6  # [sec], the step pulses of several jogging axes are interleaved, so they are kept short
+NO_LIMIT = 1 << 62  # [steps], the travel asked of clip_steps() to read how far the soft limit is
+
+
+class JogAxis:
+    def __init__(self, axis):
+        # The jog state of one axis. target is the velocity [steps/sec] the loop ramps to, requested_direction
+        # the way it was asked to go. next_time is the due time of the axis's next step, None while it stands.
+        self.axis = axis
+        profile = axis.motion_profile
+        self.acceleration = DEFAULT_ACCELERATION if profile is None else profile.acceleration
+        self.max_velocity = None if profile is None else profile.max_velocity
+        # The first step is taken at the start velocity, at least the one a single step of acceleration reaches
+        start_velocity = 0.0 if profile is None else profile.start_velocity
+        self.start_velocity = max(start_velocity, math.sqrt(2 * self.acceleration))
+        self.target = 0.0
+        self.requested_direction = None
+        self.direction = None
+        self.velocity = 0.0
+        self.next_time = None
+        self.press_time = None
+        self.steps = 0
+
+    def stopping_steps(self):
+        # This function returns the steps the axis needs to ramp down from its velocity
+        return (self.velocity ** 2 - self.start_velocity ** 2) / (2 * self.acceleration)
+
+
+class Jog:
+    def __init__(self, axes, driver, latency_budget=JOG_LATENCY_BUDGET):
+        # Continuous jogging: press() starts an axis, it ramps up to the jog velocity and runs until release()
+        # ramps it down. The velocities are read by the running step loop at every step, so press(),
+        # release() and set_velocity() from the GUI steer it without starting new moves. All the jogging
+        # axes step in one loop (run()), on the motion thread, each on its own deadline.
+        # A kill switch or a stop (axis.stop, e.g. MoveQueue.stop()) stops an axis on the spot.
+        self.axes = axes
+        self.states = {id(axis): JogAxis(axis) for axis in axes}
+        self.gpio = driver.gpio
+        self.step_timer = driver.step_timer(None)
+        self.clock = self.step_timer.clock
+        self.latency_budget = latency_budget
+        self.lock = threading.Lock()
+        self.running = False
+        self.latencies = []  # [sec], press to first step of every start
+        self.last_report = None
+
+    def press(self, axis, direction, velocity):
+        # This function starts (or keeps) jogging an axis in a direction at a velocity [steps/sec].
+        # Returns True when the step loop isn't running, the caller then runs run() on its motion thread, with
+        # cancel() called if that run is dropped (MoveQueue.submit's discarded).
+        state = self.states[id(axis)]
+        with self.lock:
+            if state.target <= 0 or state.requested_direction != direction:
+                state.press_time = self.clock()
+            state.requested_direction = direction
+            state.target = velocity
+            start = not self.running
+            self.running = True
+        return start
+
+    def release(self, axis):
+        # This function ramps an axis down to a stop
+        self.states[id(axis)].target = 0.0
+
+    def set_velocity(self, velocity, axis=None):
+        # This function streams a new jog velocity [steps/sec] to the held axes (all of them when axis is None)
+        states = self.states.values() if axis is None else [self.states[id(axis)]]
+        for state in states:
+            if state.target > 0:
+                state.target = velocity
+
+    def release_all(self):
+        for state in self.states.values():
+            state.target = 0.0
+
+    def start_axis(self, state, now):
+        # This function sets an axis off in its requested direction, returns False when it can't go there
+        axis = state.axis
+        direction = state.requested_direction
+        self.gpio.output(axis.direction_pin, direction)
+        axis.arm_kill_switches(direction)
+        if axis.stop or axis.clip_steps(direction, NO_LIMIT) <= 0:
+            state.target = 0.0
+            return False
+        state.direction = direction
+        state.velocity = state.start_velocity
+        state.next_time = now
+        latency = now - state.press_time
+        self.latencies.append(latency)
+        get_metrics().record_jog(latency)
+        if latency > self.latency_budget:
+            print(f'{axis.axis_name}: the jog started {latency * 1e3:.1f} [msec] after the press, over the '
+                  f'{self.latency_budget * 1e3:.0f} [msec] budget.')
+        return True
+
+    def next_velocity(self, state):
+        # This function ramps an axis's velocity after a step, returns False when the axis stops here
+        axis = state.axis
+        target = state.target if state.requested_direction == state.direction else 0.0
+        if state.max_velocity is not None:
+            target = min(target, state.max_velocity)
+        # The soft limit is approached on a ramp down, like a release
+        remaining = axis.clip_steps(state.direction, NO_LIMIT)
+        if remaining <= 0:
+            return False
+        if remaining <= state.stopping_steps() + 1:
+            target = 0.0
+        if state.velocity < target:
+            state.velocity = min(target, math.sqrt(state.velocity ** 2 + 2 * state.acceleration))
+        elif state.velocity > target:
+            if target <= 0 and state.velocity <= state.start_velocity:
+                return False
+            state.velocity = max(target, state.start_velocity,
+                                 math.sqrt(max(state.velocity ** 2 - 2 * state.acceleration, 0.0)))
+        return True
+
+    def cancel(self):
+        # This function is called when the queued run() was dropped (a stop): the held axes are let go and the
+        # next press() queues a new run()
+        with self.lock:
+            for state in self.states.values():
+                state.target = 0.0
+            self.running = False
+
+    def run(self):
+        # This function is the jog step loop, it returns once every axis stands and none is held
+        gpio = self.gpio
+        clock = self.clock
+        wait_until = self.step_timer.wait_until
+        states = list(self.states.values())
+        for state in states:
+            state.steps = 0
+        start = clock()
+        stopped_by = []
+        try:
+            while True:
+                now = clock()
+                for state in states:
+                    if state.next_time is None and state.target > 0:
+                        self.start_axis(state, now)
+                moving = [state for state in states if state.next_time is not None]
+                if not moving:
+                    with self.lock:
+                        if not any(state.target > 0 for state in states):
+                            break
+                    continue
+
+                state = min(moving, key=lambda moving_state: moving_state.next_time)
+                axis = state.axis
+                wait_until(state.next_time)
+                gpio.output(axis.step_pin, 1)
+                wait_until(clock() + PULSE_WIDTH)
+                gpio.output(axis.step_pin, 0)
+                axis.update_axis_status(state.velocity, state.direction)
+                state.steps += 1
+                if axis.stop:
+                    axis.stopped_by_kill_switch()
+                    stopped_by.append(axis.axis_name)
+                    state.target = 0.0
+                    state.next_time = None
+                elif self.next_velocity(state):
+                    state.next_time += 1 / state.velocity
+                else:
+                    state.next_time = None
+        finally:
+            # An error leaves no axis half started and lets the next press() queue a new run()
+            with self.lock:
+                for state in states:
+                    state.next_time = None
+                self.running = False
+
+        self.last_report = {'duration': clock() - start,
+                            'steps': {state.axis.axis_name: state.steps for state in states},
+                            'stopped': stopped_by}
+        for state in states:
+            if state.steps:
+                get_metrics().increment('gantry_steps_total', (('axis', state.axis.axis_name),), state.steps)
+        return self.last_report
+
+
+if __name__ == "__main__":
+    # Demo on the simulated driver: X is held for 0.5 [sec], Y joins it, then both are released. The press to
+    # first step latencies are checked against the budget.
+    import time
+    from machine import build_machine
+    from move_queue import MoveQueue
+    from step_drivers import get_driver
+
+    driver = get_driver('simulated')
+    machine_axes, _homing = build_machine(driver)
+    x_axis, y_axis = machine_axes[:2]
+    motion_queue = MoveQueue(machine_axes, driver)
+    jog = Jog(machine_axes, driver)
+
+    for direction in (1, 0):
+        if jog.press(x_axis, direction, 2000):
+            motion_queue.submit(jog.run, discarded=jog.cancel)
+        time.sleep(0.5)
+        jog.set_velocity(3000)  # streamed to the running loop
+        if jog.press(y_axis, direction, 1000):
+            motion_queue.submit(jog.run, discarded=jog.cancel)
+        time.sleep(0.3)
+        jog.release(x_axis)
+        jog.release(y_axis)
+        motion_queue.wait()
+        print(f'Direction {direction}: {jog.last_report["steps"]} steps in {jog.last_report["duration"]:.2f} [sec], '
+              f'at {motion_queue.snapshot()["positions"]} [mm]')
+    print(f'Press to first step: {", ".join(f"{latency * 1e3:.2f}" for latency in jog.latencies)} [msec], '
+          f'budget {JOG_LATENCY_BUDGET * 1e3:.0f} [msec].')
+    motion_queue.shutdown()
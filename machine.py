@@ -0,0 +1,193 @@
+import json
+import os
+import sys
+import time
+
+CONFIG_ENVIRONMENT_VARIABLE = 'GANTRY_MACHINE_CONFIG'
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'machine.json')
+AXIS_KEYS = ('axis_name', 'direction_pin', 'step_pin', 'kill_switch_i_pin', 'kill_switch_f_pin', 'direction',
+             'step_resolution', 'axis_length')
+OPTIONAL_AXIS_KEYS = ('motion_profile', 'soft_limits', 'homing')
+
+# The modules the gantry code is made of, none of them may pull a hardware library in when it is imported
+LIBRARY_MODULES = ('GUI', 'axis_control', 'capture', 'command_client', 'command_server', 'coordinated_motion',
+                   'coordinator', 'dry_run', 'fake_gpio', 'flight_recorder', 'gantry_controller', 'gcode', 'homing',
+                   'jog', 'machine', 'metrics', 'motion_process', 'motion_profiles', 'motion_tests', 'move_queue',
+                   'plan_cache', 'scan_patterns', 'simple_motor_movement', 'step_benchmarks', 'step_drivers',
+                   'step_timing', 'telemetry', 'trajectory_planner')
+HARDWARE_MODULES = ('RPi', 'gpiozero', 'pigpio', 'cv2', 'PIL', 'numpy')
+MAX_IMPORT_TIME = 0.5  # [sec], a library module that imports slower than this fails the check
+MAX_STARTUP_TIME = 0.25  # [sec], loading the config and building the machine on the simulated driver
+
+# The machine config is a JSON file: {"driver": "rpi", "flight_recorder": {...}, "axes": [{...}, ...]}. Every axis
+# holds the keyword arguments of axis_control.Axis, a motion_profile dict (motion_profiles.MotionProfile arguments),
+# soft_limits and a homing dict (homing.HomingSettings arguments) are optional. The GANTRY_STEP_DRIVER environment
+# variable overrides the driver, so the same config runs on the simulated driver off the Pi.
+# flight_recorder holds flight_recorder.FlightRecorder arguments (path, capacity), the axes of a machine that isn't
+# simulated record to it when set.
+# metrics ({"port": ..., "host": ..., "summary": ...}) serves the metrics.py metrics over HTTP and writes their JSON
+# summary at exit, see start_metrics().
+_configs = {}
+_recorders = {}
+
+
+def config_path(path=None):
+    # This function returns the machine config path: path, the GANTRY_MACHINE_CONFIG environment variable
+    # or machine.json next to this file
+    if path is None:
+        path = os.environ.get(CONFIG_ENVIRONMENT_VARIABLE, DEFAULT_CONFIG_PATH)
+    return os.path.abspath(path)
+
+
+def load_config(path=None):
+    # This function reads and checks a machine config, it is read once per path
+    path = config_path(path)
+    if path not in _configs:
+        from axis_control import DIRECTIONS
+
+        with open(path) as config_file:
+            config = json.load(config_file)
+        axes = config.get('axes')
+        if not axes:
+            raise ValueError(f'{path}: the machine config has no axes.')
+        for index, axis_config in enumerate(axes):
+            missing = [key for key in AXIS_KEYS if key not in axis_config]
+            if missing:
+                raise ValueError(f'{path}: axis {index} has no {", ".join(missing)}.')
+            unknown = [key for key in axis_config if key not in AXIS_KEYS + OPTIONAL_AXIS_KEYS]
+            if unknown:
+                raise ValueError(f'{path}: axis {index} has unknown keys {", ".join(unknown)}.')
+            if axis_config['direction'] not in DIRECTIONS:
+                raise ValueError(f'{path}: axis {index} direction {axis_config["direction"]} is not one of '
+                                 f'{", ".join(DIRECTIONS)}.')
+        _configs[path] = config
+    return _configs[path]
+
+
+def axis_configs(config=None):
+    # This function returns the axes of a machine config (the default one when None) as axis_control.Axis
+    # keyword arguments plus a motion_profile dict, the form motion_process.MotionProcessClient takes
+    config = load_config() if config is None else config
+    return [{key: value for key, value in axis_config.items() if key != 'homing'} for axis_config in config['axes']]
+
+
+def driver_name(config=None):
+    config = load_config() if config is None else config
+    from step_drivers import DRIVER_ENVIRONMENT_VARIABLE
+
+    return os.environ.get(DRIVER_ENVIRONMENT_VARIABLE) or config.get('driver')
+
+
+def build_machine(driver=None, config=None):
+    # This function returns the machine's axes and their homing. The step driver is the config's one when
+    # None, the hardware libraries are imported only now, by the driver.
+    from axis_control import Axis
+    from homing import Homing, HomingSettings
+    from motion_profiles import MotionProfile
+    from step_drivers import get_driver
+
+    config = load_config() if config is None else config
+    driver = get_driver(driver_name(config)) if driver is None else driver
+    axes = []
+    for axis_config in axis_configs(config):
+        axis_config = dict(axis_config)
+        profile = axis_config.pop('motion_profile', None)
+        axes.append(Axis(**axis_config, driver=driver,
+                         motion_profile=None if profile is None else MotionProfile(**profile)))
+    # A simulated machine or a dry run leaves the machine's recording alone
+    recorder = None if driver.simulated else flight_recorder(config)
+    if recorder is not None:
+        for index, axis in enumerate(axes):
+            axis.attach_flight_recorder(recorder, index)
+    settings = [HomingSettings(**axis_config.get('homing', {})) for axis_config in config['axes']]
+    return axes, Homing(axes, driver, settings)
+
+
+def flight_recorder(config=None):
+    # This function returns the flight recorder of a machine config, one per recording file, None when the config
+    # has none
+    from flight_recorder import FlightRecorder, recording_path
+
+    config = load_config() if config is None else config
+    arguments = config.get('flight_recorder')
+    if arguments is None:
+        return None
+    path = recording_path(arguments.get('path'))
+    if path not in _recorders:
+        _recorders[path] = FlightRecorder(**dict(arguments, path=path))
+    return _recorders[path]
+
+
+def start_metrics(config=None):
+    # This function starts the metrics exporter and the summary at exit of a machine config, returns the
+    # exporter's HTTP server, None when the config has no metrics
+    from metrics import DEFAULT_HOST, DEFAULT_PORT, DEFAULT_SUMMARY_PATH, start_exporter, write_summary_at_exit
+
+    config = load_config() if config is None else config
+    arguments = config.get('metrics')
+    if arguments is None:
+        return None
+    write_summary_at_exit(path=arguments.get('summary') or DEFAULT_SUMMARY_PATH)
+    port = arguments.get('port', DEFAULT_PORT)
+    try:
+        return start_exporter(port=port, host=arguments.get('host', DEFAULT_HOST))
+    except OSError as error:
+        # e.g. another process of the machine serves the port already, its summary is still written
+        print(f'The metrics exporter could not listen on port {port}: {error}')
+        return None
+
+
+def import_time(module, runs=5):
+    # This function returns the best time [sec] of importing a module in a fresh interpreter, and the
+    # hardware libraries the import pulled in
+    import subprocess
+
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            f'import {module}\n'
+            'print(time.perf_counter() - start)\n'
+            f'print(",".join(sorted(name for name in {HARDWARE_MODULES!r} if name in sys.modules)))\n')
+    best = None
+    loaded = ''
+    for _run in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split('\n')
+        best = float(output[0]) if best is None else min(best, float(output[0]))
+        loaded = output[1]
+    return best, [name for name in loaded.split(',') if name]
+
+
+def startup_time(name='simulated'):
+    # This function returns how long loading the config and building the machine on a step driver takes [sec]
+    from step_drivers import get_driver
+
+    start = time.perf_counter()
+    _configs.clear()
+    axes, _homing = build_machine(get_driver(name))
+    return time.perf_counter() - start, axes
+
+
+if __name__ == "__main__":
+    # Check: every library module imports fast without a hardware library, and the machine starts on the
+    # simulated driver of a plain Linux box
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measures the import and startup times of the gantry code.')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per module, the best one counts')
+    parser.add_argument('--max-import-time', type=float, default=MAX_IMPORT_TIME,
+                        help='[sec], a slower import fails the check')
+    arguments = parser.parse_args()
+
+    failures = []
+    for name in LIBRARY_MODULES:
+        seconds, hardware = import_time(name, arguments.runs)
+        print(f'import {name}: {seconds * 1e3:.1f} [msec]' + (f', pulled in {", ".join(hardware)}' if hardware else ''))
+        if hardware or seconds > arguments.max_import_time:
+            failures.append(name)
+    seconds, machine_axes = startup_time()
+    print(f'Machine startup on the simulated driver: {seconds * 1e3:.1f} [msec], '
+          f'{", ".join(axis.axis_name for axis in machine_axes)}.')
+    if seconds > MAX_STARTUP_TIME:
+        failures.append('the machine startup')
+    if failures:
+        raise SystemExit(f'Slow or hardware bound: {", ".join(failures)}.')
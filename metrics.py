@@ -0,0 +1,331 @@
+import atexit
+import os
+import sys
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 9105
+DEFAULT_SUMMARY_PATH = os.path.join(tempfile.gettempdir(), 'gantry_metrics.json')
+SAMPLING_INTERVAL = 0.001  # [sec], how often the sampling profiler reads the job's stack
+PROFILE_MODES = ('cprofile', 'sampling')
+
+# The histograms' bucket upper bounds, the last bucket (+Inf) is implied
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300)  # [sec]
+PLANNING_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 1)  # [sec]
+LATENCY_BUCKETS = (1e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 5e-3, 0.01)  # [sec]
+HOMING_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120)  # [sec]
+VELOCITY_RATIO_BUCKETS = (0.5, 0.8, 0.9, 0.95, 0.98, 0.99, 0.995, 1.0, 1.01)  # achieved / commanded step rate
+
+# name: (type, help), the label names are given where the metrics are recorded
+METRICS = {'gantry_moves_total': ('counter', 'Moves run, by source.'),
+           'gantry_moves_stopped_total': ('counter', 'Moves cut short by a kill switch or a stop, by source.'),
+           'gantry_steps_total': ('counter', 'Steps emitted, by axis.'),
+           'gantry_move_duration_seconds': ('histogram', 'Duration of the moves, by source.'),
+           'gantry_move_velocity_ratio': ('histogram', 'Achieved over commanded step rate of the moves, by source.'),
+           'gantry_planning_seconds': ('histogram', 'Time spent planning a move or a path, by source.'),
+           'gantry_homing_seconds': ('histogram', 'Duration of the homing runs.'),
+           'gantry_homings_total': ('counter', 'Axes homed, by axis and status.'),
+           'gantry_kill_switch_trips_total': ('counter', 'Kill switch stops, homing seeks included, by axis.'),
+           'gantry_kill_switch_latency_seconds': ('histogram', 'Kill switch edge to last pulse, by axis.'),
+           'gantry_commands_total': ('counter', 'Commands received, by source and command.'),
+           'gantry_jogs_total': ('counter', 'Continuous jogs started.'),
+           'gantry_jog_latency_seconds': ('histogram', 'Jog press to first step pulse.'),
+           'gantry_uptime_seconds': ('gauge', 'Time since the metrics were started.')}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        # Cumulative on export only, an observation is one bucket increment
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        counts = []
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class MotionMetrics:
+    def __init__(self, clock=time.time):
+        # Counters and histograms of the machine's moves, homing runs, kill switch trips and commands.
+        # They are recorded once per move (never per step), a record is a few dict updates under a lock.
+        self.clock = clock
+        self.started = clock()
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels): value, labels are ((label, value), ...)
+        self.histograms = {}  # (name, labels): Histogram
+
+    def increment(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, buckets, value, labels=()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def record_move(self, source, report, axis_steps, stopped=False):
+        # This function records a move from its step timer report, axis_steps are (axis name, steps) and
+        # stopped tells a move that was cut short
+        labels = (('source', source),)
+        self.increment('gantry_moves_total', labels)
+        if stopped:
+            self.increment('gantry_moves_stopped_total', labels)
+        self.observe('gantry_move_duration_seconds', DURATION_BUCKETS, report['duration'], labels)
+        if report['commanded_rate']:
+            self.observe('gantry_move_velocity_ratio', VELOCITY_RATIO_BUCKETS,
+                         report['achieved_rate'] / report['commanded_rate'], labels)
+        for axis_name, steps in axis_steps:
+            if steps:
+                self.increment('gantry_steps_total', (('axis', axis_name),), steps)
+
+    def record_planning(self, source, duration):
+        self.observe('gantry_planning_seconds', PLANNING_BUCKETS, duration, (('source', source),))
+
+    def record_homing(self, report):
+        # This function records a homing.Homing report
+        self.observe('gantry_homing_seconds', HOMING_BUCKETS, report['duration'])
+        for axis_name, axis_report in report['axes'].items():
+            self.increment('gantry_homings_total', (('axis', axis_name), ('status', axis_report['status'])))
+
+    def record_kill_switch(self, axis_name, latency):
+        labels = (('axis', axis_name),)
+        self.increment('gantry_kill_switch_trips_total', labels)
+        self.observe('gantry_kill_switch_latency_seconds', LATENCY_BUCKETS, latency, labels)
+
+    def record_jog(self, latency):
+        self.increment('gantry_jogs_total')
+        self.observe('gantry_jog_latency_seconds', LATENCY_BUCKETS, latency)
+
+    def record_command(self, source, command):
+        self.increment('gantry_commands_total', (('source', source), ('command', command)))
+
+    def prometheus_text(self):
+        # This function returns the metrics in the Prometheus text exposition format
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            lines = []
+            written = set()
+
+            def header(name):
+                if name not in written:
+                    written.add(name)
+                    metric_type, description = METRICS[name]
+                    lines.append(f'# HELP {name} {description}')
+                    lines.append(f'# TYPE {name} {metric_type}')
+
+            for (name, labels), value in counters:
+                header(name)
+                lines.append(f'{name}{format_labels(labels)} {value}')
+            for (name, labels), histogram in histograms:
+                header(name)
+                bounds = [f'{bound:g}' for bound in histogram.buckets] + ['+Inf']
+                for bound, count in zip(bounds, histogram.cumulative_counts()):
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum:.9g}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        header('gantry_uptime_seconds')
+        lines.append(f'gantry_uptime_seconds {self.clock() - self.started:.3f}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # This function returns the metrics as a JSON ready dict, with the moves per hour since the start
+        uptime = self.clock() - self.started
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                           'mean': histogram.sum / histogram.count if histogram.count else None,
+                           'buckets': dict(zip([f'{bound:g}' for bound in histogram.buckets] + ['+Inf'],
+                                               histogram.cumulative_counts()))}
+                          for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])]
+        moves = sum(counter['value'] for counter in counters if counter['name'] == 'gantry_moves_total')
+        return {'started': self.started,
+                'uptime': uptime,
+                'moves': moves,
+                'moves_per_hour': moves / uptime * 3600 if uptime > 0 else None,
+                'counters': counters,
+                'histograms': histograms}
+
+    def write_summary(self, path=DEFAULT_SUMMARY_PATH):
+        import json
+
+        with open(path, 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+_metrics = MotionMetrics()
+
+
+def get_metrics():
+    # This function returns the shared metrics of the process, the axes, moves and homing record to it
+    return _metrics
+
+
+def start_exporter(metrics=None, port=DEFAULT_PORT, host=DEFAULT_HOST):
+    # This function serves the metrics at http://host:port/metrics from a daemon thread, returns the server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    metrics = get_metrics() if metrics is None else metrics
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_summary_at_exit(metrics=None, path=DEFAULT_SUMMARY_PATH):
+    # This function dumps the metrics to a JSON file when the process exits
+    metrics = get_metrics() if metrics is None else metrics
+    atexit.register(metrics.write_summary, path)
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id=None, interval=SAMPLING_INTERVAL):
+        # Reads the stack of a thread (the calling one by default) every interval from a daemon thread.
+        # The job runs at full speed between the samples, unlike under cProfile.
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.stacks = {}  # 'module:function;...' (outermost first): samples
+        self.samples = 0
+        self.running = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.thread.join()
+
+    def top(self, amount=20):
+        # This function returns the functions the job spent most samples in, (share, samples, function)
+        own = {}
+        for stack, samples in self.stacks.items():
+            function = stack.rsplit(';', 1)[-1]
+            own[function] = own.get(function, 0) + samples
+        ranked = sorted(own.items(), key=lambda item: -item[1])[:amount]
+        return [(samples / self.samples, samples, function) for function, samples in ranked]
+
+    def write_collapsed(self, path):
+        # This function writes the samples as collapsed stacks, the input of flamegraph.pl and speedscope
+        with open(path, 'w') as stacks_file:
+            for stack, samples in sorted(self.stacks.items()):
+                stacks_file.write(f'{stack} {samples}\n')
+
+
+@contextmanager
+def profiled(mode, output=None):
+    # This context manager profiles the code it wraps, e.g. a single job. mode is 'cprofile' (every call,
+    # output is a .prof file for pstats / snakeviz) or 'sampling' (output is a collapsed stacks file),
+    # None does nothing. Without an output the top functions are printed.
+    if mode is None:
+        yield
+        return
+    if mode not in PROFILE_MODES:
+        raise ValueError(f'Unknown profiler {mode}, choose one of {", ".join(PROFILE_MODES)}.')
+    if mode == 'cprofile':
+        import cProfile
+        import pstats
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            if output:
+                profile.dump_stats(output)
+            else:
+                pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+        return
+
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        if output:
+            profiler.write_collapsed(output)
+        else:
+            print(f'{profiler.samples} samples:')
+            for share, samples, function in profiler.top():
+                print(f'{share * 100:5.1f}% {samples:6d} {function}')
+
+
+if __name__ == "__main__":
+    # Demo: a dry run of a short job with the exporter up, then the Prometheus text it serves. The job's last
+    # move runs X into its switch at 0.
+    import urllib.request
+    from dry_run import dry_run
+    from gcode import interpret, parse
+    from metrics import get_metrics, profiled, start_exporter  # the instance the axes record to, not __main__'s
+
+    exporter = start_exporter(port=0)
+    job = ['G28', 'G90 G1 F3000 X100 Y50 Z20', 'G1 X200 Y10', 'G0 X5 Y5 Z5', 'G1 X-50']
+    with profiled('sampling'):
+        report = dry_run(interpret(parse(job)), carriages=(300, 100, 400))
+    print(f'Job {report["status"]} in {report["duration"]:.2f} [sec] of machine time.')
+    url = f'http://{DEFAULT_HOST}:{exporter.server_address[1]}/metrics'
+    with urllib.request.urlopen(url) as response:
+        text = response.read().decode()
+    print('\n'.join(line for line in text.splitlines() if not line.startswith('#') and '_bucket' not in line))
+    get_metrics().write_summary()
+    print(f'Summary written to {DEFAULT_SUMMARY_PATH}.')
+    exporter.shutdown()
@@ -0,0 +1,189 @@
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+# Shared memory layout: a header, then one record per axis. Readers unpack it in place, nothing is pickled.
+# The writer bumps the sequence number before and after every update (odd while writing), readers retry
+# until they see the same even number on both sides.
+HEADER_FORMAT = 'QBBxxxxxxQ'  # sequence, busy, stop request, completed commands
+AXIS_FORMAT = 'qddBxxxxxxx'  # step_counter, current_position, velocity, stop
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+AXIS_SIZE = struct.calcsize(AXIS_FORMAT)
+PUBLISH_INTERVAL = 0.005  # [sec]
+DEFAULT_REALTIME_PRIORITY = 50
+
+
+class SharedMotionState:
+    def __init__(self, axes_amount, name=None):
+        # The motion state block, created by the client (name=None) and attached to by the motion process
+        self.axes_amount = axes_amount
+        size = HEADER_SIZE + axes_amount * AXIS_SIZE
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.memory.buf[:size] = bytes(size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.sequence = 0
+
+    def publish(self, axes, busy, completed):
+        # This function writes the axes state, only the motion process calls it
+        buffer = self.memory.buf
+        self.sequence += 1
+        struct.pack_into('Q', buffer, 0, self.sequence)
+        for index, axis in enumerate(axes):
+            struct.pack_into(AXIS_FORMAT, buffer, HEADER_SIZE + index * AXIS_SIZE, axis.step_counter,
+                             axis.current_position, axis.velocity, int(bool(axis.stop)))
+        struct.pack_into('B', buffer, 8, int(busy))
+        struct.pack_into('Q', buffer, 16, completed)
+        self.sequence += 1
+        struct.pack_into('Q', buffer, 0, self.sequence)
+
+    def read(self):
+        # This function returns a consistent copy of the state
+        buffer = self.memory.buf
+        while True:
+            before = struct.unpack_from('Q', buffer, 0)[0]
+            if before % 2:
+                continue
+            sequence, busy, stop_request, completed = struct.unpack_from(HEADER_FORMAT, buffer, 0)
+            axes = [struct.unpack_from(AXIS_FORMAT, buffer, HEADER_SIZE + index * AXIS_SIZE)
+                    for index in range(self.axes_amount)]
+            if struct.unpack_from('Q', buffer, 0)[0] == before:
+                break
+        return {'busy': bool(busy),
+                'completed': completed,
+                'axes': [{'step_counter': step_counter, 'current_position': current_position,
+                          'velocity': velocity, 'stop': stop}
+                         for step_counter, current_position, velocity, stop in axes]}
+
+    def request_stop(self, value=1):
+        struct.pack_into('B', self.memory.buf, 9, value)
+
+    def stop_requested(self):
+        return struct.unpack_from('B', self.memory.buf, 9)[0]
+
+    def close(self, unlink=False):
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def isolate_process(cpu, realtime, priority=DEFAULT_REALTIME_PRIORITY):
+    # This function pins the process to a dedicated core and optionally makes it SCHED_FIFO (needs root)
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {cpu})
+    if realtime and hasattr(os, 'sched_setscheduler'):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except PermissionError:
+            print('Motion process: no permission for SCHED_FIFO, running with the default scheduler.')
+
+
+def motion_process_main(axis_configs, driver_name, connection, state_name, cpu, realtime):
+    # The motion controller process, it owns the axes and runs the commands received over the pipe
+    from axis_control import Axis
+    from motion_profiles import MotionProfile
+    from move_queue import MoveQueue
+    from step_drivers import get_driver
+
+    isolate_process(cpu, realtime)
+    driver = get_driver(driver_name)
+    axes = []
+    for config in axis_configs:
+        config = dict(config)
+        profile = config.pop('motion_profile', None)
+        axes.append(Axis(**config, driver=driver,
+                         motion_profile=None if profile is None else MotionProfile(**profile)))
+    # The commands run through a move queue, the next move is planned while the current one runs
+    move_queue = MoveQueue(axes, driver)
+    state = SharedMotionState(len(axes), name=state_name)
+
+    running = True
+    failed = 0  # commands that never reached the queue, they count as completed
+
+    def publisher():
+        # Copies the axes state to the shared memory at a fixed rate and passes the client's stop requests on
+        while running:
+            if state.stop_requested():
+                state.request_stop(0)
+                move_queue.stop()
+            state.publish(axes, move_queue.pending > 0, move_queue.completed + failed)
+            time.sleep(PUBLISH_INTERVAL)
+
+    publisher_thread = threading.Thread(target=publisher, daemon=True)
+    publisher_thread.start()
+
+    while running:
+        command = connection.recv()
+        kind = command[0]
+        try:
+            if kind == 'axis':
+                _kind, index, method, args = command
+                move_queue.submit(getattr(axes[index], method), *args)
+            elif kind == 'move':
+                _kind, legs, feed_rate = command
+                move_queue.put_legs([(axes[index], direction, steps) for index, direction, steps in legs], feed_rate)
+            elif kind == 'shutdown':
+                move_queue.wait()
+                running = False
+        except Exception as error:
+            failed += 1
+            print(f'Motion process: command {command} failed: {error}')
+
+    publisher_thread.join()
+    move_queue.shutdown()
+    state.publish(axes, False, move_queue.completed + failed)
+    state.close()
+    driver.cleanup()
+
+
+class MotionProcessClient:
+    def __init__(self, axis_configs, driver_name=None, cpu=None, realtime=False):
+        # Starts the motion controller process and talks to it. axis_configs are axis_control.Axis keyword
+        # arguments (plus an optional motion_profile dict), cpu is the core the process is pinned to.
+        # Commands go over a pipe, the state is read from shared memory without pickling.
+        if cpu is None and hasattr(os, 'sched_getaffinity'):
+            cpu = max(os.sched_getaffinity(0))
+        self.axes_amount = len(axis_configs)
+        self.state = SharedMotionState(self.axes_amount)
+        self.submitted = 0
+
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=motion_process_main, daemon=True,
+                                       args=(axis_configs, driver_name, child_connection, self.state.name, cpu,
+                                             realtime))
+        self.process.start()
+
+    def send(self, command):
+        self.submitted += 1
+        self.connection.send(command)
+
+    def axis_call(self, index, method, *args):
+        # This function runs an Axis method in the motion process, e.g. axis_call(0, 'axis_for_loop', 500, 1, 1000)
+        self.send(('axis', index, method, args))
+
+    def move(self, legs, feed_rate):
+        # This function runs a coordinated linear move, legs are (axis index, direction, step_amount)
+        self.send(('move', legs, feed_rate))
+
+    def stop(self):
+        # This function stops the running move and drops the queued commands
+        self.state.request_stop()
+
+    def read_state(self):
+        return self.state.read()
+
+    def wait(self, poll_interval=0.01):
+        # This function blocks until every submitted command is done
+        while self.state.read()['completed'] < self.submitted:
+            time.sleep(poll_interval)
+
+    def shutdown(self):
+        self.send(('shutdown',))
+        self.process.join()
+        self.state.close(unlink=True)
@@ -0,0 +1,168 @@
+import math
+from functools import lru_cache
+from step_timing import StepSchedule
+
+# All the profile values are in the motor's units: [steps/sec], [steps/sec^2] and [steps/sec^3]
+PROFILE_CACHE_SIZE = 256
+
+
+def _ramp_phases(start_velocity, peak_velocity, acceleration, jerk):
+    # This function returns the (duration, jerk, initial acceleration) phases of an acceleration ramp.
+    # Without a jerk limit the ramp is a single constant acceleration phase (trapezoidal profile).
+    delta = peak_velocity - start_velocity
+    if delta <= 0:
+        return []
+    if not jerk:
+        return [(delta / acceleration, 0.0, acceleration)]
+
+    if delta >= acceleration ** 2 / jerk:
+        peak_acceleration = acceleration
+        constant_time = delta / acceleration - acceleration / jerk
+    else:
+        peak_acceleration = math.sqrt(jerk * delta)
+        constant_time = 0.0
+    jerk_time = peak_acceleration / jerk
+    return [(jerk_time, jerk, 0.0), (constant_time, 0.0, peak_acceleration), (jerk_time, -jerk, peak_acceleration)]
+
+
+def _ramp_knots(start_velocity, phases):
+    # This function integrates the ramp phases, returns (time, position, velocity, acceleration, jerk) per phase start
+    knots = []
+    t, s, v = 0.0, 0.0, start_velocity
+    for duration, jerk, acceleration in phases:
+        knots.append((t, s, v, acceleration, jerk, duration))
+        s += v * duration + acceleration * duration ** 2 / 2 + jerk * duration ** 3 / 6
+        v += acceleration * duration + jerk * duration ** 2 / 2
+        t += duration
+    return knots, t, s
+
+
+def _ramp_time_at(knots, position):
+    # This function inverts the ramp's position(time) at a given position [steps], position is monotonic
+    for t0, s0, v0, a0, j0, duration in reversed(knots):
+        if position >= s0:
+            break
+    if j0 == 0:
+        if a0 == 0:
+            return t0 + (position - s0) / v0
+        return t0 + (-v0 + math.sqrt(max(v0 ** 2 + 2 * a0 * (position - s0), 0.0))) / a0
+
+    low, high = 0.0, duration
+    for _ in range(60):
+        mid = (low + high) / 2
+        if s0 + v0 * mid + a0 * mid ** 2 / 2 + j0 * mid ** 3 / 6 < position:
+            low = mid
+        else:
+            high = mid
+    return t0 + (low + high) / 2
+
+
+def _ramp_distance(start_velocity, peak_velocity, acceleration, jerk):
+    return _ramp_knots(start_velocity, _ramp_phases(start_velocity, peak_velocity, acceleration, jerk))[2]
+
+
+@lru_cache(maxsize=PROFILE_CACHE_SIZE)
+def build_step_intervals(step_amount, max_velocity, acceleration, jerk=None, start_velocity=0.0):
+    # This function returns the step intervals [sec] of a symmetric accelerate - cruise - decelerate move.
+    # jerk=None gives a trapezoidal profile, a jerk value gives an S-curve profile.
+    # Tables are cached by (distance, profile parameters), so repeated moves cost nothing to plan.
+    if step_amount <= 0:
+        return ()
+    start_velocity = min(start_velocity, max_velocity)
+
+    # Short moves can't reach the max velocity, find the highest peak whose ramps fit in half the move
+    peak_velocity = max_velocity
+    if 2 * _ramp_distance(start_velocity, peak_velocity, acceleration, jerk) > step_amount:
+        low, high = start_velocity, max_velocity
+        for _ in range(50):
+            mid = (low + high) / 2
+            if 2 * _ramp_distance(start_velocity, mid, acceleration, jerk) > step_amount:
+                high = mid
+            else:
+                low = mid
+        peak_velocity = low
+
+    knots, ramp_time, ramp_distance = _ramp_knots(start_velocity,
+                                                  _ramp_phases(start_velocity, peak_velocity, acceleration, jerk))
+    if not knots:
+        if start_velocity <= 0:
+            raise ValueError('A move needs a positive max velocity or start velocity.')
+        knots, ramp_time, ramp_distance = [(0.0, 0.0, start_velocity, 0.0, 0.0, math.inf)], 0.0, 0.0
+
+    cruise_time = (step_amount - 2 * ramp_distance) / peak_velocity
+    total_time = 2 * ramp_time + cruise_time
+
+    def time_at(position):
+        if position <= ramp_distance:
+            return _ramp_time_at(knots, position)
+        if position <= step_amount - ramp_distance:
+            return ramp_time + (position - ramp_distance) / peak_velocity
+        return total_time - _ramp_time_at(knots, step_amount - position)
+
+    times = [time_at(position) for position in range(step_amount + 1)]
+    return tuple(times[i + 1] - times[i] for i in range(step_amount))
+
+
+@lru_cache(maxsize=PROFILE_CACHE_SIZE)
+def build_step_schedule(step_amount, max_velocity, acceleration, jerk=None, start_velocity=0.0):
+    # This function returns the cached pulse schedule of a move, see build_step_intervals
+    return StepSchedule(build_step_intervals(step_amount, max_velocity, acceleration, jerk, start_velocity))
+
+
+class MotionProfile:
+    def __init__(self, max_velocity, acceleration, jerk=None, start_velocity=0.0):
+        # A per axis motion profile, trapezoidal when jerk is None and S-curve (jerk limited) otherwise
+        self.max_velocity = max_velocity  # [steps/sec]
+        self.acceleration = acceleration  # [steps/sec^2]
+        self.jerk = jerk  # [steps/sec^3]
+        self.start_velocity = start_velocity  # [steps/sec], a velocity the motor can start at without ramping
+
+    def cache_key(self, step_amount, max_velocity=None):
+        # This function returns the (distance, profile parameters) key the tables are cached by.
+        # max_velocity overrides the profile's, it is clipped to it.
+        if max_velocity is None or max_velocity > self.max_velocity:
+            max_velocity = self.max_velocity
+        return (int(step_amount), float(max_velocity), float(self.acceleration),
+                None if self.jerk is None else float(self.jerk), float(self.start_velocity))
+
+    def step_intervals(self, step_amount, max_velocity=None):
+        # This function returns the cached step interval table of a move
+        return build_step_intervals(*self.cache_key(step_amount, max_velocity))
+
+    def step_schedule(self, step_amount, max_velocity=None):
+        # This function returns the cached pulse schedule of a move
+        return build_step_schedule(*self.cache_key(step_amount, max_velocity))
+
+    def move_time(self, step_amount, max_velocity=None):
+        # This function returns the planned duration of a move [sec]
+        return sum(self.step_intervals(step_amount, max_velocity))
+
+    def get_values(self):
+        return {'max_velocity': self.max_velocity,
+                'acceleration': self.acceleration,
+                'jerk': self.jerk,
+                'start_velocity': self.start_velocity}
+
+
+def profile_cache_info():
+    # This function returns the interval tables and schedules cache statistics
+    return {'intervals': build_step_intervals.cache_info(), 'schedules': build_step_schedule.cache_info()}
+
+
+if __name__ == "__main__":
+    import time
+
+    step_amount = 20000  # 1000 [mm] at 0.05 [mm/step]
+    constant = step_amount / 1000
+    print(f'Constant 1000 [steps/sec]: {constant:.2f} [sec]')
+    for name, profile in (('Trapezoidal', MotionProfile(4000, 8000)),
+                          ('S-curve', MotionProfile(4000, 8000, jerk=40000))):
+        start = time.perf_counter()
+        profile.step_schedule(step_amount)
+        planning = time.perf_counter() - start
+        start = time.perf_counter()
+        profile.step_schedule(step_amount)
+        cached = time.perf_counter() - start
+        print(f'{name} 4000 [steps/sec]: {profile.move_time(step_amount):.2f} [sec], planned in {planning * 1e3:.1f} '
+              f'[msec], cached in {cached * 1e6:.1f} [usec]')
+    print(profile_cache_info())
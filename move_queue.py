@@ -0,0 +1,323 @@
+import queue
+import threading
+import time
+from coordinated_motion import CoordinatedMotion, feed_rate_for_velocities
+
+DEFAULT_DEPTH = 2  # planned moves held ready, a double buffer: the next move waits while the current one runs
+DEFAULT_TARGETS = 256  # targets waiting for the planner, put() blocks when they are full
+DEFAULT_VELOCITY = 1000  # [steps/sec], for the axes without a motion profile
+STOP_POLL_INTERVAL = 0.005  # [sec], how often a stop asserts axis.stop until the running move is out
+
+
+class MoveQueue:
+    def __init__(self, axes, driver, depth=DEFAULT_DEPTH, targets=DEFAULT_TARGETS, clock=None):
+        # A bounded move pipeline on two threads. The planner thread turns the queued targets into
+        # coordinated_motion.PlannedMove step schedules, up to depth moves ahead of the executor thread, which
+        # runs them. A move that is ready when the one before it ends starts on that move's end deadline, so
+        # back to back moves have no gap between them.
+        # The functions given to submit() run on the executor thread in their turn. They are barriers, the
+        # planner waits for them before it plans on, since they may move the axes (homing, free moves).
+        # clock is the driver's one when None, the moves are chained on it.
+        self.axes = axes
+        self.coordinated_motion = CoordinatedMotion(driver)
+        self.clock = driver.clock if clock is None else clock
+        self.targets = queue.Queue(maxsize=targets)
+        self.ready = queue.Queue(maxsize=depth)
+        self.lock = threading.Lock()  # held by the planner while it plans and by a stop while it discards
+        self.idle = threading.Condition()
+        self.barrier_done = threading.Event()
+        self.generation = 0  # bumped by every stop and abort, the work queued before it is dropped
+        self.planned_steps = [axis.step_position for axis in axes]  # where the planned moves leave the axes
+        self.previous_end = None  # the end deadline of the last move, the next move chains to it
+        self.pending = 0  # work submitted and not done yet
+        self.completed = 0  # work done (or dropped) so far
+        self.busy = False
+        self.last_error = None
+
+        self.moves = 0
+        self.dropped = 0
+        self.starvations = 0  # the executor was done and the next move wasn't planned yet
+        self.gap_count = 0
+        self.gap_total = 0.0
+        self.gap_max = 0.0
+        self.max_depth = 0
+        self.planning_time = 0.0
+
+        self.planner = threading.Thread(target=self.plan_loop, daemon=True)
+        self.executor = threading.Thread(target=self.execute_loop, daemon=True)
+        self.planner.start()
+        self.executor.start()
+
+    def add(self, item, block=True, timeout=None):
+        with self.idle:
+            self.pending += 1
+        try:
+            self.targets.put((self.generation,) + item, block, timeout)
+        except queue.Full:
+            self.finish_item()
+            raise
+
+    def put(self, position, feed_rate=None, velocities=None, block=True, timeout=None):
+        # This function queues a straight move to a position [mm] (None keeps an axis where it is) at a feed rate
+        # along the path [mm/sec]. When feed_rate is None the fastest one that keeps every axis under its
+        # velocity [steps/sec] is used, velocities are per axis, the motion profiles' max velocities when None.
+        # It blocks while the queue is full, queue.Full is raised when block is False or timeout runs out.
+        self.add(('position', tuple(position), feed_rate, velocities), block, timeout)
+
+    def put_legs(self, legs, feed_rate, block=True, timeout=None):
+        # This function queues a relative move, legs are (axis, direction, step_amount)
+        self.add(('legs', tuple(legs), feed_rate, None), block, timeout)
+
+    def submit(self, function, *args, discarded=None):
+        # This function queues a call on the executor thread, after the moves queued before it. discarded is
+        # called (on the thread that drops it) when a stop or an abort drops the call before it runs.
+        self.add(('call', function, args, discarded))
+
+    def drop(self, kind, work):
+        # This function counts a dropped item, and tells a dropped call's owner
+        self.dropped += 1
+        if kind == 'call' and work[2] is not None:
+            work[2]()
+
+    def finish_item(self):
+        with self.idle:
+            self.pending -= 1
+            self.completed += 1
+            self.idle.notify_all()
+
+    def position_legs(self, position, velocities):
+        # This function returns the legs to a position [mm] from where the planned moves leave the axes
+        legs = []
+        leg_velocities = []
+        for index, (value, axis) in enumerate(zip(position, self.axes)):
+            if value is None:
+                continue
+            step_delta = round(value / axis.step_resolution) - self.planned_steps[index]
+            if step_delta == 0:
+                continue
+            legs.append((axis, 1 if step_delta > 0 else 0, abs(step_delta)))
+            if velocities is not None:
+                leg_velocities.append(velocities[index])
+            elif axis.motion_profile is None:
+                leg_velocities.append(DEFAULT_VELOCITY)
+            else:
+                leg_velocities.append(axis.motion_profile.max_velocity)
+        return legs, leg_velocities
+
+    def plan_move(self, kind, target, feed_rate, velocities):
+        # This function plans one move from the planned position, and moves the planned position to its end
+        if kind == 'position':
+            legs, velocities = self.position_legs(target, velocities)
+        else:
+            legs = [leg for leg in target if leg[2] > 0]
+        if not legs:
+            return None
+        if feed_rate is None:
+            feed_rate = feed_rate_for_velocities(legs, velocities)
+        indexes = {id(axis): index for index, axis in enumerate(self.axes)}
+        planned_move = self.coordinated_motion.plan(legs, feed_rate, [self.planned_steps[indexes[id(axis)]]
+                                                                      for axis, _direction, _step_amount in legs])
+        if planned_move is not None:
+            for axis, direction, step_amount in planned_move.legs:
+                self.planned_steps[indexes[id(axis)]] += step_amount if direction == 1 else -step_amount
+        return planned_move
+
+    def plan_loop(self):
+        while True:
+            item = self.targets.get()
+            if item is None:
+                self.ready.put(None)
+                break
+            generation, kind = item[:2]
+            with self.lock:
+                if generation != self.generation:
+                    self.drop(kind, item[2:])
+                    self.finish_item()
+                    continue
+                if kind == 'call':
+                    self.barrier_done.clear()
+                    work = item[2:]
+                else:
+                    start = self.clock()
+                    try:
+                        work = self.plan_move(kind, *item[2:])
+                    except Exception as error:
+                        self.last_error = error
+                        print(f'Planning a move failed: {error}')
+                        work = None
+                    self.planning_time += self.clock() - start
+                    if work is None:
+                        self.finish_item()
+                        continue
+
+            self.ready.put((generation, kind, work))
+            self.max_depth = max(self.max_depth, self.ready.qsize())
+            if kind == 'call':
+                # The call may move the axes, the moves after it are planned from where it leaves them
+                self.barrier_done.wait()
+                with self.lock:
+                    self.planned_steps = [axis.step_position for axis in self.axes]
+
+    def execute_loop(self):
+        while True:
+            if self.previous_end is not None and self.ready.empty() and self.pending > 0:
+                self.starvations += 1
+            item = self.ready.get()
+            if item is None:
+                break
+            generation, kind, work = item
+            with self.idle:
+                self.busy = True
+            aborted = False
+            try:
+                if generation != self.generation:
+                    self.drop(kind, work)
+                elif kind == 'call':
+                    function, args, _discarded = work
+                    self.previous_end = None
+                    function(*args)
+                else:
+                    aborted = not self.execute_move(work)
+            except Exception as error:
+                self.last_error = error
+                self.previous_end = None
+                print(f'Motion command failed: {error}')
+            finally:
+                if kind == 'call':
+                    self.barrier_done.set()
+                with self.idle:
+                    self.busy = False
+                self.finish_item()
+            if aborted:
+                # The axes didn't get where the moves after this one were planned from
+                with self.lock:
+                    if generation == self.generation:
+                        self.discard()
+                        self.planned_steps = [axis.step_position for axis in self.axes]
+
+    def execute_move(self, planned_move):
+        # This function runs a planned move, chained to the end of the move before it when it is on time.
+        # Returns False when the move was cut short (a kill switch or a stop).
+        now = self.clock()
+        start = None
+        if self.previous_end is not None:
+            gap = max(0.0, now - self.previous_end)
+            self.gap_count += 1
+            self.gap_total += gap
+            self.gap_max = max(self.gap_max, gap)
+            # A late start isn't caught up by more than a step, so the axes never burst
+            if gap <= planned_move.schedule.intervals[0]:
+                start = self.previous_end
+        report = self.coordinated_motion.execute(planned_move, start)
+        self.moves += 1
+        if report is None or report['steps'] < len(planned_move):
+            self.previous_end = None
+            return False
+        self.previous_end = report['start'] + report['commanded_duration']
+        return True
+
+    def discard(self):
+        # This function drops the queued work, the caller holds self.lock
+        self.generation += 1
+        for work_queue in (self.targets, self.ready):
+            while True:
+                try:
+                    item = work_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    work_queue.put(item)
+                    break
+                self.drop(item[1], item[2] if work_queue is self.ready else item[2:])
+                self.finish_item()
+        self.barrier_done.set()
+
+    def stop(self):
+        # This function drops the queued work and stops the running move, the step loops see axis.stop
+        with self.lock:
+            self.discard()
+            with self.idle:
+                while self.busy:
+                    for axis in self.axes:
+                        axis.stop = 1
+                    self.idle.wait(STOP_POLL_INTERVAL)
+            self.planned_steps = [axis.step_position for axis in self.axes]
+            self.previous_end = None
+
+    def wait(self, timeout=None):
+        # This function blocks until all the queued work is done, returns False on timeout
+        with self.idle:
+            return self.idle.wait_for(lambda: self.pending == 0, timeout)
+
+    def shutdown(self, timeout=5):
+        self.stop()
+        self.targets.put(None)
+        self.planner.join(timeout)
+        self.executor.join(timeout)
+
+    def snapshot(self):
+        # This function returns a lightweight copy of the motion state, cheap enough to poll from the GUI
+        busy = self.busy
+        return {'busy': busy,
+                'queued': self.pending,
+                'positions': tuple(axis.current_position for axis in self.axes),
+                'velocities': tuple(axis.velocity * axis.step_resolution if busy else 0 for axis in self.axes)}
+
+    def metrics(self):
+        return {'depth': self.ready.qsize(),
+                'max_depth': self.max_depth,
+                'queued_targets': self.targets.qsize(),
+                'pending': self.pending,
+                'moves': self.moves,
+                'dropped': self.dropped,
+                'starvations': self.starvations,
+                'gaps': self.gap_count,
+                'gap_mean': self.gap_total / self.gap_count if self.gap_count else None,
+                'gap_max': self.gap_max,
+                'planning_time': self.planning_time}
+
+
+if __name__ == "__main__":
+    # Demo on the simulated driver: a dense scan row, planned then run move after move, then through the queue
+    from machine import build_machine
+    from step_drivers import get_driver
+
+    driver = get_driver('simulated')
+    machine_axes, _homing = build_machine(driver)
+    row = [(10 + 0.25 * i + (0.5 if i % 2 else 0.0), 10 + 0.25 * i, None) for i in range(200)]
+    feed_rate = 40  # [mm/sec]
+
+    coordinated_motion = CoordinatedMotion(driver)
+    gaps = []
+    previous_end = None
+    begin = time.perf_counter()
+    for position in row:
+        legs = []
+        for value, axis in zip(position, machine_axes):
+            if value is not None:
+                step_delta = round(value / axis.step_resolution) - axis.step_position
+                legs.append((axis, 1 if step_delta > 0 else 0, abs(step_delta)))
+        planned = coordinated_motion.plan(legs, feed_rate)
+        if planned is None:
+            continue
+        if previous_end is not None:
+            gaps.append(time.perf_counter() - previous_end)
+        report = coordinated_motion.execute(planned)
+        previous_end = report['start'] + report['commanded_duration']
+    print(f'Plan then run: {len(row)} moves in {time.perf_counter() - begin:.2f} [sec], '
+          f'mean gap {sum(gaps) / len(gaps) * 1e6:.0f} [usec], max gap {max(gaps) * 1e6:.0f} [usec]')
+
+    move_queue = MoveQueue(machine_axes, driver)
+    move_queue.put((10, 10, None), feed_rate)
+    move_queue.wait()
+    move_queue.gap_count, move_queue.gap_total, move_queue.gap_max = 0, 0.0, 0.0
+    begin = time.perf_counter()
+    for position in row:
+        move_queue.put(position, feed_rate)
+    move_queue.wait()
+    metrics = move_queue.metrics()
+    print(f'Move queue: {metrics["moves"] - 1} moves in {time.perf_counter() - begin:.2f} [sec], '
+          f'mean gap {metrics["gap_mean"] * 1e6:.0f} [usec], max gap {metrics["gap_max"] * 1e6:.0f} [usec], '
+          f'{metrics["starvations"]} starvations, max depth {metrics["max_depth"]}')
+    print(f'At {move_queue.snapshot()["positions"]} [mm].')
+    move_queue.shutdown()
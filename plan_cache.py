@@ -0,0 +1,327 @@
+import hashlib
+import mmap
+import os
+import struct
+import time
+from array import array
+from gcode import DEFAULT_RAPID_RATE, JobRunner, load_job
+from metrics import get_metrics
+from step_timing import chained_start
+from trajectory_planner import DEFAULT_ACCELERATION, DEFAULT_JUNCTION_DEVIATION
+
+CACHE_ENVIRONMENT_VARIABLE = 'GANTRY_PLAN_CACHE'
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'gantry', 'plans')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+HASH_CHUNK = 1 << 20  # [bytes], the job file is hashed a chunk at a time
+
+# A plan file: the header, the start position, one record per segment, then the per tick arrays
+# (intervals, rise times, fall times [sec] and the mask of the axes stepped at the tick).
+# The rise and fall times are offsets from the start of the tick's segment.
+PLAN_MAGIC = b'GPL1'
+PLAN_HEADER_FORMAT = '<4sBxxxQQd'  # magic, axes amount, segments, ticks, planning time [sec]
+PLAN_SEGMENT_FORMAT = '<QQBBxxxxxxd'  # first tick, ticks, direction mask, moving mask, duration [sec]
+MAX_AXES = 8  # the axes masks are one byte
+
+
+class MappedSchedule:
+    def __init__(self, intervals, rise_times, fall_times, duration):
+        # A StepSchedule whose times are views into a memory mapped plan, nothing is copied
+        self.intervals = intervals
+        self.rise_times = rise_times
+        self.fall_times = fall_times
+        self.duration = duration
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def commanded_rate(self):
+        if self.duration == 0:
+            return 0
+        return len(self.intervals) / self.duration
+
+
+class TickPins:
+    def __init__(self, masks, pins_by_mask):
+        # The step pins of every tick, looked up from the ticks axes masks when the step timer asks for them
+        self.masks = masks
+        self.pins_by_mask = pins_by_mask
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __getitem__(self, tick):
+        return self.pins_by_mask[self.masks[tick]]
+
+
+class PlanCompiler(JobRunner):
+    def __init__(self, axes, rapid_rate=DEFAULT_RAPID_RATE, acceleration=DEFAULT_ACCELERATION,
+                 junction_deviation=DEFAULT_JUNCTION_DEVIATION):
+        # Plans a job like JobRunner does, but keeps the segments pulse tables instead of stepping them
+        if len(axes) > MAX_AXES:
+            raise ValueError(f'A plan holds up to {MAX_AXES} axes.')
+        super().__init__(axes, None, None, rapid_rate, acceleration, junction_deviation)
+        self.clock = time.perf_counter
+        self.start_steps = None
+        self.segments = []  # (first tick, ticks, direction mask, moving mask, duration, velocities)
+        self.intervals = array('d')
+        self.rise_times = array('d')
+        self.fall_times = array('d')
+        self.masks = array('B')
+
+    def flush(self):
+        if self.planner is None:
+            return
+        planner, self.planner = self.planner, None
+        for segment in planner.plan():
+            ticks, schedule = segment.step_schedule()
+            direction_mask = sum(1 << index for index, delta in enumerate(segment.step_deltas) if delta > 0)
+            moving_mask = sum(1 << index for index, delta in enumerate(segment.step_deltas) if delta)
+            velocities = [abs(component) * segment.feed_rate / axis.step_resolution
+                          for component, axis in zip(segment.unit, self.axes)]
+            self.segments.append((len(self.masks), len(ticks), direction_mask, moving_mask, schedule.duration,
+                                  velocities))
+            self.intervals.extend(schedule.intervals)
+            self.rise_times.extend(schedule.rise_times)
+            self.fall_times.extend(schedule.fall_times)
+            self.masks.extend(sum(1 << index for index in tick) for tick in ticks)
+
+    def home(self):
+        raise ValueError("G28 can't be part of a compiled plan, home the machine before running it.")
+
+    def compile(self, commands, output_path):
+        # This function plans the job and writes its plan file, returns the planning time [sec]
+        start = time.perf_counter()
+        self.start_steps = [axis.step_position for axis in self.axes]
+        self.run(commands)
+        planning_time = time.perf_counter() - start
+
+        axes_amount = len(self.axes)
+        segment_format = PLAN_SEGMENT_FORMAT + f'{axes_amount}d'
+        with open(output_path, 'wb') as plan_file:
+            plan_file.write(struct.pack(PLAN_HEADER_FORMAT, PLAN_MAGIC, axes_amount, len(self.segments),
+                                        len(self.masks), planning_time))
+            plan_file.write(struct.pack(f'<{axes_amount}q', *self.start_steps))
+            for *fields, velocities in self.segments:
+                plan_file.write(struct.pack(segment_format, *fields, *velocities))
+            for values in (self.intervals, self.rise_times, self.fall_times, self.masks):
+                plan_file.write(values.tobytes())
+        return planning_time
+
+
+class MappedPlan:
+    def __init__(self, path):
+        # A compiled plan, memory mapped read only. The pulse tables stay in the page cache and are read in
+        # place by the step timer.
+        self.path = path
+        with open(path, 'rb') as plan_file:
+            self.memory = mmap.mmap(plan_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.memory)
+        magic, self.axes_amount, segments, ticks, self.planning_time = struct.unpack_from(PLAN_HEADER_FORMAT,
+                                                                                          self.view, 0)
+        if magic != PLAN_MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a compiled plan.')
+        offset = struct.calcsize(PLAN_HEADER_FORMAT)
+        self.start_steps = list(struct.unpack_from(f'<{self.axes_amount}q', self.view, offset))
+        offset += 8 * self.axes_amount
+        segment_record = struct.Struct(PLAN_SEGMENT_FORMAT + f'{self.axes_amount}d')
+        self.segments = [segment_record.unpack_from(self.view, offset + index * segment_record.size)
+                         for index in range(segments)]
+        offset += segments * segment_record.size
+        self.intervals, self.rise_times, self.fall_times = (
+            self.view[offset + index * 8 * ticks:offset + (index + 1) * 8 * ticks].cast('d') for index in range(3))
+        self.masks = self.view[offset + 3 * 8 * ticks:offset + 3 * 8 * ticks + ticks]
+        self.ticks = ticks
+
+    def duration(self):
+        # This function returns the planned duration of the plan [sec]
+        return sum(segment[4] for segment in self.segments)
+
+    def segment_schedule(self, index):
+        # This function returns a segment's (ticks axes masks, schedule), views into the mapped tables
+        first, ticks, _direction_mask, _moving_mask, duration = self.segments[index][:5]
+        last = first + ticks
+        return self.masks[first:last], MappedSchedule(self.intervals[first:last], self.rise_times[first:last],
+                                                      self.fall_times[first:last], duration)
+
+    def close(self):
+        for name in ('intervals', 'rise_times', 'fall_times', 'masks', 'view'):
+            view = getattr(self, name, None)
+            if view is not None:
+                view.release()
+        self.memory.close()
+
+
+def run_plan(plan, axes, driver):
+    # This function steps the axes through a mapped plan, like TrajectoryPlanner.execute does. The segments
+    # are chained on one deadline clock, a late one is started afresh, a kill switch stops the whole plan.
+    positions = [axis.step_position for axis in axes]
+    if positions != plan.start_steps:
+        raise ValueError(f'The plan starts at {plan.start_steps} [steps], the axes are at {positions} [steps].')
+    gpio = driver.gpio
+    step_timer = driver.step_timer(None)
+    pins_by_mask = [tuple(axis.step_pin for index, axis in enumerate(axes) if mask >> index & 1)
+                    for mask in range(1 << len(axes))]
+    indexes_by_mask = [tuple(index for index in range(len(axes)) if mask >> index & 1)
+                       for mask in range(1 << len(axes))]
+
+    end = None
+    steps = 0
+    status = 'done'
+    run_start = driver.clock()
+    for index, (_first, ticks, direction_mask, moving_mask, _duration, *velocities) in enumerate(plan.segments):
+        directions = [direction_mask >> axis_index & 1 for axis_index in range(len(axes))]
+        for axis_index, axis in enumerate(axes):
+            if moving_mask >> axis_index & 1:
+                gpio.output(axis.direction_pin, directions[axis_index])
+                axis.arm_kill_switches(directions[axis_index])
+                if axis.stop:
+                    status = 'stopped'
+        if status == 'stopped':
+            break
+
+        masks, schedule = plan.segment_schedule(index)
+
+        def on_tick(tick):
+            stop = False
+            for axis_index in indexes_by_mask[masks[tick]]:
+                axis = axes[axis_index]
+                axis.update_axis_status(velocities[axis_index], directions[axis_index])
+                if axis.stop:
+                    stop = axis.stopped_by_kill_switch()
+            return stop
+
+        step_counters = [axis.step_counter for axis in axes]
+        report = step_timer.run_ticks(schedule, TickPins(masks, pins_by_mask), on_tick,
+                                      chained_start(end, schedule, step_timer.clock()))
+        get_metrics().record_move('plan_cache', report,
+                                  [(axis.axis_name, axis.step_counter - step_counter)
+                                   for axis, step_counter in zip(axes, step_counters)], report['steps'] < ticks)
+        steps += report['steps']
+        masks.release()
+        if report['steps'] < ticks:
+            status = 'stopped'
+            break
+        end = report['start'] + report['commanded_duration']
+    return {'status': status, 'ticks': steps, 'duration': driver.clock() - run_start}
+
+
+class PlanCache:
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        # Compiled plans on disk, addressed by the hash of the job and of everything its plan depends on.
+        # The least recently used plans are evicted once the cache is bigger than max_bytes.
+        if directory is None:
+            directory = os.environ.get(CACHE_ENVIRONMENT_VARIABLE, DEFAULT_CACHE_DIRECTORY)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.planning_time = 0.0  # [sec], spent compiling the missed plans
+        self.saved_time = 0.0  # [sec], the planning time of the plans that were hits
+        self.lookup_time = 0.0  # [sec], spent hashing and mapping the hits
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(job_path, axes, rapid_rate=DEFAULT_RAPID_RATE, acceleration=DEFAULT_ACCELERATION,
+            junction_deviation=DEFAULT_JUNCTION_DEVIATION):
+        # This function returns the content address of a job's plan
+        digest = hashlib.sha256(PLAN_MAGIC)
+        with open(job_path, 'rb') as job_file:
+            while True:
+                chunk = job_file.read(HASH_CHUNK)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        machine = [(axis.step_position, axis.step_resolution, axis.soft_limits,
+                    None if axis.motion_profile is None else sorted(axis.motion_profile.get_values().items()))
+                   for axis in axes]
+        digest.update(repr((machine, rapid_rate, acceleration, junction_deviation)).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.plan')
+
+    def load(self, job_path, axes, rapid_rate=DEFAULT_RAPID_RATE, acceleration=DEFAULT_ACCELERATION,
+             junction_deviation=DEFAULT_JUNCTION_DEVIATION):
+        # This function returns the mapped plan of a job, compiled and stored on a miss
+        start = time.perf_counter()
+        path = self.path(self.key(job_path, axes, rapid_rate, acceleration, junction_deviation))
+        if os.path.exists(path):
+            os.utime(path)  # the modification time orders the eviction
+            plan = MappedPlan(path)
+            self.hits += 1
+            self.saved_time += plan.planning_time
+            self.lookup_time += time.perf_counter() - start
+            return plan
+
+        self.misses += 1
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        compiler = PlanCompiler(axes, rapid_rate, acceleration, junction_deviation)
+        self.planning_time += compiler.compile(load_job(job_path, len(axes)), temporary_path)
+        os.replace(temporary_path, path)
+        self.evict(keep=path)
+        return MappedPlan(path)
+
+    def entries(self):
+        # This function returns the (modification time, size, path) of the cached plans, oldest first
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.plan'):
+                status = entry.stat()
+                entries.append((status.st_mtime, status.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        # This function deletes the least recently used plans until the cache fits in max_bytes
+        entries = self.entries()
+        total = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        entries = self.entries()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(entries),
+                'bytes': sum(size for _mtime, size, _path in entries),
+                'planning_time': self.planning_time,
+                'saved_time': self.saved_time,
+                'lookup_time': self.lookup_time}
+
+
+if __name__ == "__main__":
+    import argparse
+    from machine import build_machine, driver_name
+    from step_drivers import get_driver
+
+    parser = argparse.ArgumentParser(description='Runs a G-code job from the compiled plans cache.')
+    parser.add_argument('job', help='a G-code file or a compiled job, without G28')
+    parser.add_argument('--driver',
+                        help='the step driver, see step_drivers.py (GANTRY_STEP_DRIVER, then machine.json by default)')
+    parser.add_argument('--cache-dir', help=f'the cache directory ({CACHE_ENVIRONMENT_VARIABLE} by default)')
+    parser.add_argument('--max-mb', type=float, default=DEFAULT_MAX_BYTES / 1024 ** 2, help='the cache size limit')
+    parser.add_argument('--runs', type=int, default=1, help='how many times the job is run')
+    arguments = parser.parse_args()
+
+    step_driver = get_driver(arguments.driver or driver_name())
+    machine_axes, _homing = build_machine(step_driver)
+    cache = PlanCache(arguments.cache_dir, int(arguments.max_mb * 1024 ** 2))
+    for _run in range(arguments.runs):
+        if step_driver.name == 'simulated':
+            for axis in machine_axes:
+                axis.step_position = 0  # the simulated gantry is put back where the job starts
+        hits = cache.hits
+        job_plan = cache.load(arguments.job, machine_axes)
+        plan_report = run_plan(job_plan, machine_axes, step_driver)
+        job_plan.close()
+        print(f'{"Hit" if cache.hits > hits else "Miss"}: {job_plan.ticks} ticks {plan_report["status"]} '
+              f'in {plan_report["duration"]:.2f} [sec].')
+    print(cache.stats())
@@ -0,0 +1,261 @@
+import math
+import random
+import time
+from machine import axis_configs as machine_axes
+
+TWO_OPT_MAX_PASSES = 50
+DEFAULT_VELOCITY = 1000  # [steps/sec], for the axes without a motion profile
+
+
+def working_volume(axis_configs=None):
+    # This function returns the axes lengths [mm] (of the machine config when None), the scans must fit in them
+    axis_configs = machine_axes() if axis_configs is None else axis_configs
+    return tuple(config['axis_length'] for config in axis_configs)
+
+
+def machine_limits(axis_configs=None):
+    # This function returns the (max velocity [mm/sec], acceleration [mm/sec^2]) of every axis
+    axis_configs = machine_axes() if axis_configs is None else axis_configs
+    limits = []
+    for config in axis_configs:
+        profile = config.get('motion_profile')
+        resolution = config['step_resolution']
+        if profile is None:
+            limits.append((DEFAULT_VELOCITY * resolution, math.inf))
+        else:
+            limits.append((profile['max_velocity'] * resolution, profile['acceleration'] * resolution))
+    return limits
+
+
+def axes_limits(axes):
+    # This function returns the (max velocity [mm/sec], acceleration [mm/sec^2]) of axis_control.Axis objects
+    return [(DEFAULT_VELOCITY * axis.step_resolution, math.inf) if axis.motion_profile is None else
+            (axis.motion_profile.max_velocity * axis.step_resolution,
+             axis.motion_profile.acceleration * axis.step_resolution) for axis in axes]
+
+
+def check_volume(points, volume):
+    # This function raises a ValueError when a point is outside of the working volume, returns the points
+    for point in points:
+        if any(not 0 <= value <= length for value, length in zip(point, volume)):
+            raise ValueError(f'The point {point} is outside of the working volume {volume} [mm].')
+    return points
+
+
+def axis_move_time(distance, velocity, acceleration):
+    # This function returns the time of a trapezoidal (triangular when short) move from rest to rest [sec]
+    if distance == 0:
+        return 0.0
+    if math.isinf(acceleration):
+        return distance / velocity
+    if distance >= velocity ** 2 / acceleration:
+        return distance / velocity + velocity / acceleration
+    return 2 * math.sqrt(distance / acceleration)
+
+
+def move_time(start, end, limits):
+    # This function returns the time of a move between two points [sec], the slowest axis sets it
+    return max(axis_move_time(abs(b - a), velocity, acceleration)
+               for a, b, (velocity, acceleration) in zip(start, end, limits))
+
+
+def raster(x_range, y_range, pitch, z=0.0, volume=None):
+    # This function returns a raster scan [mm]: every row runs from low to high x, rows go up in y.
+    # x_range and y_range are (start, end) [mm], pitch is the grid spacing [mm].
+    volume = working_volume() if volume is None else volume
+    xs = grid_values(*x_range, pitch)
+    ys = grid_values(*y_range, pitch)
+    return check_volume([(x, y, z) for y in ys for x in xs], volume)
+
+
+def serpentine(x_range, y_range, pitch, z=0.0, volume=None):
+    # This function returns a serpentine (boustrophedon) scan [mm], every other row runs backwards
+    volume = working_volume() if volume is None else volume
+    xs = grid_values(*x_range, pitch)
+    ys = grid_values(*y_range, pitch)
+    return check_volume([(x, y, z) for row, y in enumerate(ys) for x in (xs if row % 2 == 0 else xs[::-1])],
+                        volume)
+
+
+def layers(pattern, z_values, volume=None):
+    # This function stacks an XY pattern [mm] at several heights, every other layer runs backwards
+    volume = working_volume() if volume is None else volume
+    return check_volume([(x, y, z) for layer, z in enumerate(z_values)
+                         for x, y, _z in (pattern if layer % 2 == 0 else pattern[::-1])], volume)
+
+
+def spiral(center, radius, pitch, spacing=None, z=0.0, volume=None):
+    # This function returns an Archimedean spiral scan [mm] from the center out to radius, pitch apart
+    # between turns and spacing apart along the curve (pitch when None)
+    volume = working_volume() if volume is None else volume
+    spacing = pitch if spacing is None else spacing
+    points = [(center[0], center[1], z)]
+    b = pitch / (2 * math.pi)
+    theta = 0.0
+    while b * theta <= radius:
+        # the arc length of an Archimedean spiral grows by about r * dtheta
+        theta += spacing / max(b * theta, spacing)
+        r = b * theta
+        if r > radius:
+            break
+        points.append((center[0] + r * math.cos(theta), center[1] + r * math.sin(theta), z))
+    return check_volume(points, volume)
+
+
+def grid_values(start, end, pitch):
+    amount = int(math.floor(abs(end - start) / pitch + 1e-9)) + 1
+    step = pitch if end >= start else -pitch
+    return [start + i * step for i in range(amount)]
+
+
+def time_matrix(points, limits):
+    # This function returns the move time between every two points [sec], a NumPy array when NumPy is
+    # installed (vectorized over all the pairs), a list of lists otherwise
+    try:
+        import numpy as np
+    except ImportError:
+        return [[move_time(a, b, limits) for b in points] for a in points]
+
+    coordinates = np.asarray(points, dtype=float)
+    times = np.zeros((len(points), len(points)))
+    for axis, (velocity, acceleration) in enumerate(limits):
+        distance = np.abs(coordinates[:, None, axis] - coordinates[None, :, axis])
+        if math.isinf(acceleration):
+            axis_times = distance / velocity
+        else:
+            axis_times = np.where(distance >= velocity ** 2 / acceleration,
+                                  distance / velocity + velocity / acceleration,
+                                  2 * np.sqrt(distance / acceleration))
+        np.maximum(times, axis_times, out=times)
+    return times
+
+
+def nearest_neighbour(times, first=0):
+    # This function returns a visiting order that always goes to the closest (in time) point left
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    amount = len(times)
+    order = [first]
+    if np is not None:
+        visited = np.zeros(amount, dtype=bool)
+        visited[first] = True
+        for _ in range(amount - 1):
+            row = np.where(visited, np.inf, times[order[-1]])
+            following = int(np.argmin(row))
+            visited[following] = True
+            order.append(following)
+        return order
+
+    left = set(range(amount)) - {first}
+    while left:
+        following = min(left, key=times[order[-1]].__getitem__)
+        left.remove(following)
+        order.append(following)
+    return order
+
+
+def two_opt(times, order, max_passes=TWO_OPT_MAX_PASSES):
+    # This function shortens an open path by reversing sub paths while that saves time, the first point
+    # stays first. With NumPy every candidate reversal of a pass position is scored in one vectorized step.
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    order = list(order)
+    amount = len(order)
+    for _pass in range(max_passes):
+        improved = False
+        for i in range(amount - 2):
+            a, b = order[i], order[i + 1]
+            if np is not None:
+                path = np.asarray(order)
+                c = path[i + 2:]
+                d = np.append(path[i + 3:], -1)
+                gains = times[a, c] - times[a, b]
+                gains[:-1] += times[b, d[:-1]] - times[c[:-1], d[:-1]]
+                best = int(np.argmin(gains))
+                gain = gains[best]
+            else:
+                gain, best = 0.0, None
+                for index, j in enumerate(range(i + 2, amount)):
+                    c = order[j]
+                    change = times[a][c] - times[a][b]
+                    if j + 1 < amount:
+                        d = order[j + 1]
+                        change += times[b][d] - times[c][d]
+                    if change < gain:
+                        gain, best = change, index
+            if best is not None and gain < -1e-12:
+                j = i + 2 + best
+                order[i + 1:j + 1] = order[i + 1:j + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def path_time(times, order):
+    return sum(float(times[a][b]) for a, b in zip(order, order[1:]))
+
+
+def order_points(points, limits=None, start=(0.0, 0.0, 0.0)):
+    # This function orders a point cloud [mm] for the least total move time from start, nearest neighbour
+    # then 2-opt. Returns the ordered points and a report of the estimated times.
+    limits = machine_limits() if limits is None else limits
+    begin = time.perf_counter()
+    all_points = [tuple(start)] + [tuple(point) for point in points]
+    times = time_matrix(all_points, limits)
+    given_time = path_time(times, range(len(all_points)))
+    order = nearest_neighbour(times)
+    nearest_time = path_time(times, order)
+    order = two_opt(times, order)
+    ordered_time = path_time(times, order)
+    return [all_points[index] for index in order[1:]], {'points': len(points),
+                                                         'given_order_time': given_time,
+                                                         'nearest_neighbour_time': nearest_time,
+                                                         'two_opt_time': ordered_time,
+                                                         'ordering_time': time.perf_counter() - begin}
+
+
+def estimate_duration(points, limits=None, start=(0.0, 0.0, 0.0), dwell=0.0):
+    # This function returns the estimated duration of a scan [sec]: the moves from start through the points
+    # in order, each from rest to rest, plus a dwell (e.g. the capture time) at every point
+    limits = machine_limits() if limits is None else limits
+    total = 0.0
+    previous = tuple(start)
+    for point in points:
+        total += move_time(previous, point, limits) + dwell
+        previous = point
+    return total
+
+
+def write_gcode(points, path, feed_rate, dwell=True):
+    # This function writes a scan as a G-code job (see gcode.py), feed_rate in [mm/sec].
+    # With dwell every point ends with M400, so the machine is at rest there.
+    with open(path, 'w') as job_file:
+        job_file.write(f'G90 G1 F{feed_rate * 60:g}\n')
+        for x, y, z in points:
+            job_file.write(f'G1 X{x:.3f} Y{y:.3f} Z{z:.3f}\n')
+            if dwell:
+                job_file.write('M400\n')
+
+
+if __name__ == "__main__":
+    # Demo: the estimated durations of the patterns, and the ordering of a random point cloud
+    for name, points in (('raster', raster((100, 400), (100, 200), 10)),
+                         ('serpentine', serpentine((100, 400), (100, 200), 10)),
+                         ('serpentine, 3 layers', layers(serpentine((100, 400), (100, 200), 10), (0, 50, 100))),
+                         ('spiral', spiral((750, 250), 200, 10))):
+        print(f'{name}: {len(points)} points, estimated {estimate_duration(points):.1f} [sec]')
+
+    generator = random.Random(0)
+    cloud = [(generator.uniform(0, 1500), generator.uniform(0, 500), generator.uniform(0, 200)) for _ in range(300)]
+    ordered, report = order_points(cloud)
+    print(f'Point cloud: {report["points"]} points, as given {report["given_order_time"]:.1f} [sec], '
+          f'nearest neighbour {report["nearest_neighbour_time"]:.1f} [sec], '
+          f'2-opt {report["two_opt_time"]:.1f} [sec], ordered in {report["ordering_time"] * 1e3:.0f} [msec]')
+    print(f'Estimated duration: {estimate_duration(ordered):.1f} [sec]')
@@ -1,6 +1,5 @@
-import RPi.GPIO as GPIO
 import time
-from tqdm.auto import tqdm
+from telemetry import ProgressDisplay, TelemetryChannel
 
 
 def motor_single_step(_step_pin, _velocity):
@@ -12,6 +11,9 @@ def motor_single_step(_step_pin, _velocity):
 
 
 if __name__ == "__main__":
+    # RPi.GPIO is imported only when the script runs, so the module imports off the Pi
+    import RPi.GPIO as GPIO
+
     # 0/1 used to define clockwise or counterclockwise.
     CW = 1
     CCW = 0
@@ -35,9 +37,16 @@ if __name__ == "__main__":
     GPIO.setup(direction_pin, GPIO.OUT)
     GPIO.setup(step_pin, GPIO.OUT)
 
+    # The progress is printed by a separate thread, the step loop only writes to the telemetry channel
+    telemetry = TelemetryChannel()
+    progress = ProgressDisplay(telemetry, steps)
+    progress.start()
+
     GPIO.output(direction_pin, CCW)
-    for _ in tqdm(range(steps)):
+    for step in range(steps):
         motor_single_step(step_pin, velocity)
+        telemetry.record(0, step + 1, step + 1)
+    progress.close()
 
     # time.sleep(2)
     #
@@ -0,0 +1,125 @@
+import argparse
+import contextlib
+import json
+import platform
+import sys
+import time
+from step_drivers import get_driver
+
+DEFAULT_VELOCITIES = (250, 500, 1000, 2000, 4000, 8000)  # [steps/sec]
+DEFAULT_STEPS = 500
+HOMING_VELOCITY = 1000  # go_to_home_position's fixed velocity [steps/sec]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def measure(name, velocity, run, gpio, step_pin):
+    # This function runs one benchmark case against the recording GPIO, returns the achieved step rate,
+    # the inter pulse jitter (distance from the commanded interval) percentiles and the CPU usage
+    gpio.reset()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    with contextlib.redirect_stdout(sys.stderr):
+        run()
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    rising = gpio.rising_edges(step_pin)
+    intervals = gpio.pulse_intervals(step_pin)
+    commanded_interval = 1 / velocity
+    jitter = sorted(abs(interval - commanded_interval) for interval in intervals)
+    return {'function': name,
+            'commanded_rate': velocity,
+            'steps': len(rising),
+            'achieved_rate': (len(rising) - 1) / (rising[-1] - rising[0]) if len(rising) > 1 else None,
+            'jitter_p50': percentile(jitter, 0.50),
+            'jitter_p99': percentile(jitter, 0.99),
+            'jitter_max': jitter[-1] if jitter else None,
+            'wall_time': wall,
+            'cpu_time': cpu,
+            'cpu_usage': cpu / wall if wall else None}
+
+
+def axis_cases(axis, steps):
+    # This function returns the (name, run(velocity)) benchmark cases of an axis_control.Axis
+    def single_steps(velocity):
+        axis.arm_kill_switches(1)
+        for _ in range(steps):
+            axis.motor_single_step(velocity)
+
+    def for_loop(velocity):
+        axis.axis_for_loop(velocity, 1, steps)
+
+    def while_loop(velocity):
+        axis.axis_while_loop(velocity, 1, round(axis.current_position + steps * axis.step_resolution, 3))
+
+    return [('motor_single_step', single_steps), ('axis_for_loop', for_loop), ('axis_while_loop', while_loop)]
+
+
+def homing_case(axis, steps):
+    # go_to_home_position seeks the switch at 0, the simulated switch is hit after `steps` steps
+    def homing(_velocity):
+        axis.kill_switch_i.release()
+        axis.direction = 0
+        axis.kill_switch_i.press_at_pulse(axis.gpio, axis.step_pin, steps)
+        axis.go_to_home_position(steps * axis.step_resolution)
+        axis.kill_switch_i.release()
+    return 'go_to_home_position', homing
+
+
+def gui_case(axis, steps):
+    # GUI.create_motion, GUI.py builds its window only when it is run as a script
+    import GUI
+
+    GUI.x_axis = axis
+
+    def create_motion(velocity):
+        GUI.create_motion('x', 'left', steps, velocity)
+    return 'GUI.create_motion', create_motion
+
+
+def run_benchmarks(velocities=DEFAULT_VELOCITIES, steps=DEFAULT_STEPS, include_gui=True):
+    # This function sweeps every benchmark case over the velocities, on the simulated step driver
+    from axis_control import Axis
+
+    driver = get_driver('simulated')
+    axis_arguments = dict(axis_name='X axis', direction_pin=31, step_pin=29, kill_switch_i_pin=10,
+                          kill_switch_f_pin=11, step_resolution=0.05, axis_length=1500, driver=driver)
+    axis = Axis(direction='left', **axis_arguments)
+    cases = axis_cases(axis, steps)
+    if include_gui:
+        cases.append(gui_case(Axis(direction='left', **axis_arguments), steps))
+
+    results = []
+    for name, run in cases:
+        for velocity in velocities:
+            results.append(measure(name, velocity, lambda: run(velocity), driver.gpio, axis.step_pin))
+    name, run = homing_case(axis, steps)
+    results.append(measure(name, HOMING_VELOCITY, lambda: run(HOMING_VELOCITY), driver.gpio, axis.step_pin))
+
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'steps': steps,
+            'results': results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Step timing benchmarks against a simulated GPIO.')
+    parser.add_argument('--velocities', type=float, nargs='+', default=DEFAULT_VELOCITIES,
+                        help='the commanded step rates to sweep [steps/sec]')
+    parser.add_argument('--steps', type=int, default=DEFAULT_STEPS, help='steps per case')
+    parser.add_argument('--output', help='the JSON results file, printed when not given')
+    parser.add_argument('--no-gui', action='store_true', help="skip GUI.create_motion (needs tkinter)")
+    arguments = parser.parse_args()
+
+    report = run_benchmarks(arguments.velocities, arguments.steps, include_gui=not arguments.no_gui)
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
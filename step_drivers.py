@@ -0,0 +1,250 @@
+import os
+import time
+from bisect import bisect_right
+from step_timing import StepTimer
+
+DRIVER_ENVIRONMENT_VARIABLE = 'GANTRY_STEP_DRIVER'
+DEFAULT_DRIVER = 'rpi'
+PIGPIO_STEPS_PER_WAVE = 2000  # each step is 2 pulses, pigpio holds ~12000 pulses in all its waves
+PIGPIO_POLL_INTERVAL = 0.001  # [sec], how often the move's progress is read back while the DMA engine pulses
+
+# The axes are wired by board pin number, pigpio talks in BCM numbers
+BOARD_TO_BCM = {3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23, 18: 24, 19: 10, 21: 9,
+                22: 25, 23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26,
+                38: 20, 40: 21}
+
+
+class StepDriver:
+    # The interface between the axes and the pins. gpio follows the RPi.GPIO API (setup / output),
+    # step_timer() returns the object that emits the step pulses (run / run_ticks / pulse), clock() is the
+    # time the step timers run on.
+    name = None
+    simulated = False  # no machine behind the pins
+
+    def __init__(self, gpio, kill_switch_class, clock=time.perf_counter):
+        self.gpio = gpio
+        self.kill_switch_class = kill_switch_class
+        self.clock = clock
+
+    def step_timer(self, step_pin):
+        return StepTimer(self.gpio, step_pin)
+
+    def attach_axis(self, axis):
+        # This function is called by every new axis_control.Axis of the driver
+        pass
+
+    def cleanup(self):
+        self.gpio.cleanup()
+
+
+class RPiGPIODriver(StepDriver):
+    # Bit-bangs the step pins from Python with RPi.GPIO, timed by the deadline clock of step_timing.py
+    name = 'rpi'
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        from gpiozero import Button as KillSwitch
+
+        GPIO.setmode(GPIO.BOARD)
+        GPIO.setwarnings(False)
+        super().__init__(GPIO, KillSwitch)
+
+
+class SimulatedDriver(StepDriver):
+    # Records the pulses instead of driving pins, for CI and for benchmarking off the Pi
+    name = 'simulated'
+    simulated = True
+
+    def __init__(self):
+        from fake_gpio import RecordingGPIO, SimulatedKillSwitch
+
+        super().__init__(RecordingGPIO(), SimulatedKillSwitch)
+
+
+class PigpioGPIO:
+    def __init__(self, pi):
+        # The RPi.GPIO calls the axes make, on top of a pigpio connection, pins are board numbers
+        self.pi = pi
+        self.OUT = 1
+        self.HIGH = 1
+        self.LOW = 0
+
+    def setup(self, pin, mode):
+        self.pi.set_mode(BOARD_TO_BCM[pin], mode)
+
+    def output(self, pin, value):
+        self.pi.write(BOARD_TO_BCM[pin], int(value))
+
+    def cleanup(self):
+        self.pi.stop()
+
+
+class PigpioStepTimer(StepTimer):
+    def __init__(self, gpio, step_pin, pigpio_module):
+        # Turns whole moves into pigpio wave chains, the DMA engine then emits them with microsecond timing.
+        # Single pulses (pulse()) are still bit-banged through pigpio writes.
+        super().__init__(gpio, step_pin)
+        self.pigpio = pigpio_module
+        self.pi = gpio.pi
+
+    def run(self, schedule, on_step=None):
+        return self.run_ticks(schedule, [(self.step_pin,)] * len(schedule),
+                              None if on_step is None else lambda _tick: on_step())
+
+    def create_wave(self, schedule, tick_pins, first, last):
+        # This function uploads the pulses of ticks [first, last) as one wave, times are rounded on absolute
+        # offsets so the rounding doesn't add up over the move
+        pulse = self.pigpio.pulse
+        rise_times = schedule.rise_times
+        fall_times = schedule.fall_times
+        masks = {}
+        pulses = []
+        for i in range(first, last):
+            pins = tick_pins[i]
+            mask = masks.get(pins)
+            if mask is None:
+                mask = masks[pins] = sum(1 << BOARD_TO_BCM[pin] for pin in pins)
+            rise = round(rise_times[i] * 1e6)
+            fall = round(fall_times[i] * 1e6)
+            end = round((rise_times[i] + schedule.intervals[i]) * 1e6)
+            pulses.append(pulse(mask, 0, fall - rise))
+            pulses.append(pulse(0, mask, end - fall))
+        self.pi.wave_add_generic(pulses)
+        return self.pi.wave_create()
+
+    def run_ticks(self, schedule, tick_pins, on_tick=None, start=None):
+        # This function streams the schedule as waves, the next wave is uploaded while the current one is sent.
+        # The steps are reported to on_tick as the DMA engine passes their time, a True return aborts the wave.
+        pi = self.pi
+        ticks = len(schedule)
+        if ticks == 0:
+            return self.finish_run(schedule, self.clock(), 0, 0.0)
+
+        wave_ranges = [(first, min(first + PIGPIO_STEPS_PER_WAVE, ticks))
+                       for first in range(0, ticks, PIGPIO_STEPS_PER_WAVE)]
+        pi.wave_clear()
+        waves = [self.create_wave(schedule, tick_pins, *wave_ranges[0])]
+        start = self.clock()
+        pi.wave_send_using_mode(waves[0], self.pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+
+        done = 0
+        sent = 1
+        stopped = False
+        while done < ticks and not stopped:
+            if sent < len(wave_ranges) and len(waves) - waves.count(None) < 2:
+                waves.append(self.create_wave(schedule, tick_pins, *wave_ranges[sent]))
+                pi.wave_send_using_mode(waves[-1], self.pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+                sent += 1
+            self.sleep(PIGPIO_POLL_INTERVAL)
+
+            passed = bisect_right(schedule.rise_times, self.clock() - start)
+            if sent == len(wave_ranges) and not pi.wave_tx_busy():
+                passed = ticks
+            for tick in range(done, min(passed, ticks)):
+                done = tick + 1
+                if on_tick is not None and on_tick(tick):
+                    pi.wave_tx_stop()
+                    stopped = True
+                    break
+
+            # Free the waves that were fully sent
+            current = pi.wave_tx_at()
+            for index, wave in enumerate(waves):
+                if wave is not None and wave != current and wave_ranges[index][1] <= done:
+                    pi.wave_delete(wave)
+                    waves[index] = None
+
+        if not stopped:
+            while pi.wave_tx_busy():
+                self.sleep(PIGPIO_POLL_INTERVAL)
+        for wave in waves:
+            if wave is not None:
+                pi.wave_delete(wave)
+        return self.finish_run(schedule, start, done, 0.0)
+
+
+class PigpioDriver(StepDriver):
+    # Hardware timed pulses from the pigpio daemon's DMA engine. pigpio_module stands in for the pigpio
+    # package, the simulated one (fake_gpio.SimulatedPigpio) runs the whole backend off the Pi.
+    name = 'pigpio'
+
+    def __init__(self, pigpio_module=None, kill_switch_class=None):
+        if pigpio_module is None:
+            import pigpio as pigpio_module
+        if kill_switch_class is None:
+            from gpiozero import Button as kill_switch_class
+
+        pi = pigpio_module.pi()
+        if not pi.connected:
+            raise RuntimeError('Could not connect to the pigpio daemon, is pigpiod running?')
+        self.pigpio = pigpio_module
+        super().__init__(PigpioGPIO(pi), kill_switch_class)
+
+    def step_timer(self, step_pin):
+        return PigpioStepTimer(self.gpio, step_pin, self.pigpio)
+
+
+class VirtualStepTimer(StepTimer):
+    def __init__(self, gpio, step_pin, virtual_clock):
+        # A step timer on a fake_gpio.VirtualClock, a wait jumps the clock to its deadline at once
+        super().__init__(gpio, step_pin, virtual_clock.now, virtual_clock.sleep)
+        self.virtual_clock = virtual_clock
+
+    def wait_until(self, deadline):
+        self.virtual_clock.advance_to(deadline)
+
+
+class VirtualDriver(StepDriver):
+    # Runs the axes on a virtual clock against a model of the machine, faster than real time: every axis gets a
+    # fake_gpio.SimulatedCarriage that presses its kill switches at 0 and axis_length. The carriages start where
+    # their axes think they are, set carriage.position to start one elsewhere. For dry runs and job times.
+    name = 'virtual'
+    simulated = True
+
+    def __init__(self):
+        from fake_gpio import RecordingGPIO, SimulatedKillSwitch, VirtualClock
+
+        self.virtual_clock = VirtualClock()
+        super().__init__(RecordingGPIO(self.virtual_clock.now, record_edges=False), SimulatedKillSwitch,
+                         self.virtual_clock.now)
+        self.carriages = []
+
+    def step_timer(self, step_pin):
+        return VirtualStepTimer(self.gpio, step_pin, self.virtual_clock)
+
+    def attach_axis(self, axis):
+        from fake_gpio import SimulatedCarriage
+
+        self.carriages.append(SimulatedCarriage(self.gpio, axis, axis.step_position, self.clock))
+
+    def switch_events(self):
+        # This function returns the kill switch edges of all the carriages, in time order
+        return sorted(event for carriage in self.carriages for event in carriage.switch_events)
+
+
+def simulated_pigpio_driver():
+    from fake_gpio import SimulatedKillSwitch, SimulatedPigpio
+
+    driver = PigpioDriver(SimulatedPigpio(), SimulatedKillSwitch)
+    driver.simulated = True
+    return driver
+
+
+DRIVERS = {'rpi': RPiGPIODriver,
+           'pigpio': PigpioDriver,
+           'simulated': SimulatedDriver,
+           'simulated-pigpio': simulated_pigpio_driver,
+           'virtual': VirtualDriver}
+_drivers = {}
+
+
+def get_driver(name=None):
+    # This function returns the shared step driver of a backend, by default the one named by the
+    # GANTRY_STEP_DRIVER environment variable ('rpi', 'pigpio', 'simulated', 'simulated-pigpio' or 'virtual')
+    if name is None:
+        name = os.environ.get(DRIVER_ENVIRONMENT_VARIABLE, DEFAULT_DRIVER)
+    if name not in DRIVERS:
+        raise ValueError(f'Unknown step driver {name}, choose one of {", ".join(DRIVERS)}.')
+    if name not in _drivers:
+        _drivers[name] = DRIVERS[name]()
+    return _drivers[name]
@@ -0,0 +1,170 @@
+import time
+
+SPIN_THRESHOLD = 0.0005  # [sec], the last stretch before a deadline is busy-waited instead of slept
+HIGH = 1
+LOW = 0
+
+
+def constant_velocity_intervals(step_amount, velocity):
+    # This function returns the step intervals [sec] of a move at a constant velocity [steps/sec]
+    return [1 / velocity] * step_amount
+
+
+def chained_start(previous_end, schedule, now):
+    # This function returns where a move chained to the move before it starts: that move's end deadline, or None
+    # (start now) when the move is later than its first step interval, so a late move isn't caught up in a burst
+    if previous_end is None or not len(schedule) or now - previous_end > schedule.intervals[0]:
+        return None
+    return previous_end
+
+
+class StepSchedule:
+    def __init__(self, intervals, duty_cycle=0.5):
+        # A whole move's pulse timestamps, computed ahead of time from the per-step intervals [sec].
+        # All the times are offsets from the start of the move.
+        self.intervals = intervals
+        self.rise_times = []
+        self.fall_times = []
+
+        offset = 0.0
+        for interval in intervals:
+            self.rise_times.append(offset)
+            self.fall_times.append(offset + duty_cycle * interval)
+            offset += interval
+        self.duration = offset
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def commanded_rate(self):
+        # This function returns the average step rate the schedule asks for [steps/sec]
+        if self.duration == 0:
+            return 0
+        return len(self.intervals) / self.duration
+
+
+class StepTimer:
+    def __init__(self, gpio, step_pin, clock=time.perf_counter, sleep=time.sleep, spin_threshold=SPIN_THRESHOLD):
+        # Emits step pulses against a monotonic deadline clock. Every edge is due at an absolute time,
+        # so sleep overshoot and call overhead of one step are caught up on the next instead of adding up.
+        self.gpio = gpio
+        self.step_pin = step_pin
+        self.clock = clock
+        self.sleep = sleep
+        self.spin_threshold = spin_threshold
+        self.next_deadline = None  # the due time of the next single pulse, see pulse()
+        self.last_report = None
+
+    def wait_until(self, deadline):
+        # This function sleeps the bulk of the time left and spins the rest, returns at once if already late
+        remaining = deadline - self.clock()
+        if remaining > self.spin_threshold:
+            self.sleep(remaining - self.spin_threshold)
+        while self.clock() < deadline:
+            pass
+
+    def run(self, schedule, on_step=None):
+        # This function emits a whole precomputed schedule. on_step is called after every pulse,
+        # a True return value stops the move. Returns the achieved versus commanded step rate.
+        gpio = self.gpio
+        step_pin = self.step_pin
+        clock = self.clock
+        wait_until = self.wait_until
+        rise_times = schedule.rise_times
+        fall_times = schedule.fall_times
+
+        steps = 0
+        max_lateness = 0.0
+        start = clock()
+        for i in range(len(schedule)):
+            rise = start + rise_times[i]
+            wait_until(rise)
+            lateness = clock() - rise
+            if lateness > max_lateness:
+                max_lateness = lateness
+            gpio.output(step_pin, HIGH)
+            wait_until(start + fall_times[i])
+            gpio.output(step_pin, LOW)
+            steps += 1
+            if on_step is not None and on_step():
+                break
+
+        return self.finish_run(schedule, start, steps, max_lateness)
+
+    def finish_run(self, schedule, start, steps, max_lateness):
+        # This function waits out the last step and reports the achieved versus commanded step rate.
+        # The last step owns its whole interval, like the old sleep based step did.
+        commanded_duration = 0
+        if steps:
+            commanded_duration = schedule.rise_times[steps - 1] + schedule.intervals[steps - 1]
+            self.wait_until(start + commanded_duration)
+        elapsed = self.clock() - start
+
+        self.next_deadline = None
+        self.last_report = {'start': start,
+                            'steps': steps,
+                            'commanded_rate': steps / commanded_duration if commanded_duration else 0,
+                            'achieved_rate': steps / elapsed if steps and elapsed else 0,
+                            'commanded_duration': commanded_duration,
+                            'duration': elapsed,
+                            'max_lateness': max_lateness}
+        return self.last_report
+
+    def run_ticks(self, schedule, tick_pins, on_tick=None, start=None):
+        # This function emits a schedule whose ticks may pulse several step pins at once (coordinated motion).
+        # tick_pins[i] holds the pins stepped at tick i, on_tick(i) is called after it, True stops the move.
+        # start chains the schedule to a previous one's end deadline, so back to back moves don't drift.
+        gpio = self.gpio
+        clock = self.clock
+        wait_until = self.wait_until
+        rise_times = schedule.rise_times
+        fall_times = schedule.fall_times
+
+        ticks = 0
+        max_lateness = 0.0
+        if start is None:
+            start = clock()
+        for i in range(len(schedule)):
+            pins = tick_pins[i]
+            rise = start + rise_times[i]
+            wait_until(rise)
+            lateness = clock() - rise
+            if lateness > max_lateness:
+                max_lateness = lateness
+            for pin in pins:
+                gpio.output(pin, HIGH)
+            wait_until(start + fall_times[i])
+            for pin in pins:
+                gpio.output(pin, LOW)
+            ticks += 1
+            if on_tick is not None and on_tick(i):
+                break
+
+        return self.finish_run(schedule, start, ticks, max_lateness)
+
+    def pulse(self, interval):
+        # This function emits a single step for loops that still step one call at a time. The pulses are
+        # chained on a running deadline, a caller that is idle (or late) for more than a whole interval
+        # starts a new chain instead of bursting to catch up.
+        now = self.clock()
+        if self.next_deadline is None or now - self.next_deadline > interval:
+            self.next_deadline = now
+        rise = self.next_deadline
+        self.wait_until(rise)
+        self.gpio.output(self.step_pin, HIGH)
+        self.wait_until(rise + 0.5 * interval)
+        self.gpio.output(self.step_pin, LOW)
+        self.next_deadline = rise + interval
+        self.wait_until(self.next_deadline)
+
+
+if __name__ == "__main__":
+    from fake_gpio import RecordingGPIO
+
+    fake_gpio = RecordingGPIO()
+    for velocity in (200, 1000, 5000, 10000):
+        timer = StepTimer(fake_gpio, step_pin=11)
+        fake_gpio.reset()
+        report = timer.run(StepSchedule(constant_velocity_intervals(2000, velocity)))
+        print(f"commanded {report['commanded_rate']:.0f} [steps/sec], achieved {report['achieved_rate']:.0f} "
+              f"[steps/sec], max lateness {report['max_lateness'] * 1e6:.1f} [usec]")
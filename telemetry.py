@@ -0,0 +1,94 @@
+import threading
+import time
+from array import array
+
+DEFAULT_CAPACITY = 1 << 16  # records, a power of 2
+
+
+class TelemetryChannel:
+    def __init__(self, capacity=DEFAULT_CAPACITY, decimation=1, clock=time.perf_counter):
+        # A preallocated ring buffer of (timestamp, axis, step, position) records. The step loop writes into it
+        # with a few array stores and never blocks or prints, the consumers drain it at their own pace.
+        # decimation keeps one record out of every n writes.
+        if capacity & (capacity - 1):
+            raise ValueError('The telemetry capacity must be a power of 2.')
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.decimation = decimation
+        self.clock = clock
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.axes = array('b', bytes(capacity))
+        self.steps = array('q', bytes(8 * capacity))
+        self.positions = array('d', bytes(8 * capacity))
+        self.writes = 0
+        self.head = 0  # the records written so far, the next one goes to head & mask
+
+    def record(self, axis, step, position):
+        # This function is called from the step loop, once per step
+        self.writes += 1
+        if self.writes % self.decimation:
+            return
+        index = self.head & self.mask
+        self.timestamps[index] = self.clock()
+        self.axes[index] = axis
+        self.steps[index] = step
+        self.positions[index] = position
+        self.head += 1
+
+
+class TelemetryReader:
+    def __init__(self, channel, decimation=1):
+        # One consumer's cursor into a channel, records it was too slow to read are counted as dropped
+        self.channel = channel
+        self.decimation = decimation
+        self.cursor = channel.head
+        self.dropped = 0
+
+    def drain(self):
+        # This function returns the new records since the last drain, every decimation-th one
+        channel = self.channel
+        head = channel.head
+        first = max(self.cursor, head - channel.capacity)
+        self.dropped += first - self.cursor
+        first += -first % self.decimation
+        records = [(channel.timestamps[i & channel.mask], channel.axes[i & channel.mask],
+                    channel.steps[i & channel.mask], channel.positions[i & channel.mask])
+                   for i in range(first, head, self.decimation)]
+
+        # The writer may have lapped the records while they were copied, those are dropped too
+        overwritten = channel.head - channel.capacity
+        if overwritten > first:
+            kept = [record for i, record in zip(range(first, head, self.decimation), records) if i >= overwritten]
+            self.dropped += len(records) - len(kept)
+            records = kept
+        self.cursor = head
+        return records
+
+
+class ProgressDisplay(threading.Thread):
+    def __init__(self, channel, total_steps, interval=0.2, label='Steps'):
+        # A terminal progress line fed by the telemetry channel, it replaces tqdm in the step loops
+        super().__init__(daemon=True)
+        self.reader = TelemetryReader(channel)
+        self.total_steps = total_steps
+        self.interval = interval
+        self.label = label
+        self.done_steps = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.show()
+
+    def show(self):
+        records = self.reader.drain()
+        self.done_steps += (len(records) + self.reader.dropped) * self.reader.channel.decimation
+        self.reader.dropped = 0
+        print(f'\r{self.label}: {min(self.done_steps, self.total_steps)}/{self.total_steps}', end='', flush=True)
+
+    def close(self):
+        self.running = False
+        self.join()
+        self.show()
+        print()
@@ -0,0 +1,86 @@
+import pytest
+from axis_control import Axis
+from step_drivers import SimulatedDriver, VirtualDriver
+
+
+def x_axis(driver, step_resolution=0.05):
+    axis = Axis(axis_name='X axis', direction_pin=31, step_pin=29, kill_switch_i_pin=10, kill_switch_f_pin=11,
+                direction='right', step_resolution=step_resolution, axis_length=1500, driver=driver)
+    axis.current_position = 750
+    return axis
+
+
+def virtual_axis(step_resolution=0.05):
+    # An X axis on a fresh virtual driver, parked in the middle of its travel with its carriage
+    driver = VirtualDriver()
+    axis = x_axis(driver, step_resolution)
+    driver.carriages[0].position = axis.step_position
+    return driver, axis
+
+
+def simulated_axis():
+    # An X axis on a fresh simulated driver, its switches are pressed by the test and its pulses are recorded
+    driver = SimulatedDriver()
+    return driver.gpio, x_axis(driver)
+
+
+def test_million_steps_out_and_back_do_not_drift():
+    _driver, axis = virtual_axis()
+    for direction in (1, 0):
+        for _ in range(1000000):
+            axis.update_axis_status(1000, direction)
+    assert axis.step_position == 15000
+    assert axis.current_position == 750
+
+
+def test_step_loop_round_trips_land_on_the_start():
+    # 0.03 [mm] has no exact binary form, a float sum of it would drift within a few thousand steps
+    driver, axis = virtual_axis(step_resolution=0.03)
+    start = axis.step_position
+    for _ in range(20):
+        axis.axis_for_loop(4000, 1, 3333)
+        axis.axis_for_loop(4000, 0, 3333)
+    assert axis.step_counter == 20 * 2 * 3333
+    assert axis.step_position == start
+    assert axis.current_position == 750
+    assert driver.carriages[0].position == start
+    assert not axis.stop
+
+
+def test_a_kill_switch_edge_stops_the_axis_on_the_next_step():
+    gpio, axis = simulated_axis()
+    axis.kill_switch_f.press_at_pulse(gpio, axis.step_pin, 300)
+    axis.axis_for_loop(2000, 1, 1000)
+    assert len(gpio.rising_edges(axis.step_pin)) == 300
+    assert axis.step_position == 15300
+    assert axis.stop
+    assert 0 <= axis.stop_latency < 0.005
+
+
+def test_a_kill_switch_pressed_from_another_thread_stops_the_axis():
+    gpio, axis = simulated_axis()
+    axis.kill_switch_i.press_after(0.1)
+    axis.axis_for_loop(2000, 0, 1000)
+    assert 0 < len(gpio.rising_edges(axis.step_pin)) < 1000
+    assert axis.stop_latency is not None
+
+
+@pytest.mark.parametrize('direction, steps', [(1, 0), (0, 100)])
+def test_a_pressed_kill_switch_only_blocks_the_moves_towards_it(direction, steps):
+    gpio, axis = simulated_axis()
+    axis.kill_switch_f.press()
+    axis.axis_for_loop(2000, direction, 100)
+    assert len(gpio.rising_edges(axis.step_pin)) == steps
+    assert bool(axis.stop) == (steps == 0)
+
+
+def test_a_released_kill_switch_lets_the_axis_move_again():
+    gpio, axis = simulated_axis()
+    axis.kill_switch_f.press_at_pulse(gpio, axis.step_pin, 10)
+    axis.axis_for_loop(2000, 1, 100)
+    axis.kill_switch_f.release()
+    gpio.reset()
+    axis.axis_for_loop(2000, 1, 100)
+    assert len(gpio.rising_edges(axis.step_pin)) == 100
+    assert axis.step_position == 15110
+    assert not axis.stop
@@ -0,0 +1,131 @@
+import asyncio
+import threading
+import time
+import pytest
+from command_client import GantryClient
+from command_server import CommandServer
+from gantry_controller import GantryController
+from machine import build_machine
+from step_drivers import get_driver
+
+
+class SlowPlanningController(GantryController):
+    # The moves take a while to plan, a stop that comes meanwhile lands before the move has armed its kill switches
+    def __init__(self, axes, driver, homing):
+        super().__init__(axes, driver, homing)
+        self.planning = threading.Event()
+
+    def move_to_position(self, position, feed_rate):
+        self.planning.set()
+        time.sleep(0.05)
+        return super().move_to_position(position, feed_rate)
+
+
+def serve(controller_class):
+    # This function serves a controller of the simulated machine on a free port, its event loop on its own
+    # thread, the moves take real time. Returns (controller, client, close).
+    driver = get_driver('simulated')
+    axes, homing = build_machine(driver)
+    controller = controller_class(axes, driver, homing)
+    server = CommandServer(controller, port=0)
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+        server.server.close()
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    ready.wait()
+    client = GantryClient(port=server.port, timeout=30)
+
+    def close():
+        client.close()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        controller.close()
+
+    return controller, client, close
+
+
+@pytest.fixture
+def gantry():
+    controller, client, close = serve(GantryController)
+    yield controller, client
+    close()
+
+
+def test_a_batch_runs_its_moves_in_order(gantry):
+    controller, client = gantry
+    start = controller.state()['positions']
+    results = client.move_batch([(start[0] + 5, start[1] + 5, None), (start[0] + 2, start[1] + 8, start[2] + 1)],
+                                feed_rate=100)
+    assert len(results) == 2
+    assert all(result['steps'] > 0 for result in results)
+    assert client.state()['positions'] == pytest.approx((start[0] + 2, start[1] + 8, start[2] + 1), abs=1e-9)
+
+
+def test_the_state_is_answered_while_a_move_runs(gantry):
+    controller, client = gantry
+    start = controller.state()['positions'][0]
+    answer = client.send({'command': 'move_to', 'position': [start + 20, None, None], 'feed_rate': 40})
+    state = client.state()
+    while state['positions'][0] == start:
+        state = client.state()
+    assert state['busy']
+    assert start < state['positions'][0] < start + 20
+    assert state['velocities'][0] > 0
+    assert answer.empty()
+    assert answer.get(timeout=30)['ok']
+    assert client.state()['positions'][0] == pytest.approx(start + 20)
+
+
+def test_the_subscribed_events_follow_a_move(gantry):
+    controller, client = gantry
+    start = controller.state()['positions'][0]
+    client.subscribe(0.01)
+    assert not client.next_event(5)['busy']
+    client.move_to((start + 10, None, None), feed_rate=50)
+    events = []
+    while not events or events[-1]['busy']:
+        events.append(client.next_event(5))
+    positions = [event['positions'][0] for event in events]
+    assert any(event['busy'] for event in events)
+    assert positions == sorted(positions)
+    assert positions[-1] == pytest.approx(start + 10)
+    client.unsubscribe()
+
+
+def test_stop_ends_the_running_move(gantry):
+    controller, client = gantry
+    start = controller.state()['positions'][0]
+    answer = client.send({'command': 'move_to', 'position': [start + 400, None, None], 'feed_rate': 40})
+    while not client.state()['busy']:
+        pass
+    client.stop()
+    report = answer.get(timeout=5)['result']
+    assert report['steps'] < round(400 / controller.axes[0].step_resolution)
+    assert client.state()['positions'][0] < start + 400
+
+
+def test_stop_ends_a_move_that_has_not_armed_its_kill_switches_yet():
+    # A move re-arms its kill switches (which clears axis.stop) before its first step, the stop must outlast that
+    controller, client, close = serve(SlowPlanningController)
+    try:
+        start = controller.state()['positions'][0]
+        answer = client.send({'command': 'move_to', 'position': [start + 400, None, None], 'feed_rate': 40})
+        assert controller.planning.wait(5)
+        client.stop()
+        assert answer.get(timeout=5)['ok']
+        assert client.state()['positions'][0] < start + 1
+    finally:
+        close()
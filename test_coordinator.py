@@ -0,0 +1,153 @@
+import asyncio
+import threading
+import coordinator
+from command_server import CommandServer
+from coordinator import Coordinator, Node
+from dry_run import virtual_machine
+from gantry_controller import GantryController
+
+JOB = 'G90\nG1 X5 Y5 F600\nG1 X1 Y2\n'
+
+
+class StallingController(GantryController):
+    # A node that takes jobs and never finishes them, it is cut off by the test
+    def __init__(self, axes, driver, homing):
+        super().__init__(axes, driver, homing)
+        self.job_started = threading.Event()
+
+    async def job(self, gcode):
+        self.job_started.set()
+        await asyncio.Event().wait()
+
+
+class LocalNode:
+    def __init__(self, controller_class=GantryController):
+        # An in-process command server on a virtual machine, its event loop on its own thread
+        driver, axes, homing = virtual_machine()
+        self.controller = controller_class(axes, driver, homing)
+        self.server = CommandServer(self.controller, port=0)
+        self.writers = []
+        self.loop = asyncio.new_event_loop()
+        self.stalled = False
+        self.closing = threading.Event()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.serve, args=(ready,), daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def serve(self, ready):
+        asyncio.set_event_loop(self.loop)
+        serve_client = self.server.serve_client
+
+        async def tracked_client(reader, writer):
+            self.writers.append(writer)
+            await serve_client(reader, writer)
+
+        self.server.serve_client = tracked_client
+        self.loop.run_until_complete(self.server.start())
+        ready.set()
+        self.loop.run_forever()
+        # A stalled node keeps its connections open until the test closes it
+        self.closing.wait()
+        self.abort()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def abort(self):
+        self.server.server.close()
+        for writer in self.writers:
+            writer.transport.abort()
+
+    def kill(self):
+        # The node goes away the way a crashed process does: it stops listening and its connections reset
+        self.loop.call_soon_threadsafe(self.abort)
+
+    def stall(self):
+        # The node's event loop stops: its connections stay open, but it answers nothing
+        self.stalled = True
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def close(self):
+        self.closing.set()
+        if not self.stalled:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.controller.close()
+
+
+def start_coordinator(nodes):
+    # This function returns a coordinator of the nodes, once all of them are connected
+    jobs = Coordinator([(name, '127.0.0.1', node.server.port) for name, node in zip('ab', nodes)],
+                       estimator=lambda gcode: 1.0)
+    with jobs.condition:
+        assert jobs.condition.wait_for(lambda: all(node.status == 'idle' for node in jobs.nodes), 5)
+    return jobs
+
+
+def test_the_job_of_a_node_that_dies_is_rescheduled():
+    nodes = [LocalNode(StallingController), LocalNode()]
+    jobs = start_coordinator(nodes)
+    try:
+        # Equal estimates tie on the node name, so the stalling node 'a' gets the first job
+        for index in range(4):
+            jobs.submit(JOB, f'job {index}')
+        assert nodes[0].controller.job_started.wait(5)
+        nodes[0].kill()
+        assert jobs.wait(10)
+
+        results = jobs.results()
+        assert [result['status'] for result in results] == ['done'] * 4
+        assert all(result['node'] == 'b' for result in results)
+        assert sorted(result['attempts'] for result in results) == [1, 1, 1, 2]
+        assert all(result['position'][:2] == [1.0, 2.0] for result in results)
+        node_status = {node['name']: node for node in jobs.status()['nodes']}
+        assert node_status['a']['failures'] == 1
+        assert node_status['a']['status'] in ('down', 'connecting')
+        assert node_status['b']['completed'] == 4
+    finally:
+        jobs.close()
+        for node in nodes:
+            node.close()
+
+
+def test_a_node_that_misses_its_heartbeat_is_taken_down(monkeypatch):
+    monkeypatch.setattr(coordinator, 'HEARTBEAT_INTERVAL', 0.1)
+    monkeypatch.setattr(coordinator, 'HEARTBEAT_TIMEOUT', 0.5)
+    nodes = [LocalNode(StallingController), LocalNode()]
+    jobs = start_coordinator(nodes)
+    try:
+        jobs.submit(JOB, 'stalled job')
+        assert nodes[0].controller.job_started.wait(5)
+        nodes[0].stall()
+        assert jobs.wait(10)
+        result = jobs.results()[0]
+        assert (result['status'], result['node'], result['attempts']) == ('done', 'b', 2)
+        assert jobs.status()['nodes'][0]['failures'] == 1
+    finally:
+        jobs.close()
+        for node in nodes:
+            node.close()
+
+
+def test_a_late_answer_of_a_node_taken_down_is_ignored():
+    jobs = Coordinator([], estimator=lambda gcode: 1.0)
+    try:
+        node_a, node_b = jobs.nodes = [Node('a', '127.0.0.1', 1), Node('b', '127.0.0.1', 2)]
+        for node in jobs.nodes:
+            node.status = 'idle'
+        job = jobs.submit(JOB)
+        assert jobs.take_job(node_a) is job
+        jobs.node_failed(node_a, 'no heartbeat')
+        assert jobs.take_job(node_b) is job
+
+        report = {'status': 'done', 'duration': 1.0, 'position': [1.0, 2.0, 0.0], 'commands': {}}
+        jobs.finish_job(node_a, job, report)
+        assert (job.status, job.node, node_b.job) == ('running', 'b', job)
+        assert node_a.completed == 0
+        jobs.finish_job(node_b, job, report)
+        assert (job.status, job.attempts, node_b.completed) == ('done', 2, 1)
+    finally:
+        jobs.close()
@@ -0,0 +1,81 @@
+import pytest
+from dry_run import virtual_machine
+from gcode import (DEFAULT_FEED_RATE, RAPID, RELATIVE, JobRunner, compile_job, interpret, is_compiled, load_job,
+                   parse, read_compiled)
+from machine import load_config
+
+JOB = '''; a test job
+G90 G1 X110 Y120 F600 (absolute, 10 [mm/sec])
+G91
+G1 X-5 Z2
+G90 G0 X100 Y100
+M400
+'''
+
+
+def commands(text):
+    return list(interpret(parse(text.splitlines())))
+
+
+def test_parse_drops_the_comments_and_the_empty_lines():
+    assert list(parse(['g1 x1.5 (a comment) y-.5 ; another one', '', '(only a comment)', 'G28'])) == \
+           [(1, [('G', 1.0), ('X', 1.5), ('Y', -0.5)]), (4, [('G', 28.0)])]
+
+
+def test_interpret_keeps_the_modal_state():
+    assert commands(JOB) == [('move', 0, 10.0, (110.0, 120.0, None)),
+                             ('move', RELATIVE, 10.0, (-5.0, None, 2.0)),
+                             ('move', RAPID, 10.0, (100.0, 100.0, None)),
+                             ('wait',)]
+
+
+def test_interpret_turns_the_feed_rate_into_mm_per_second():
+    assert commands('X1\nG1 X2 F1500\nG0 X3 F3000\nG1 X4') == [('move', 0, DEFAULT_FEED_RATE, (1.0, None, None)),
+                                                            ('move', 0, 25.0, (2.0, None, None)),
+                                                            ('move', RAPID, 50.0, (3.0, None, None)),
+                                                            ('move', 0, 50.0, (4.0, None, None))]
+
+
+def test_interpret_homes_and_sets_the_position():
+    assert commands('G28\nG92 X0 Y5') == [('home',), ('set_position', (0.0, 5.0, None))]
+
+
+@pytest.mark.parametrize('line', ['G20 X1', 'G2 X1 Y1', 'G1 X1 F0'])
+def test_interpret_rejects_what_it_does_not_support(line):
+    with pytest.raises(ValueError, match='Line 1'):
+        commands(line)
+
+
+def test_a_compiled_job_reads_back_the_same_commands(tmp_path):
+    job_path = tmp_path / 'job.gcode'
+    job_path.write_text(JOB + 'G28\nG92 X0 Y0 Z0\n')
+    compiled_path = tmp_path / 'job.gcj'
+    expected = list(load_job(job_path))
+    assert compile_job(load_job(job_path), compiled_path) == len(expected)
+    assert not is_compiled(job_path)
+    assert is_compiled(compiled_path)
+    assert list(read_compiled(compiled_path)) == expected
+    assert list(load_job(compiled_path)) == expected
+
+
+def test_job_runner_moves_the_virtual_machine():
+    driver, axes, homing = virtual_machine(start=[100, 100, 100])
+    report = JobRunner(axes, driver, homing).run(commands(JOB))
+    assert report['status'] == 'done'
+    assert report['commands'] == {'move': 3, 'home': 0, 'set_position': 0, 'wait': 1}
+    assert report['position'] == pytest.approx([100, 100, 102])
+    for axis, carriage, distance in zip(axes, driver.carriages, (20, 40, 2)):
+        assert axis.step_counter == round(distance / axis.step_resolution)
+        assert carriage.position == axis.step_position
+    assert driver.switch_events() == []
+
+
+def test_job_runner_homes_and_moves_from_the_set_position():
+    home_positions = [axis['homing']['home_position'] for axis in load_config()['axes']]
+    driver, axes, homing = virtual_machine(carriages=[300, 100, 500])
+    report = JobRunner(axes, driver, homing).run(commands('G28\nG92 X0 Y0 Z0\nG1 X-10 Y10 Z-5 F1200'))
+    assert report['status'] == 'done'
+    assert report['position'] == pytest.approx([home_positions[0] - 10, home_positions[1] + 10,
+                                                home_positions[2] - 5])
+    for axis, carriage in zip(axes, driver.carriages):
+        assert carriage.position == axis.step_position
@@ -0,0 +1,28 @@
+import copy
+from dry_run import virtual_machine
+from machine import load_config
+
+
+def test_build_machine_homes_with_the_config_settings():
+    config = copy.deepcopy(load_config())  # the loaded config is shared by the whole process
+    config['axes'][0]['homing'] = {'home_position': 120, 'back_off': 2}
+    _driver, axes, homing = virtual_machine(config)
+    assert homing.axes == axes
+    assert homing.settings[0].home_position == 120
+    assert homing.settings[0].back_off == 2
+    assert [setting.home_position for setting in homing.settings[1:]] == \
+           [axis_config.get('homing', {}).get('home_position') for axis_config in config['axes'][1:]]
+
+
+def test_homing_parks_every_axis_at_its_home_position():
+    # The carriages start away from where the axes think they are, as after a power cycle
+    config = load_config()
+    home_positions = [axis.get('homing', {}).get('home_position') for axis in config['axes']]
+    driver, axes, homing = virtual_machine(config, carriages=[300, 100, 500])
+    report = homing.home()
+    for axis, carriage, home_position in zip(axes, driver.carriages, home_positions):
+        assert report['axes'][axis.axis_name]['status'] == 'homed'
+        if home_position is not None:
+            assert axis.current_position == home_position
+        assert carriage.position == axis.step_position
+        assert not axis.stop
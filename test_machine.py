@@ -0,0 +1,15 @@
+import pytest
+from machine import LIBRARY_MODULES, MAX_IMPORT_TIME, MAX_STARTUP_TIME, import_time, startup_time
+
+
+@pytest.mark.parametrize('module', LIBRARY_MODULES)
+def test_library_module_imports_fast_without_hardware(module):
+    seconds, hardware = import_time(module, runs=3)
+    assert hardware == []
+    assert seconds < MAX_IMPORT_TIME
+
+
+def test_machine_starts_fast_on_the_simulated_driver():
+    seconds, axes = startup_time('simulated')
+    assert [axis.axis_name for axis in axes] == ['X axis', 'Y axis', 'Z axis']
+    assert seconds < MAX_STARTUP_TIME
@@ -0,0 +1,44 @@
+import math
+import random
+import sys
+import pytest
+from scan_patterns import nearest_neighbour, path_time, time_matrix, two_opt
+
+LIMITS = [(50.0, 200.0), (40.0, 150.0), (20.0, math.inf)]  # (velocity [mm/sec], acceleration [mm/sec^2])
+
+
+def scattered_points(amount=60, seed=3):
+    generator = random.Random(seed)
+    return [(generator.uniform(0, 300), generator.uniform(0, 200), generator.uniform(0, 20)) for _ in range(amount)]
+
+
+def ordering(points, monkeypatch=None):
+    # This function returns the time matrix, nearest neighbour and 2-opt orders of the points,
+    # on the pure Python path when monkeypatch is given (it hides NumPy)
+    if monkeypatch is not None:
+        monkeypatch.setitem(sys.modules, 'numpy', None)
+    times = time_matrix(points, LIMITS)
+    order = nearest_neighbour(times)
+    return times, order, two_opt(times, order)
+
+
+def test_the_numpy_and_pure_python_orderings_agree(monkeypatch):
+    pytest.importorskip('numpy')
+    points = scattered_points()
+    times, order, optimized = ordering(points)
+    with monkeypatch.context() as context:
+        python_times, python_order, python_optimized = ordering(points, context)
+    assert isinstance(python_times, list)
+    assert times.tolist() == pytest.approx(python_times)
+    assert order == python_order
+    assert optimized == python_optimized
+    assert path_time(times, optimized) == pytest.approx(path_time(python_times, python_optimized))
+
+
+def test_the_ordering_visits_every_point_and_only_saves_time(monkeypatch):
+    points = scattered_points()
+    times, order, optimized = ordering(points, monkeypatch)
+    assert order[0] == optimized[0] == 0
+    assert sorted(optimized) == list(range(len(points)))
+    assert path_time(times, optimized) <= path_time(times, order) <= path_time(times, range(len(points)))
+
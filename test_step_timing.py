@@ -0,0 +1,84 @@
+import pytest
+from axis_control import Axis
+from fake_gpio import RecordingGPIO, VirtualClock
+from step_drivers import SimulatedDriver
+from step_timing import StepSchedule, StepTimer, chained_start, constant_velocity_intervals
+
+STEP_PIN = 11
+TOLERANCE = 0.0005  # [sec], how far a real clock pulse may be off its deadline on a loaded CI machine
+
+
+def virtual_timer():
+    # A step timer on a virtual clock, its pulses land exactly on their deadlines
+    clock = VirtualClock()
+    gpio = RecordingGPIO(clock.now)
+    timer = StepTimer(gpio, STEP_PIN, clock.now, clock.sleep, spin_threshold=0)
+    return gpio, timer
+
+
+def test_the_pulses_follow_the_schedule_on_a_virtual_clock():
+    gpio, timer = virtual_timer()
+    intervals = [0.004, 0.002, 0.001, 0.001, 0.002, 0.004]
+    report = timer.run(StepSchedule(intervals))
+    assert report['steps'] == len(gpio.rising_edges(STEP_PIN)) == len(intervals)
+    assert gpio.pulse_intervals(STEP_PIN) == pytest.approx(intervals[:-1])
+    assert report['duration'] == pytest.approx(sum(intervals))
+    falling = [timestamp for timestamp, pin, value in gpio.edges if pin == STEP_PIN and value == gpio.LOW]
+    widths = [fall - rise for rise, fall in zip(gpio.rising_edges(STEP_PIN), falling)]
+    assert widths == pytest.approx([0.5 * interval for interval in intervals])
+
+
+def test_the_pulses_keep_their_rate_on_the_real_clock():
+    gpio = RecordingGPIO()
+    report = StepTimer(gpio, STEP_PIN).run(StepSchedule(constant_velocity_intervals(500, 5000)))
+    rising = gpio.rising_edges(STEP_PIN)
+    assert report['steps'] == len(rising) == 500
+    # Every edge is due at an absolute time, the late ones don't push the rest back
+    assert report['achieved_rate'] == pytest.approx(5000, rel=0.02)
+    # A preempted step comes late once, the scheduler may do that to a few of them
+    on_time = [abs(interval - 1 / 5000) < TOLERANCE for interval in gpio.pulse_intervals(STEP_PIN)]
+    assert sum(on_time) >= 0.95 * len(on_time)
+
+
+def test_on_step_stops_the_move():
+    gpio, timer = virtual_timer()
+    steps = []
+
+    def on_step():
+        steps.append(1)
+        return len(steps) == 30
+
+    report = timer.run(StepSchedule(constant_velocity_intervals(100, 1000)), on_step)
+    assert report['steps'] == len(gpio.rising_edges(STEP_PIN)) == 30
+
+
+def test_run_ticks_pulses_only_the_pins_of_each_tick():
+    gpio, timer = virtual_timer()
+    tick_pins = [(11, 13), (11,), (11, 13), (11,)]
+    report = timer.run_ticks(StepSchedule(constant_velocity_intervals(4, 1000)), tick_pins, start=1.0)
+    assert report['steps'] == 4
+    assert gpio.rising_edges(11) == pytest.approx([1.0, 1.001, 1.002, 1.003])
+    assert gpio.rising_edges(13) == pytest.approx([1.0, 1.002])
+
+
+def test_a_late_chained_move_starts_afresh():
+    schedule = StepSchedule(constant_velocity_intervals(10, 1000))
+    assert chained_start(None, schedule, 5.0) is None
+    assert chained_start(5.0, schedule, 5.0005) == 5.0
+    assert chained_start(5.0, schedule, 5.002) is None
+    assert chained_start(5.0, StepSchedule([]), 5.0) is None
+
+
+@pytest.mark.parametrize('direction', [0, 1])
+def test_an_axis_sets_its_direction_before_the_first_step(direction):
+    driver = SimulatedDriver()
+    axis = Axis(axis_name='X axis', direction_pin=31, step_pin=29, kill_switch_i_pin=10, kill_switch_f_pin=11,
+                direction='right', step_resolution=0.05, axis_length=1500, driver=driver)
+    axis.current_position = 750
+    driver.gpio.reset()
+    axis.axis_for_loop(5000, direction, 200)
+    edges = driver.gpio.edges
+    assert edges[0][1:] == (31, direction)
+    assert all(pin == 29 for _timestamp, pin, _value in edges[1:])
+    assert len(driver.gpio.rising_edges(29)) == 200
+    assert axis.step_position == 15000 + (200 if direction == 1 else -200)
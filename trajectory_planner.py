@@ -0,0 +1,242 @@
+import math
+import time
+from coordinated_motion import dda_ticks
+from metrics import get_metrics
+from step_timing import StepSchedule, chained_start
+
+# All the planner values are along the path: [mm], [mm/sec] and [mm/sec^2]
+DEFAULT_ACCELERATION = 400
+DEFAULT_JUNCTION_DEVIATION = 0.05  # [mm], how far a corner may be rounded, 0 makes every waypoint a full stop
+MINIMUM_JUNCTION_SPEED = 0.0
+
+
+class Segment:
+    def __init__(self, start_steps, end_steps, step_resolutions, feed_rate):
+        # A straight move between two waypoints, in whole steps so the rounding never adds up along a path
+        self.step_deltas = [end - start for start, end in zip(start_steps, end_steps)]
+        self.deltas = [delta * resolution for delta, resolution in zip(self.step_deltas, step_resolutions)]
+        self.length = math.sqrt(sum(delta ** 2 for delta in self.deltas))
+        self.unit = [delta / self.length for delta in self.deltas] if self.length else [0.0] * len(self.deltas)
+        self.feed_rate = feed_rate  # the nominal (cruise) speed of the segment
+
+        self.acceleration = 0.0
+        self.max_entry_speed = 0.0  # the junction speed limit with the previous segment
+        self.entry_speed = 0.0
+        self.exit_speed = 0.0
+
+    def speed_profile(self):
+        # This function returns the (peak speed, acceleration distance, deceleration distance) of the segment
+        a, length = self.acceleration, self.length
+        v0, v1, peak = self.entry_speed, self.exit_speed, self.feed_rate
+        accel_distance = (peak ** 2 - v0 ** 2) / (2 * a)
+        decel_distance = (peak ** 2 - v1 ** 2) / (2 * a)
+        if accel_distance + decel_distance > length:
+            peak = math.sqrt(max((2 * a * length + v0 ** 2 + v1 ** 2) / 2, max(v0, v1) ** 2))
+            accel_distance = max((peak ** 2 - v0 ** 2) / (2 * a), 0.0)
+            decel_distance = max(length - accel_distance, 0.0)
+        return peak, accel_distance, decel_distance
+
+    def time_at(self, distance, profile=None):
+        # This function returns the time [sec] at which the segment reaches a distance along it [mm]
+        a = self.acceleration
+        v0 = self.entry_speed
+        peak, accel_distance, decel_distance = profile or self.speed_profile()
+        accel_time = (peak - v0) / a
+        cruise_distance = self.length - accel_distance - decel_distance
+        cruise_time = cruise_distance / peak if peak else 0.0
+
+        if distance <= accel_distance:
+            return (-v0 + math.sqrt(v0 ** 2 + 2 * a * distance)) / a
+        if distance <= accel_distance + cruise_distance:
+            return accel_time + (distance - accel_distance) / peak
+        decel = distance - accel_distance - cruise_distance
+        return accel_time + cruise_time + (peak - math.sqrt(max(peak ** 2 - 2 * a * decel, 0.0))) / a
+
+    def duration(self):
+        return self.time_at(self.length)
+
+    def step_schedule(self):
+        # This function returns the segment's DDA ticks and their pulse schedule, the major axis steps every tick
+        step_amounts = tuple(abs(delta) for delta in self.step_deltas)
+        major_steps = max(step_amounts)
+        profile = self.speed_profile()
+        times = [self.time_at(self.length * tick / major_steps, profile) for tick in range(major_steps + 1)]
+        intervals = [times[tick + 1] - times[tick] for tick in range(major_steps)]
+        return dda_ticks(step_amounts), StepSchedule(intervals)
+
+
+def clip_to_soft_limits(axis, position):
+    # This function returns a position [mm] moved inside the axis soft limits, when the axis has them
+    if axis.soft_limits is None:
+        return position
+    low, high = axis.soft_limits
+    return min(max(position, low), high)
+
+
+class TrajectoryPlanner:
+    def __init__(self, axes, acceleration=DEFAULT_ACCELERATION, junction_deviation=DEFAULT_JUNCTION_DEVIATION,
+                 start_steps=None):
+        # A queued look-ahead planner (like the GRBL / Marlin ones) for paths made of many short waypoints.
+        # The corner speed between segments is limited by a junction deviation, then the entry and exit speeds
+        # are made reachable by a backward and a forward pass, so consecutive segments blend without stopping.
+        # The path starts at start_steps, the axes position when None.
+        self.axes = axes
+        self.acceleration = acceleration
+        self.junction_deviation = junction_deviation
+        self.segments = []
+        self.planned = True
+        self.last_steps = [axis.step_position for axis in axes] if start_steps is None else list(start_steps)
+
+    def axis_limits(self, unit):
+        # This function returns the path's (max speed, acceleration) in a direction, so no axis exceeds its profile
+        max_speed = math.inf
+        acceleration = self.acceleration
+        for axis, component in zip(self.axes, unit):
+            if component == 0 or axis.motion_profile is None:
+                continue
+            max_speed = min(max_speed, axis.motion_profile.max_velocity * axis.step_resolution / abs(component))
+            acceleration = min(acceleration, axis.motion_profile.acceleration * axis.step_resolution / abs(component))
+        return max_speed, acceleration
+
+    def add_waypoint(self, position, feed_rate):
+        # This function queues a straight move to a position [mm] per axis at a feed rate [mm/sec]
+        # The waypoints are clipped to the axes soft limits here, the step loop doesn't check the position
+        steps = [round(clip_to_soft_limits(axis, value) / axis.step_resolution)
+                 for value, axis in zip(position, self.axes)]
+        segment = Segment(self.last_steps, steps, [axis.step_resolution for axis in self.axes], feed_rate)
+        if segment.length == 0:
+            return None
+        max_speed, segment.acceleration = self.axis_limits(segment.unit)
+        segment.feed_rate = min(feed_rate, max_speed)
+
+        if self.segments:
+            previous = self.segments[-1]
+            cos_theta = -sum(u0 * u1 for u0, u1 in zip(previous.unit, segment.unit))
+            if cos_theta > -0.999999:
+                junction_speed = MINIMUM_JUNCTION_SPEED
+                if cos_theta < 0.999999 and self.junction_deviation > 0:
+                    sin_half_theta = math.sqrt(0.5 * (1 - cos_theta))
+                    junction_speed = math.sqrt(segment.acceleration * self.junction_deviation * sin_half_theta /
+                                               (1 - sin_half_theta))
+            else:
+                junction_speed = math.inf  # straight through
+            segment.max_entry_speed = min(junction_speed, segment.feed_rate, previous.feed_rate)
+
+        self.segments.append(segment)
+        self.last_steps = steps
+        self.planned = False
+        return segment
+
+    def add_waypoints(self, positions, feed_rate):
+        for position in positions:
+            self.add_waypoint(position, feed_rate)
+
+    def plan(self):
+        # This function computes every segment's entry and exit speeds, the path starts and ends at rest
+        segments = self.segments
+        if not segments:
+            return segments
+        start = time.perf_counter()
+
+        # Backward pass, every segment must be able to slow down to the next one's entry speed
+        next_entry = 0.0
+        for segment in reversed(segments):
+            segment.exit_speed = next_entry
+            segment.entry_speed = min(segment.max_entry_speed,
+                                      math.sqrt(next_entry ** 2 + 2 * segment.acceleration * segment.length))
+            next_entry = segment.entry_speed
+
+        # Forward pass, every segment must be able to speed up to its exit speed
+        segments[0].entry_speed = 0.0
+        for segment, following in zip(segments, segments[1:]):
+            reachable = math.sqrt(segment.entry_speed ** 2 + 2 * segment.acceleration * segment.length)
+            if following.entry_speed > reachable:
+                following.entry_speed = reachable
+            segment.exit_speed = following.entry_speed
+        segments[-1].exit_speed = 0.0
+
+        self.planned = True
+        get_metrics().record_planning('trajectory', time.perf_counter() - start)
+        return segments
+
+    def job_time(self):
+        # This function returns the planned duration of the queued path [sec]
+        if not self.planned:
+            self.plan()
+        return sum(segment.duration() for segment in self.segments)
+
+    def execute(self, driver):
+        # This function steps the axes through the planned path. The segments are chained on one deadline
+        # clock, so a segment starts exactly when the previous one ends. Their schedules are all computed before
+        # the first step, a segment that still starts late is started afresh, see step_timing.chained_start.
+        # A kill switch stops the whole path.
+        if not self.planned:
+            self.plan()
+        gpio = driver.gpio
+        step_timer = driver.step_timer(None)
+        step_pins = [axis.step_pin for axis in self.axes]
+        steps = []
+        for segment in self.segments:
+            ticks, schedule = segment.step_schedule()
+            steps.append((segment, ticks, schedule, [tuple(step_pins[index] for index in tick) for tick in ticks]))
+
+        end = None
+        reports = []
+        for segment, ticks, schedule, tick_pins in steps:
+            directions = [1 if delta > 0 else 0 for delta in segment.step_deltas]
+            for axis, direction, delta in zip(self.axes, directions, segment.step_deltas):
+                if delta:
+                    gpio.output(axis.direction_pin, direction)
+                    axis.arm_kill_switches(direction)
+                    if axis.stop:
+                        return reports
+            velocities = [abs(component) * segment.feed_rate / axis.step_resolution
+                          for component, axis in zip(segment.unit, self.axes)]
+
+            def on_tick(tick):
+                stop = False
+                for index in ticks[tick]:
+                    axis = self.axes[index]
+                    axis.update_axis_status(velocities[index], directions[index])
+                    if axis.stop:
+                        stop = axis.stopped_by_kill_switch()
+                return stop
+
+            step_counters = [axis.step_counter for axis in self.axes]
+            report = step_timer.run_ticks(schedule, tick_pins, on_tick,
+                                          chained_start(end, schedule, step_timer.clock()))
+            reports.append(report)
+            get_metrics().record_move('trajectory', report,
+                                      [(axis.axis_name, axis.step_counter - step_counter)
+                                       for axis, step_counter in zip(self.axes, step_counters)],
+                                      report['steps'] < len(schedule))
+            if report['steps'] < len(schedule):
+                break
+            end = report['start'] + report['commanded_duration']
+        self.segments = []
+        return reports
+
+if __name__ == "__main__":
+    # Benchmark: the planned job time of a dense 1,000 waypoints path, blended versus stopping at every point
+    class BenchmarkAxis:
+        def __init__(self, step_resolution):
+            self.step_resolution = step_resolution
+            self.step_position = 0
+            self.soft_limits = None
+            self.motion_profile = None
+
+    waypoints = []
+    for i in range(1000):
+        angle = i * 0.05
+        radius = 50 + 0.2 * i
+        waypoints.append((700 + radius * math.cos(angle), 250 + 0.5 * radius * math.sin(angle), 0.5 * i))
+
+    for junction_deviation in (0, 0.01, DEFAULT_JUNCTION_DEVIATION, 0.2):
+        planner = TrajectoryPlanner([BenchmarkAxis(0.05) for _ in range(3)],
+                                    acceleration=DEFAULT_ACCELERATION, junction_deviation=junction_deviation)
+        start = time.perf_counter()
+        planner.add_waypoints(waypoints, feed_rate=100)
+        planner.plan()
+        planning_time = time.perf_counter() - start
+        print(f'Junction deviation {junction_deviation} [mm]: job time {planner.job_time():.1f} [sec], '
+              f'planned in {planning_time * 1e3:.1f} [msec]')